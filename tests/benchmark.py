@@ -0,0 +1,80 @@
+# Copyright (c) 2020 Adam Souzis
+# SPDX-License-Identifier: MIT
+"""
+Micro-benchmarks for the optimizations whose gains aren't visible in the test suite.
+They aren't collected by pytest; run them from the repository root:
+
+    python tests/benchmark.py [name...] [--number N]
+
+Each prints its timings and exits with an error if the results of the fast path
+don't match the results of the code path it replaces.
+"""
+from __future__ import print_function
+import argparse
+import sys
+import timeit
+
+from unfurl.runtime import NodeInstance
+from unfurl.eval import RefContext
+from unfurl.result import ResultsMap
+from unfurl import support
+
+
+def benchTemplates(number):
+    """
+    Compares the time `applyTemplate` takes to evaluate trivial templates directly
+    with the time it takes to render them with jinja2.
+    The templates are taken from the helm and docker configurators.
+    """
+    resource = NodeInstance(
+        "test", dict(homeDir="/home", volumes=["a"], name="x", url="http://x")
+    )
+    inputs = ResultsMap(dict(chart="stable/mysql"), RefContext(resource))
+    templates = [
+        "{{ SELF.url }}",
+        "{{ inputs.chart }}",
+        "{{ '.::volumes' | ref }}",
+        "{{ 'name' | eval }}",
+    ]
+
+    def apply(template):
+        ctx = RefContext(resource, dict(SELF=resource.attributes, inputs=inputs))
+        return support.applyTemplate(template, ctx)
+
+    parseTrivialTemplate = support._parseTrivialTemplate
+    ok = True
+    print("%-28s %10s %10s" % ("template", "jinja2", "direct"))
+    for template in templates:
+        direct = apply(template)
+        timeDirect = timeit.timeit(lambda: apply(template), number=number)
+        support._parseTrivialTemplate = lambda value, templar: None
+        try:
+            rendered = apply(template)
+            timeRendered = timeit.timeit(lambda: apply(template), number=number)
+        finally:
+            support._parseTrivialTemplate = parseTrivialTemplate
+        if direct != rendered or type(direct) is not type(rendered):
+            print("mismatch for %s: %r != %r" % (template, direct, rendered))
+            ok = False
+        print("%-28s %9.3fs %9.3fs" % (template, timeRendered, timeDirect))
+    return ok
+
+
+benchmarks = dict(templates=benchTemplates)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Run unfurl's micro-benchmarks.")
+    parser.add_argument("names", nargs="*", help="default: all of them")
+    parser.add_argument("--number", type=int, default=2000)
+    options = parser.parse_args(args)
+    ok = True
+    for name in options.names or sorted(benchmarks):
+        print("%s (number=%s):" % (name, options.number))
+        if not benchmarks[name](options.number):
+            ok = False
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,12 @@ import unfurl.util
 import unittest
 from unfurl.yamlmanifest import YamlManifest
 from unfurl.job import Runner, JobOptions
-from unfurl.configurators.ansible import runPlaybooks
+from unfurl.configurators.ansible import (
+    runPlaybooks,
+    getPlaybookPool,
+    PlaybookResults,
+)
+from unfurl.util import saveToTempfile
 from unfurl.runtime import Status
 import os
 import os.path
@@ -20,7 +25,7 @@ class AnsibleTest(unittest.TestCase):
             pass
         self.results = {}
 
-    def runPlaybook(self, args=None):
+    def runPlaybook(self, args=None, runPlaybooks=runPlaybooks):
         return runPlaybooks(
             [os.path.join(os.path.dirname(__file__), "examples", "testplaybook.yaml")],
             "localhost,",
@@ -60,6 +65,42 @@ class AnsibleTest(unittest.TestCase):
         assert results.resultsByStatus.ok.get("test-verbosity")
         assert not results.resultsByStatus.skipped.get("test-verbosity")
 
+    def test_pool(self):
+        results = self.runPlaybook(runPlaybooks=getPlaybookPool(2).runPlaybooks)
+        # the results were sent back from the worker process
+        assert not results.exit_code
+        saved = results.resultsByStatus.ok["save command results"][0]
+        self.assertEqual(saved._result["stdout"], "hello")
+        assert saved.is_changed()
+        assert results.resultsByStatus.skipped.get("test-verbosity")
+        # pools are shared by size
+        self.assertIs(getPlaybookPool(2), getPlaybookPool(2))
+        self.assertEqual(getPlaybookPool(1).size, 1)
+
+    def test_playResults(self):
+        playbook = [
+            dict(name=name, hosts="localhost", gather_facts=False, tasks=[task])
+            for name, task in [
+                ("good", dict(command="echo good")),
+                ("bad", dict(fail=dict(msg="bad"))),
+            ]
+        ]
+        path = saveToTempfile(playbook, "-playbook.yml").name
+        results = PlaybookResults(
+            runPlaybooks(
+                [path],
+                "localhost,",
+                {
+                    "ansible_connection": "local",
+                    "ansible_python_interpreter": sys.executable,
+                },
+            )
+        )
+        assert results.exit_code
+        # each play gets the exit code it would have if it ran by itself
+        self.assertEqual(results.getPlayResults("good").exit_code, 0)
+        self.assertEqual(results.getPlayResults("bad").exit_code, 2)
+
 
 manifest = """
 apiVersion: unfurl/v1alpha1
@@ -113,3 +154,75 @@ class AnsibleConfiguratorTest(unittest.TestCase):
         self.assertEqual(result.outputs, {"fact1": "test1", "fact2": "test"})
         self.assertEqual(result.result.get("stdout"), sys.executable)
         assert run1.status == Status.ok, run1.summary()
+
+    def test_isolated(self):
+        isolatedManifest = manifest.replace(
+            """              fact1: "{{ '.name' | ref }}"
+""",
+            "",
+        ).replace("    inputs:\n", "    inputs:\n      isolated: true\n")
+        runner = Runner(YamlManifest(isolatedManifest))
+        run1 = runner.run(JobOptions(resource="test1", jobs=2))
+        assert not run1.unexpectedAbort, run1.unexpectedAbort.getStackTrace()
+        assert len(run1.workDone) == 1, run1.workDone
+        result = list(run1.workDone.values())[0].result
+        self.assertEqual(result.outputs, {"fact2": "test"})
+        self.assertEqual(result.result.get("stdout"), sys.executable)
+        assert run1.status == Status.ok, run1.summary()
+        # batching is opt-in
+        task = list(run1.workDone.values())[0]
+        assert task.configurator.getBatchItem(task) is None
+
+        # a playbook that uses unfurl's filters isn't isolated even if "isolated" is set
+        runner = Runner(
+            YamlManifest(
+                manifest.replace("    inputs:\n", "    inputs:\n      isolated: true\n")
+            )
+        )
+        run2 = runner.run(JobOptions(resource="test1", jobs=2))
+        assert not run2.unexpectedAbort, run2.unexpectedAbort.getStackTrace()
+        result = list(run2.workDone.values())[0].result
+        self.assertEqual(result.outputs, {"fact1": "test1", "fact2": "test"})
+        assert run2.status == Status.ok, run2.summary()
+
+    def test_batch(self):
+        batchManifest = manifest.replace(
+            """              fact1: "{{ '.name' | ref }}"
+""",
+            "",
+        ).replace(
+            "    inputs:\n", "    inputs:\n      isolated: true\n      batch: true\n"
+        ) + """
+        test2:
+          type: tosca.nodes.Root
+          properties:
+            testProp: "test2"
+          interfaces:
+            Standard:
+              +/configurations:
+"""
+        runner = Runner(YamlManifest(batchManifest))
+        run1 = runner.run(JobOptions(jobs=2))
+        assert not run1.unexpectedAbort, run1.unexpectedAbort.getStackTrace()
+        assert len(run1.workDone) == 2, run1.workDone
+        results = [task.result for task in run1.workDone.values()]
+        # each task got the results of its own play
+        self.assertEqual(results[0].outputs, {"fact2": "test"})
+        self.assertEqual(results[1].outputs, {"fact2": "test2"})
+        assert run1.status == Status.ok, run1.summary()
+
+        # a host that fails only fails its own task
+        failingManifest = batchManifest.replace(
+            "        q:\n",
+            """        q:
+          - fail:
+              msg: failed
+            when: SELF.testProp == "test2"
+""",
+        )
+        run2 = Runner(YamlManifest(failingManifest)).run(JobOptions(jobs=2))
+        assert not run2.unexpectedAbort, run2.unexpectedAbort.getStackTrace()
+        tasks = list(run2.workDone.values())
+        self.assertEqual([task.target.name for task in tasks], ["test1", "test2"])
+        assert tasks[0].result.success, run2.summary()
+        assert not tasks[1].result.success, run2.summary()
@@ -1,9 +1,17 @@
 import unittest
+import os.path
+from click.testing import CliRunner
 from unfurl.yamlmanifest import YamlManifest
-from unfurl.job import Runner, JobOptions, Status
+from unfurl.job import Runner, JobOptions, Status, ParallelScheduler
+from unfurl.plan import TaskGraph
+from unfurl.eval import getExprProfile
 from unfurl.configurator import Configurator
 from unfurl.merge import lookupPath
+from unfurl.result import serializeValue
+from unfurl.util import TokenBucket
 import datetime
+import threading
+import time
 
 
 class TestConfigurator(Configurator):
@@ -28,6 +36,104 @@ class TestConfigurator(Configurator):
         yield task.done(True)
 
 
+def _double(value):
+    return value * 2
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+class WaitingConfigurator(Configurator):
+    def run(self, task):
+        doubled = yield task.wait(_double, task.inputs["value"])
+        try:
+            yield task.wait(_fail, "expected")
+            error = None
+        except ValueError as e:
+            error = str(e)
+        task.target.attributes["doubled"] = doubled
+        task.target.attributes["error"] = error
+        yield task.done(True)
+
+
+class SpawnStartConfigurator(Configurator):
+    def run(self, task):
+        subtask = yield task.createSubTask("Standard.start", inputs={})
+        yield task.done(subtask.result.success)
+
+
+class CountStartsConfigurator(Configurator):
+    def run(self, task):
+        task.target.attributes["starts"] = task.target.attributes.get("starts", 0) + 1
+        yield task.done(True)
+
+
+class StartOtherConfigurator(Configurator):
+    def run(self, task):
+        other = task.target.root.findResource("other")
+        yield task.createSubTask("Standard.start", other, inputs=dict(extra=1))
+        yield task.done(True)
+
+
+class UpdateNestedConfigurator(Configurator):
+    def run(self, task):
+        nested = task.target.attributes["nested"]
+        nested["a"] = 10
+        del nested["b"]
+        yield task.done(True)
+
+
+class CountStartsWithSecretConfigurator(CountStartsConfigurator):
+    def run(self, task):
+        task.target.attributes["password"] = task.sensitive("secret")
+        return super(CountStartsWithSecretConfigurator, self).run(task)
+
+
+class InterruptOnceConfigurator(Configurator):
+    interrupted = False
+
+    def run(self, task):
+        if not InterruptOnceConfigurator.interrupted:
+            InterruptOnceConfigurator.interrupted = True
+            raise KeyboardInterrupt()
+        yield task.done(True)
+
+
+_batchCalls = []
+
+
+def _runUpperBatch(items):
+    _batchCalls.append(len(items))
+    return [item.upper() for item in items]
+
+
+class UpperBatchConfigurator(Configurator):
+    def run(self, task):
+        result = yield task.waitBatch("upper", _runUpperBatch, task.target.name)
+        task.target.attributes["upper"] = result
+        yield task.done(True)
+
+
+_sleeping = dict(current=0, most=0)
+_sleepingLock = threading.Lock()
+
+
+def _sleep(seconds):
+    with _sleepingLock:
+        _sleeping["current"] += 1
+        _sleeping["most"] = max(_sleeping["most"], _sleeping["current"])
+    time.sleep(seconds)
+    with _sleepingLock:
+        _sleeping["current"] -= 1
+
+
+class SleepConfigurator(Configurator):
+    def run(self, task):
+        yield task.wait(_sleep, 0.1)
+        yield task.done(True)
+
+
 manifest = """
 apiVersion: unfurl/v1alpha1
 kind: Manifest
@@ -214,6 +320,495 @@ class ConfiguratorTest(unittest.TestCase):
         )
         assert job.rootResource.findResource("testNode").attributes["outputVar"]
 
+    def test_alreadyHandled(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      topology_template:
+        node_templates:
+          testNode:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: SpawnStart
+                start:
+                  implementation:
+                    className: CountStarts
+  """
+        runner = Runner(YamlManifest(manifest))
+        job = runner.run()
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        # start was run as a subtask of configure so the plan didn't run it again
+        self.assertEqual(
+            job.rootResource.findResource("testNode").attributes["starts"], 1
+        )
+        self.assertEqual(len(job.workDone), 2)
+
+    def test_resume(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      node_types:
+        test.nodes.Nested:
+          derived_from: tosca.nodes.Root
+          properties:
+            nested:
+              type: map
+      topology_template:
+        node_templates:
+          node1:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: CountStarts
+          nestedNode:
+            type: test.nodes.Nested
+            properties:
+              nested:
+                a: 1
+                b: 2
+                c: 3
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: UpdateNested
+          node2:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: InterruptOnce
+  """
+        InterruptOnceConfigurator.interrupted = False
+        with CliRunner().isolated_filesystem():
+            with open("ensemble.yaml", "w") as f:
+                f.write(manifest)
+            runner = Runner(YamlManifest(path="ensemble.yaml"))
+            self.assertRaises(KeyboardInterrupt, runner.run)
+            assert os.path.exists("jobs/checkpoint.yaml")
+
+            runner = Runner(YamlManifest(path="ensemble.yaml"))
+            job = runner.run(JobOptions(resume=True))
+            assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+            self.assertEqual(job.stats()["ok"], 3, job.summary())
+            # node1's configure wasn't run again, its changes were restored
+            node1 = job.rootResource.findResource("node1")
+            self.assertEqual(node1.attributes["starts"], 1)
+            self.assertEqual(node1.status, Status.ok)
+            # only the nested keys that changed were recorded and restored
+            nestedNode = job.rootResource.findResource("nestedNode")
+            self.assertEqual(
+                serializeValue(nestedNode.attributes["nested"]), {"a": 10, "c": 3}
+            )
+            assert not os.path.exists("jobs/checkpoint.yaml")
+
+    def test_resumeTruncated(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      topology_template:
+        node_templates:
+          node1:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: CountStarts
+          node2:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: CountStartsWithSecret
+          node3:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: InterruptOnce
+  """
+        InterruptOnceConfigurator.interrupted = False
+        with CliRunner().isolated_filesystem():
+            with open("ensemble.yaml", "w") as f:
+                f.write(manifest)
+            runner = Runner(YamlManifest(path="ensemble.yaml"))
+            self.assertRaises(KeyboardInterrupt, runner.run)
+            # simulate being interrupted while writing another record
+            with open("jobs/checkpoint.yaml") as f:
+                lastRecord = f.read().split("---\n")[-1]
+            cutAt = lastRecord.index("configDigest")
+            for truncated in [lastRecord[:-20], lastRecord[:cutAt]]:
+                with open("jobs/checkpoint.yaml", "a") as f:
+                    f.write("---\n" + truncated)
+                runner = Runner(YamlManifest(path="ensemble.yaml"))
+                records = runner.manifest.loadCheckpoint(JobOptions())
+                self.assertEqual(len(records), 1)
+
+            job = runner.run(JobOptions(resume=True))
+            assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+            self.assertEqual(job.stats()["ok"], 3, job.summary())
+            node1 = job.rootResource.findResource("node1")
+            self.assertEqual(node1.attributes["starts"], 1)
+            # the password was redacted in the checkpoint so node2 was run again
+            node2 = job.rootResource.findResource("node2")
+            self.assertEqual(node2.attributes["password"], "secret")
+
+    def test_configChanged(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      node_types:
+        test.nodes.Greeter:
+          derived_from: tosca.nodes.Root
+          properties:
+            greeting:
+              type: string
+          interfaces:
+           Standard:
+            operations:
+              configure:
+                implementation:
+                  className: CountStarts
+                inputs:
+                  greeting: "{{ SELF.greeting }}"
+                  # a new path each time it's evaluated
+                  valuesFile:
+                    eval:
+                      tempfile: $inputs::greeting
+      topology_template:
+        node_templates:
+          node1:
+            type: test.nodes.Greeter
+            properties:
+              greeting: hello
+          node2:
+            type: test.nodes.Greeter
+            properties:
+              greeting: hi
+  """
+        with CliRunner().isolated_filesystem():
+            with open("ensemble.yaml", "w") as f:
+                f.write(manifest)
+            job = Runner(YamlManifest(path="ensemble.yaml")).run()
+            assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+            self.assertEqual(job.stats()["ok"], 2, job.summary())
+            task = list(job.workDone.values())[0]
+            self.assertEqual(task.target.name, "node1")
+            assert task.digest
+            self.assertEqual(
+                task.target._configDigests, {"Standard.configure": task.digest}
+            )
+
+            # nothing changed, nothing to do
+            job = Runner(YamlManifest(path="ensemble.yaml")).run()
+            self.assertEqual(len(job.workDone), 0, job.summary())
+
+            with open("ensemble.yaml") as f:
+                saved = f.read()
+            with open("ensemble.yaml", "w") as f:
+                f.write(saved.replace("greeting: hello", "greeting: goodbye"))
+            job = Runner(YamlManifest(path="ensemble.yaml")).run()
+            tasks = list(job.workDone.values())
+            self.assertEqual(len(tasks), 1, job.summary())
+            self.assertEqual(tasks[0].target.name, "node1")
+            self.assertEqual(tasks[0].reason, "config changed")
+            self.assertEqual(tasks[0].target.attributes["starts"], 2)
+
+    def test_configChangedSubtask(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      topology_template:
+        node_templates:
+          other:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                start:
+                  implementation:
+                    className: CountStarts
+          node1:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: StartOther
+  """
+        with CliRunner().isolated_filesystem():
+            with open("ensemble.yaml", "w") as f:
+                f.write(manifest)
+            job = Runner(YamlManifest(path="ensemble.yaml")).run()
+            assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+            tasks = list(job.workDone.values())
+            self.assertEqual(len(tasks), 2, job.summary())
+            assert tasks[0].digest
+            # the planner doesn't know the subtask's inputs so its digest isn't recorded
+            self.assertEqual(tasks[1].target.name, "other")
+            self.assertIsNone(tasks[1].digest)
+
+            job = Runner(YamlManifest(path="ensemble.yaml")).run()
+            self.assertEqual(len(job.workDone), 0, job.summary())
+
+    def test_planSummary(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      node_types:
+        test.nodes.Counted:
+          derived_from: tosca.nodes.Root
+          interfaces:
+           Standard:
+            operations:
+              configure:
+                implementation:
+                  className: CountStarts
+      topology_template:
+        node_templates:
+          node1:
+            type: test.nodes.Counted
+          node2:
+            type: test.nodes.Counted
+            requirements:
+              - dependency: node1
+          node3:
+            type: test.nodes.Counted
+  """
+        runner = Runner(YamlManifest(manifest))
+        job = runner.run(JobOptions(planOnly=True))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        summary = job.planSummary(True)
+        self.assertEqual(summary["depth"], 2)
+        self.assertEqual(summary["width"], 2)
+        self.assertEqual(
+            summary["criticalPath"],
+            [
+                dict(target="node1", operation="configure"),
+                dict(target="node2", operation="configure"),
+            ],
+        )
+        assert "estimatedDuration" not in summary  # no history
+
+    def test_profileExpressions(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      topology_template:
+        node_templates:
+          node1:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: unfurl.configurators.TemplateConfigurator
+                  inputs:
+                    run: "{{ '::node2::host' | eval }}"
+          node2:
+            type: tosca.nodes.Root
+            properties:
+              host: example.com
+  """
+        runner = Runner(YamlManifest(manifest))
+        job = runner.run(JobOptions(profileExpressions=5))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        stats = job.jsonSummary()["expressionProfile"]
+        self.assertIn("::node2::host", [e["source"] for e in stats["expressions"]])
+        self.assertEqual(
+            stats["templates"][0]["source"], "{{ '::node2::host' | eval }}"
+        )
+        self.assertIn("Expression profile", job.summary())
+        # the profile is only collected while the job runs
+        self.assertIsNone(getExprProfile())
+
+    def test_taskGraph(self):
+        graph = TaskGraph(["a", "b", "c", "d"])
+        graph.addEdge(0, 1)
+        graph.addEdge(0, 2)
+        graph.addEdge(2, 3)
+        self.assertEqual(graph.getLevels(), [1, 2, 2, 3])
+        self.assertEqual(graph.depth, 3)
+        self.assertEqual(graph.width, 2)
+        self.assertEqual(graph.findCriticalPath([1, 10, 2, 3]), (11, ["a", "b"]))
+        self.assertEqual(graph.findCriticalPath([1, 1, 2, 3]), (6, ["a", "c", "d"]))
+
+    def test_schedulerCycles(self):
+        class Instance(object):
+            def __init__(self, name):
+                self.name = name
+                self.deps = []
+
+            def getOperationalDependents(self):
+                return []
+
+        class Plan(object):
+            def findInstanceDependencies(self, instance):
+                return instance.deps
+
+            def findTemplateDependencies(self, template):
+                return []
+
+        class Job(object):
+            plan = Plan()
+
+        a, b, c, d = [Instance(name) for name in "abcd"]
+        a.deps = [d]  # against plan order but not a cycle
+        b.deps = [c]
+        c.deps = [b]  # cycle
+        workflows = [(i, i, None) for i in [a, b, c, d]]
+        scheduler = ParallelScheduler(Job(), workflows)
+        # only the dependency in the cycle that points against plan order is dropped
+        self.assertEqual(scheduler.waitingOn, {0: set([3]), 1: set(), 2: set([1]), 3: set()})
+        self.assertEqual(sorted(scheduler.ready), [1, 3])
+
+    def test_batch(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      node_types:
+        test.nodes.Batched:
+          derived_from: tosca.nodes.Root
+          interfaces:
+           Standard:
+            operations:
+              configure:
+                implementation:
+                  className: UpperBatch
+      topology_template:
+        node_templates:
+          node1:
+            type: test.nodes.Batched
+          node2:
+            type: test.nodes.Batched
+          node3:
+            type: test.nodes.Batched
+  """
+        del _batchCalls[:]
+        job = Runner(YamlManifest(manifest)).run(JobOptions(jobs=3, startTime=1))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        self.assertEqual(job.stats()["ok"], 3, job.summary())
+        # the three tasks ran in one batch
+        self.assertEqual(_batchCalls, [3])
+        for name in ["node1", "node2", "node3"]:
+            node = job.rootResource.findResource(name)
+            self.assertEqual(node.attributes["upper"], name.upper())
+
+        # without parallel tasks each task runs its own batch
+        del _batchCalls[:]
+        job = Runner(YamlManifest(manifest)).run(JobOptions(startTime=1))
+        self.assertEqual(job.stats()["ok"], 3, job.summary())
+        self.assertEqual(_batchCalls, [1, 1, 1])
+
+    def test_limits(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  context:
+    limits:
+      configurators:
+        Sleep: 2
+  spec:
+    service_template:
+      node_types:
+        test.nodes.Sleepy:
+          derived_from: tosca.nodes.Root
+          interfaces:
+           Standard:
+            operations:
+              configure:
+                implementation:
+                  className: Sleep
+      topology_template:
+        node_templates:
+          node1:
+            type: test.nodes.Sleepy
+          node2:
+            type: test.nodes.Sleepy
+          node3:
+            type: test.nodes.Sleepy
+          node4:
+            type: test.nodes.Sleepy
+  """
+        _sleeping["most"] = 0
+        job = Runner(YamlManifest(manifest)).run(JobOptions(jobs=4, startTime=1))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        self.assertEqual(job.stats()["ok"], 4, job.summary())
+        self.assertEqual(_sleeping["most"], 2)
+
+        now = [0.0]
+        bucket = TokenBucket(2, burst=2, clock=lambda: now[0])
+        self.assertEqual([bucket.reserve() for i in range(4)], [0, 0, 0.5, 1.0])
+        now[0] = 3.0  # refilled, but not past the burst size
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0.5])
+
+    def test_wait(self):
+        manifest = """\
+  apiVersion: unfurl/v1alpha1
+  kind: Manifest
+  spec:
+    service_template:
+      topology_template:
+        node_templates:
+          testNode:
+            type: tosca.nodes.Root
+            interfaces:
+             Standard:
+              operations:
+                configure:
+                  implementation:
+                    className: Waiting
+                  inputs:
+                    value: 21
+  """
+        runner = Runner(YamlManifest(manifest))
+        job = runner.run()
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        self.assertEqual(job.stats()["ok"], 1)
+        testNode = job.rootResource.findResource("testNode")
+        self.assertEqual(testNode.attributes["doubled"], 42)
+        self.assertEqual(testNode.attributes["error"], "expected")
+
+        task = list(job.workDone.values())[0]
+        self.assertEqual(list(task.timings), ["check", "run", "wait", "commit"])
+        timings = job.jsonSummary()["timings"]
+        self.assertEqual(list(timings[0]), list(task.timings))
+        assert all(t["wall"] >= 0 and t["cpu"] >= 0 for t in timings[0].values())
+
     # def test_shouldRun(self):
     #   pass
     #   #assert should_run
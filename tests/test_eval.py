@@ -2,11 +2,28 @@ import unittest
 import os
 import json
 from unfurl.result import ResultsList, serializeValue
-from unfurl.eval import Ref, mapValue, RefContext
-from unfurl.support import applyTemplate
+from unfurl.eval import (
+    Ref,
+    mapValue,
+    mapValueMany,
+    RefContext,
+    ExprCache,
+    exprCache,
+    Expr,
+    evalExp,
+    ExprProfile,
+)
+from unfurl.support import (
+    applyTemplate,
+    templateCache,
+    getTemplar,
+    AttributeManager,
+    Status,
+)
 from unfurl.util import sensitive_str
 from unfurl.runtime import NodeInstance
 from ruamel.yaml.comments import CommentedMap
+from ansible.parsing.vault import VaultSecret
 
 
 class EvalTest(unittest.TestCase):
@@ -132,6 +149,48 @@ class EvalTest(unittest.TestCase):
                     "expr was: " + ref.source,
                 )
 
+    def test_exprCache(self):
+        resource = self._getTestResource()
+        exprCache.clear()
+        for i in range(3):
+            self.assertEqual(Ref("d::a").resolve(RefContext(resource)), ["va"])
+        stats = exprCache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+        # relative paths are parsed differently inside a foreach
+        self.assertEqual(
+            Ref({"eval": "d", "foreach": "a"}).resolve(RefContext(resource)), ["va"]
+        )
+        self.assertEqual(exprCache.stats()["misses"], 3)
+
+        cache = ExprCache(2)
+        cache.put("a", [1])
+        cache.put("b", [2])
+        self.assertEqual(cache.get("a"), [1])
+        cache.put("c", [3])  # evicts "b", the least recently used
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.stats(), dict(hits=1, misses=1, size=2, maxsize=2))
+
+    def test_compiledExpr(self):
+        resource = self._getTestResource()
+        for exp in [
+            "x?::a[c=4]",
+            "x::a::[c]",
+            "x::a[!b]::c",
+            "d[a=va][a!=vb]",
+            "e::*::b2",
+            "b?::2",
+            "[!blah]",
+        ]:
+            expr = Expr(exp)
+            compiled = expr.resolve(RefContext(resource))
+            # evalExp() interprets the expression instead
+            interpreted = evalExp([resource], expr.paths, RefContext(resource))
+            self.assertEqual(
+                [r.resolved for r in compiled],
+                [r.resolved for r in interpreted],
+                "expr was: " + exp,
+            )
+
     def test_funcs(self):
         resource = self._getTestResource()
         test1 = {"ref": ".name", "vars": {"a": None}}
@@ -221,6 +280,281 @@ class EvalTest(unittest.TestCase):
         val = applyTemplate("{{ foo.bar }}", RefContext(resource, vars, trace=0))
         assert isinstance(val, sensitive_str), type(val)
 
+    def test_templateCache(self):
+        resource = NodeInstance("test", attributes=dict(a1="hello"))
+        templateCache.clear()
+        for value in ["one", "two"]:
+            ctx = RefContext(resource, {"foo": value})
+            self.assertEqual(applyTemplate("!{{ foo }}", ctx), "!" + value)
+            self.assertEqual(applyTemplate("{{ foo }}!", ctx), value + "!")
+        stats = templateCache.stats()
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hits"], 2)
+
+        # changing the delimiters compiles the template again
+        template = "#jinja2: variable_start_string: '<%', variable_end_string: '%>'\n<% foo %>!"
+        self.assertEqual(applyTemplate(template, ctx), "two!")
+        self.assertEqual(templateCache.stats()["misses"], 3)
+
+        # templars are shared by directory
+        self.assertIs(getTemplar("/tmp"), getTemplar("/tmp"))
+        self.assertEqual(getTemplar("/tmp")._basedir, "/tmp")
+        # and by vault secrets
+        secrets = [("default", VaultSecret(b"secret"))]
+        templar = getTemplar("/tmp", secrets)
+        self.assertIsNot(templar, getTemplar("/tmp"))
+        sameSecrets = [("default", VaultSecret(b"secret"))]
+        self.assertIs(templar, getTemplar("/tmp", sameSecrets))
+        self.assertEqual(templar._loader._vault.secrets, secrets)
+        self.assertFalse(getTemplar("/tmp")._loader._vault.secrets)
+
+    def test_trivialTemplates(self):
+        resource = NodeInstance(
+            "test",
+            attributes=dict(a1="hello", n=3, d={"k": "v"}, s=sensitive_str("secret")),
+        )
+        vars = dict(
+            foo="bar",
+            lst=[1, "{{ foo }}"],
+            SELF=resource.attributes,
+            tmpl="{{ foo }}",
+        )
+        # these are evaluated without jinja2 but adding parentheses forces them to be rendered
+        for exp in [
+            "SELF.a1",
+            "SELF.n",
+            "SELF.d.k",
+            "SELF.s",
+            "foo",
+            "lst",
+            "tmpl",
+            "'.::a1'",
+            "'::test::s' | ref",
+            "'.::d' | eval",
+        ]:
+            if exp[0] == "'" and "|" not in exp:
+                template, rendered = "{{ %s | ref }}" % exp, "{{ (%s) | ref }}" % exp
+            else:
+                template, rendered = "{{ %s }}" % exp, "{{ (%s) }}" % exp
+            expected = applyTemplate(rendered, RefContext(resource, dict(vars)))
+            result = applyTemplate(template, RefContext(resource, dict(vars)))
+            self.assertEqual(result, expected, exp)
+            self.assertIs(type(result), type(expected), exp)
+
+    def test_queryCache(self):
+        root = NodeInstance("root")
+        a = NodeInstance("a", dict(port=80, url={"eval": "::b::host"}), root)
+        b = NodeInstance("b", dict(host="foo"), root)
+        # each topology has its own cache
+        queryCache = a.queryCache
+        self.assertIs(queryCache, root.queryCache)
+
+        def query(expr, vars=None):
+            return Ref(expr).resolveOne(RefContext(a, vars))
+
+        self.assertEqual(query(".::url"), "foo")
+        self.assertEqual(query(".::url"), "foo")
+        self.assertEqual(queryCache.stats()["hits"], 1)
+
+        # the result is reused by the next task's attribute manager
+        root.attributeManager = AttributeManager()
+        self.assertEqual(query(".::url"), "foo")
+        self.assertEqual(queryCache.stats()["hits"], 2)
+
+        # changing an attribute the query read (even indirectly) invalidates it
+        b.attributes["host"] = "bar"
+        root.attributeManager.commitChanges()
+        root.attributeManager = AttributeManager()
+        self.assertEqual(query(".::url"), "bar")
+        self.assertEqual(query("::b::host"), "bar")
+        b.attributes["host"] = "baz"
+        self.assertEqual(query("::b::host"), "baz")
+        self.assertEqual(query(".::port"), 80)
+        hits = queryCache.stats()["hits"]
+        # but not other instances' attributes
+        self.assertEqual(query(".::port"), 80)
+        self.assertEqual(queryCache.stats()["hits"], hits + 1)
+
+        # so does a change to the vars it read
+        self.assertEqual(query("$port", dict(port=1)), 1)
+        self.assertEqual(query("$port", dict(port=2)), 2)
+
+        # or to the instances or their status
+        self.assertNotEqual(query("::b::.status"), Status.error)
+        self.assertEqual(len(query("::*")), 3)
+        b.localStatus = Status.error
+        self.assertEqual(query("::b::.status"), Status.error)
+        NodeInstance("c", parent=root)
+        self.assertEqual(len(query("::*")), 4)
+
+        # the memoized results are selected from for each call
+        self.assertEqual(Ref(".::port").resolve(RefContext(a, wantList=True)), [80])
+        self.assertEqual(Ref(".::port").resolve(RefContext(a), "result").resolved, 80)
+        self.assertEqual(query(".::port"), 80)
+
+        # nor do other topologies
+        root2 = NodeInstance("root")
+        a2 = NodeInstance("a", dict(port=8080), root2)
+        self.assertIsNot(a2.queryCache, queryCache)
+        self.assertEqual(Ref(".::port").resolveOne(RefContext(a2)), 8080)
+        self.assertEqual(a2.queryCache.stats()["misses"], 1)
+
+    def test_resolveMany(self):
+        root = NodeInstance("root")
+        a = NodeInstance("a", dict(port=80), root)
+        b = NodeInstance("b", dict(port=81), root)
+
+        self.assertEqual(Ref(".::port").resolveMany([a, b], wantList=False), [80, 81])
+        self.assertEqual(Ref("$x").resolveMany([a, b], dict(x=1), False), [1, 1])
+        results = Ref("::a::port").resolveMany([a, b, root])
+        self.assertEqual(results, [[80], [80], [80]])
+        # each instance gets its own results
+        self.assertIsNot(results[0]._attributes[0], results[1]._attributes[0])
+
+        self.assertEqual(mapValueMany({"eval": ".name"}, [a, b]), ["a", "b"])
+        self.assertEqual(mapValueMany("{{ '.name' | ref }}", [a, b]), ["a", "b"])
+
+    def test_exprProfile(self):
+        root = NodeInstance("root")
+        a = NodeInstance("a", dict(url={"eval": "::b::host"}), root)
+        NodeInstance("b", dict(host="foo"), root)
+        NodeInstance("c", dict(host="bar"), root)
+
+        profile = ExprProfile().start()
+        try:
+            ctx = RefContext(a)
+            self.assertEqual(Ref(".::url").resolveOne(ctx), "foo")
+            self.assertEqual(Ref("::*::host").resolve(ctx), ["foo", "bar"])
+            self.assertEqual(Ref("::*::host").resolve(ctx), ["foo", "bar"])
+            self.assertEqual(applyTemplate("{{ 'a' | upper }}", ctx), "A")
+        finally:
+            profile.stop()
+        # not collected after it stops
+        self.assertEqual(Ref("::*::[host=foo]").resolveOne(ctx).name, "b")
+        self.assertNotIn("::*::[host=foo]", profile.expressions)
+
+        stats = profile.getStats()
+        expressions = {item["source"]: item for item in stats["expressions"]}
+        self.assertEqual(set(expressions), set([".::url", "::b::host", "::*::host"]))
+        # the nested expression's time is included in the outer expression's time
+        url = expressions[".::url"]
+        self.assertEqual(url["calls"], 1)
+        self.assertGreaterEqual(url["time"], expressions["::b::host"]["time"])
+        self.assertEqual([s["segment"] for s in url["segments"]], [".", "url"])
+
+        host = expressions["::*::host"]
+        self.assertEqual(host["calls"], 2)
+        self.assertEqual(host["memoized"], 1)
+        # root, a, b and c were visited but only b and c matched
+        self.assertEqual(host["visited"], 4)
+        self.assertEqual(host["matched"], 4)
+        segment = host["segments"][0]
+        self.assertEqual(
+            segment, dict(segment="host", time=segment["time"], visited=4, matched=2)
+        )
+
+        self.assertEqual(stats["templates"][0]["source"], "{{ 'a' | upper }}")
+        self.assertEqual(stats["templates"][0]["calls"], 1)
+        # the header and one line for the slowest expression and template
+        self.assertEqual(len(profile.summary(1).splitlines()), 4)
+
+    def test_attributesCopyOnWrite(self):
+        state = {"outputs": {"a": [1, 2]}}
+        d = {"a": {"ref": ".name"}, "b": [{"c": 1}]}
+        resource = NodeInstance("test", dict(state=state, d=d, n="n"))
+        resource.attributeManager = AttributeManager()
+        self.assertEqual(resource.attributes["d"]["a"], "test")
+        resource.attributes["d"]["b"][0]["c"] = 2
+        del resource.attributes["d"]["a"]
+        resource.attributes["new"] = 1
+        self.assertEqual(resource.attributes["d"], dict(b=[dict(c=2)]))
+        # the instance's attributes weren't modified
+        self.assertEqual(
+            resource._attributes,
+            dict(state=state, d={"a": {"ref": ".name"}, "b": [{"c": 1}]}, n="n"),
+        )
+
+        changes = resource.attributeManager.commitChanges()
+        self.assertEqual(
+            changes[resource.key],
+            {"d": {"a": {"+%": "delete"}, "b": [{"c": 2}]}, "new": 1},
+        )
+        self.assertEqual(
+            resource._attributes, dict(state=state, d={"b": [{"c": 2}]}, n="n", new=1)
+        )
+        # values that weren't read are saved as is
+        self.assertIs(resource._attributes["state"], state)
+
+    def test_commitDirtyAttributes(self):
+        root = NodeInstance("root")
+        a = NodeInstance("a", dict(host="foo", d=dict(port=80)), root)
+        b = NodeInstance("b", dict(host="bar", url={"eval": "::a::host"}), root)
+        c = NodeInstance("c", dict(host="baz"), root)
+        saved = a._attributes
+        root.attributeManager = AttributeManager()
+        self.assertEqual(a.attributes["host"], "foo")
+        self.assertEqual(a.attributes["d"]["port"], 80)
+        self.assertEqual(b.attributes["url"], "foo")
+        c.attributes["d"] = dict(port=81)
+        changes = root.attributeManager.commitChanges()
+        # a was only read so it's skipped but b's evaluated value is saved
+        self.assertEqual(changes, {"::b": {"url": "foo"}, "::c": {"d": {"port": 81}}})
+        self.assertIs(a._attributes, saved)
+        self.assertEqual(b._attributes, dict(host="bar", url="foo"))
+
+        a.attributes["d"]["port"] = 81
+        changes = root.attributeManager.commitChanges()
+        self.assertEqual(changes, {"::a": {"d": {"port": 81}}})
+        self.assertEqual(a._attributes, dict(host="foo", d=dict(port=81)))
+
+    def test_commitNestedAttributes(self):
+        big = dict(
+            a=dict(b=dict(c=1), d=dict(e={"eval": "::root::missing"})),
+            l=[dict(f=1)],
+        )
+        root = NodeInstance("root")
+        inst = NodeInstance("inst", dict(big=big), root)
+        root.attributeManager = AttributeManager()
+        inst.attributes["big"]["a"]["b"]["c"] = 2
+        del inst.attributes["big"]["l"]
+        changes = root.attributeManager.commitChanges()
+        # only the changed subtrees are in the diff
+        self.assertEqual(
+            changes,
+            {"::inst": {"big": {"a": {"b": {"c": 2}}, "l": {"+%": "delete"}}}},
+        )
+        # items that weren't read are saved without being evaluated
+        saved = inst._attributes["big"]
+        self.assertEqual(saved, dict(a=dict(b=dict(c=2), d=big["a"]["d"])))
+        self.assertIs(saved["a"]["d"], big["a"]["d"])
+
+        # deleting a nested item is saved too
+        del inst.attributes["big"]["a"]["d"]
+        changes = root.attributeManager.commitChanges()
+        self.assertEqual(changes, {"::inst": {"big": {"a": {"d": {"+%": "delete"}}}}})
+        self.assertEqual(inst._attributes["big"], dict(a=dict(b=dict(c=2))))
+
+    def test_contextVars(self):
+        resource = NodeInstance("test")
+        vars = dict(a=1)
+        ctx = RefContext(resource, vars)
+        copy = ctx.copy(vars=dict(b=2))
+        self.assertEqual(dict(copy.vars), dict(a=1, b=2))
+        self.assertIs(ctx.copy().vars, ctx.vars)
+
+        # setting a var on a copy doesn't change the context it was copied from
+        copy.vars["a"] = 3
+        self.assertEqual(copy.vars["a"], 3)
+        self.assertEqual(vars, dict(a=1))
+
+        # and neither do the vars of the expression
+        query = {"eval": "$c", "vars": {"c": "c"}}
+        self.assertEqual(Ref(query).resolveOne(ctx), "c")
+        self.assertNotIn("c", ctx.vars)
+        query = {"eval": "$a", "foreach": "$item"}
+        self.assertEqual(Ref(query).resolve(ctx), [1])
+        self.assertNotIn("item", ctx.vars)
+
     def test_templateFunc(self):
         query = {
             "eval": {"template": "{%if testVar %}{{success}}{%else%}failed{%endif%}"},
@@ -15,6 +15,8 @@ from unfurl.merge import (
     expandDoc,
     restoreIncludes,
     diffDicts,
+    applyDiff,
+    intersectDict,
     mergeDicts,
     patchDict,
     parseMergeKey,
@@ -104,6 +106,24 @@ class ExpandDocTest(unittest.TestCase):
         patchDict(old, new)
         self.assertEqual(old, new)
 
+        # nested maps that are equal aren't included
+        old = {"a": {"b": {"c": 1}, "d": {"e": 1}}}
+        new = {"a": {"b": {"c": 1}, "d": {"e": 2}}}
+        self.assertEqual(diffDicts(old, new), {"a": {"d": {"e": 2}}})
+        self.assertEqual(diffDicts(old, copy.deepcopy(old)), {})
+
+        # applyDiff reverses diffDicts, including deleted keys and shortened lists
+        old = {"a": {"b": 1, "c": 2, "d": [1, 2]}, "e": 1, "f": 1}
+        new = {"a": {"b": 10, "d": [2]}, "e": {"g": 1}, "h": 1}
+        self.assertEqual(applyDiff(old, diffDicts(old, new)), new)
+        # deletions that are still live are kept
+        diff = diffDicts(old, new)
+        self.assertEqual(intersectDict(diff, new), diff)
+        deleted = {"+%": "delete"}
+        self.assertEqual(
+            intersectDict(dict(a=deleted, b=deleted), dict(a=1)), dict(b=deleted)
+        )
+
     def test_missingInclude(self):
         doc1 = CommentedMap(
             [("+/a/c", None), ("a", {"+/b": None}), ("b", {"c": {"d": 1}})]
@@ -138,6 +158,36 @@ class JobTest(unittest.TestCase):
     def test_lookupClass(self):
         assert lookupClass("Simple") is SimpleConfigurator
 
+    def test_configDigest(self):
+        # inputs that json can't serialize, like dates, don't break the digest
+        def makeSpec(day):
+            inputs = dict(when=datetime.date(2020, 1, day))
+            return ConfigurationSpec("test", "configure", "Simple", 0, inputs=inputs)
+
+        self.assertEqual(makeSpec(1).getDigest(), makeSpec(1).getDigest())
+        self.assertNotEqual(makeSpec(1).getDigest(), makeSpec(2).getDigest())
+
+        manifest = (
+            """
+    apiVersion: %s
+    kind: Manifest
+    spec:
+      instances:
+        anInstance:
+          interfaces:
+            Standard:
+              operations:
+               configure:
+                implementation: Simple
+                inputs:
+                  when: 2020-01-01
+    """
+            % API_VERSION
+        )
+        job = Runner(YamlManifest(manifest)).run(JobOptions(add=True, startTime=1))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        self.assertEqual(len(job.workDone), 1)
+
     # XXX rewrite
     # def test_runner(self):
     #   rootResource = NodeInstance('root')
@@ -158,6 +208,50 @@ class PickleTest(unittest.TestCase):
         # self.assertEqual(manifest.rootResource, manifest2.rootResource)
 
 
+class InstanceIndexTest(unittest.TestCase):
+    def test_findResource(self):
+        root = NodeInstance("root")
+        child = NodeInstance("child", parent=root)
+        grandchild = NodeInstance("grandchild", parent=child)
+        sibling = NodeInstance("sibling", parent=root)
+        self.assertIs(root.findResource("grandchild"), grandchild)
+        self.assertIs(child.findResource("grandchild"), grandchild)
+        self.assertIs(child.findResource("child"), child)
+        # only searches the instance's descendents
+        self.assertIsNone(child.findResource("sibling"))
+        self.assertIsNone(sibling.findResource("root"))
+        self.assertIsNone(root.findResource("missing"))
+        self.assertEqual(len(root.all), 4)
+        self.assertEqual(list(root.all), ["root", "child", "grandchild", "sibling"])
+        with self.assertRaises(UnfurlError):
+            NodeInstance("child", parent=sibling)
+
+
+class InstanceMemoryTest(unittest.TestCase):
+    @unittest.skipIf(six.PY2, "tracemalloc requires Python 3")
+    def test_bytesPerInstance(self):
+        import gc
+        import tracemalloc
+
+        count = 5000
+        root = NodeInstance("root")
+        template = root.template
+        names = ["node%s" % i for i in range(count)]
+        gc.collect()
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            for name in names:
+                NodeInstance(name, None, root, template)
+            gc.collect()
+            bytesPerInstance = (tracemalloc.get_traced_memory()[0] - start) // count
+        finally:
+            tracemalloc.stop()
+        # instances use __slots__, this was over 900 bytes when they didn't
+        assert not hasattr(root.findResource("node0"), "__dict__")
+        self.assertLess(bytesPerInstance, 750, "%s bytes per instance" % bytesPerInstance)
+
+
 class OperationalInstanceTest(unittest.TestCase):
     def test_aggregate(self):
         ignoredError = OperationalInstance("error", "ignore")
@@ -4,6 +4,7 @@ from unfurl.job import Runner, JobOptions
 from unfurl.configurator import Configurator, Status
 from unfurl.merge import lookupPath
 import datetime
+import tempfile
 
 manifest = """
 apiVersion: unfurl/v1alpha1
@@ -52,3 +53,58 @@ class ShellConfiguratorTest(unittest.TestCase):
             "helloworld",
         )
         assert not run1.unexpectedAbort, run1.unexpectedAbort.getStackTrace()
+
+    def test_parallel(self):
+        """
+        test that independent tasks can be run in parallel and are still recorded in plan order
+        """
+        parallelManifest = (
+            manifest
+            + """
+        test2:
+          type: tosca.nodes.Root
+          interfaces:
+            Standard:
+              +/configurations:
+        test3:
+          type: tosca.nodes.Root
+          interfaces:
+            Standard:
+              +/configurations:
+"""
+        )
+        runner = Runner(YamlManifest(parallelManifest))
+        job = runner.run(JobOptions(jobs=3, startTime=1))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        self.assertEqual(
+            [task.target.name for task in job.workDone.values()],
+            ["test1", "test2", "test3"],
+        )
+        for name in ["test1", "test2", "test3"]:
+            self.assertEqual(
+                runner.manifest.getRootResource().findResource(name).attributes["stdout"],
+                "helloworld",
+            )
+        # workflows that can't run in parallel fall back to running tasks in order
+        job = runner.run(JobOptions(workflow="undeploy", jobs=3, startTime=2))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+
+        # each task waits until all three have started so they have to overlap
+        barrier = tempfile.mkdtemp()
+        command = (
+            "touch %s/$$; for i in $(seq 100); do "
+            'if [ $(ls %s | wc -l) -ge 3 ]; then echo overlapped; exit 0; fi; '
+            "sleep 0.1; done; echo alone" % (barrier, barrier)
+        )
+        runner = Runner(
+            YamlManifest(
+                parallelManifest.replace("echo ${{inputs.envvar}}", command)
+            )
+        )
+        job = runner.run(JobOptions(jobs=3, startTime=1))
+        assert not job.unexpectedAbort, job.unexpectedAbort.getStackTrace()
+        for name in ["test1", "test2", "test3"]:
+            self.assertEqual(
+                runner.manifest.getRootResource().findResource(name).attributes["stdout"],
+                "overlapped",
+            )
@@ -222,6 +222,36 @@ class ToscaSyntaxTest(unittest.TestCase):
         vaultString = "server_ip: !vault |\n      $ANSIBLE_VAULT;1.1;AES256"
         assert vaultString in job.out.getvalue(), job.out.getvalue()
 
+    def test_nodesOfType(self):
+        manifest = YamlManifest(manifestDoc)
+        outputIp, job = self._runInputAndOutputs(manifest)
+        root = job.rootResource
+        for typeName in ["tosca.nodes.Root", "testy.nodes.aNodeType"]:
+            expected = [
+                r
+                for r in root.getSelfAndDescendents()
+                if r.template.isCompatibleType(typeName)
+            ]
+            self.assertEqual(root.all.findInstancesOfType(typeName), expected)
+        self.assertEqual(
+            sorted(root.all), sorted(r.name for r in root.getSelfAndDescendents())
+        )
+        self.assertEqual(
+            ["testSensitive"],
+            root.query("::*::[.type=testy.nodes.aNodeType]::.name", wantList=True),
+        )
+        self.assertEqual(
+            ["testSensitive"],
+            root.query(
+                "::*::[.template::type=testy.nodes.aNodeType]::.name", wantList=True
+            ),
+        )
+        # only exact matches
+        self.assertEqual(
+            ["inputs", "outputs"],
+            root.query("::*::[.type=tosca.nodes.Root]::.name", wantList=True),
+        )
+
     def test_import(self):
         """
         Tests nested imports and url fragment resolution.
@@ -125,6 +125,18 @@ jobControlOptions = option_group(
         default="never",
         help="Set exit code to 1 if job status is not ok.",
     ),
+    click.option(
+        "--jobs",
+        default=1,
+        type=int,
+        help="Maximum number of independent tasks to run in parallel. (Default: 1)",
+    ),
+    click.option(
+        "--resume",
+        default=False,
+        is_flag=True,
+        help="Skip the tasks already completed by the last job if it was interrupted.",
+    ),
 )
 
 commonJobFilterOptions = option_group(
@@ -132,6 +144,13 @@ commonJobFilterOptions = option_group(
     click.option("--instance", help="instance name to target"),
     click.option("--query", help="Run the given expression upon job completion"),
     click.option("--trace", default=0, help="Set the query's trace level"),
+    click.option(
+        "--profile-expressions",
+        default=0,
+        type=int,
+        metavar="N",
+        help="Profile the expressions evaluated by the job and print the N slowest.",
+    ),
     click.option(
         "--output",
         type=click.Choice(["text", "json", "none"]),
@@ -2,8 +2,11 @@
 # SPDX-License-Identifier: MIT
 import six
 import collections
+import hashlib
+import json
 import re
 import os
+import sys
 from .support import Status, Defaults, ResourceChanges
 from .result import serializeValue, ChangeAware, Results, ResultsMap
 from .util import (
@@ -56,6 +59,89 @@ class JobRequest(object):
         return "JobRequest(%s)" % (self.instances,)
 
 
+class WaitRequest(object):
+    """
+    Yield this to wait for a function that blocks on an external process or service to return
+    (see :py:meth:`unfurl.configurator.TaskView.wait`).
+    When the job is running tasks in parallel other tasks can run while the function is waiting.
+    The function's return value is sent back to the configurator
+    or, if it raised an exception, the exception is raised where the configurator yielded.
+    """
+
+    def __init__(self, func, args, kw):
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.result = None
+        self.excInfo = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args, **self.kw)
+        except Exception:
+            self.excInfo = sys.exc_info()
+        return self
+
+    def resume(self, generator):
+        if self.excInfo:
+            excInfo, self.excInfo = self.excInfo, None
+            return generator.throw(*excInfo)
+        return generator.send(self.result)
+
+    def __repr__(self):
+        return "WaitRequest(%s)" % getattr(self.func, "__name__", self.func)
+
+
+class BatchRequest(WaitRequest):
+    """
+    Yield this to run a function once for a batch of tasks
+    (see :py:meth:`unfurl.configurator.TaskView.waitBatch`).
+
+    When the job is running tasks in parallel, tasks that yield a BatchRequest with the same key
+    within ``window`` seconds of each other are combined: the function is called once
+    with the list of each request's ``item`` and must return a list with a result for each item,
+    which is sent back to the corresponding task.
+    Otherwise the function is called with a list containing just this request's item.
+    """
+
+    def __init__(self, key, func, item, window):
+        super(BatchRequest, self).__init__(func, (), {})
+        self.key = key
+        self.item = item
+        self.window = window
+        self.done = False
+
+    @staticmethod
+    def runBatch(requests):
+        func = requests[0].func
+        try:
+            results = func([request.item for request in requests])
+            if len(results) != len(requests):
+                raise UnfurlError(
+                    "batch function %s returned %s results for %s requests"
+                    % (getattr(func, "__name__", func), len(results), len(requests))
+                )
+        except Exception:
+            excInfo = sys.exc_info()
+            for request in requests:
+                request.excInfo = excInfo
+        else:
+            for request, result in zip(requests, results):
+                request.result = result
+        for request in requests:
+            request.done = True
+
+    def run(self):
+        self.runBatch([self])
+        return self
+
+    def __repr__(self):
+        return "BatchRequest(%s, %s)" % (
+            self.key,
+            getattr(self.func, "__name__", self.func),
+        )
+
+
 # we want ConfigurationSpec to be standalone and easily serializable
 class ConfigurationSpec(object):
     @classmethod
@@ -95,6 +181,7 @@ class ConfigurationSpec(object):
         primary=None,
         dependencies=None,
         outputs=None,
+        interface=None,
     ):
         assert name and className, "missing required arguments"
         self.name = name
@@ -111,6 +198,7 @@ class ConfigurationSpec(object):
         self.outputs = outputs or {}
         self.preConditions = preConditions
         self.postConditions = postConditions
+        self.interface = interface
 
     def findInvalidateInputs(self, inputs):
         if not self.inputSchema:
@@ -135,6 +223,27 @@ class ConfigurationSpec(object):
     def shouldRun(self):
         return Defaults.shouldRun
 
+    def getDigest(self):
+        """
+        Returns a digest of the fields that determine what the configuration does
+        (its name, workflow and other descriptive fields are ignored).
+        """
+        m = hashlib.sha1()
+        m.update(
+            json.dumps(
+                [
+                    self.operation,
+                    self.className,
+                    self.majorVersion,
+                    self.minorVersion,
+                    serializeValue(self.inputs),
+                ],
+                sort_keys=True,
+                default=str,  # e.g. dates
+            ).encode("utf-8")
+        )
+        return m.hexdigest()
+
     def copy(self, **mods):
         args = self.__dict__.copy()
         args.update(mods)
@@ -235,17 +344,22 @@ class Configurator(object):
     def getGenerator(self, task):
         return self.run(task)
 
-    # yields a JobRequest, TaskRequest or a ConfiguratorResult
+    # yields a JobRequest, TaskRequest, WaitRequest or a ConfiguratorResult
     def run(self, task):
         """
         This should perform the operation specified in the :class:`ConfigurationSpec`
         on the :obj:`task.target`.
 
+        Yielding a request suspends the configurator until the job has completed that request,
+        for example:
+
+        >>> output = yield task.wait(runCommand, cmd)
+
         Args:
             task (:class:`TaskView`) The task currently running.
 
         Yields:
-            Should yield either a :class:`JobRequest`, :class:`TaskRequest`
+            Should yield either a :class:`JobRequest`, :class:`TaskRequest`, :class:`WaitRequest`
             or a :class:`ConfiguratorResult` when done
         """
         yield task.done(False)
@@ -291,6 +405,9 @@ class Configurator(object):
 class TaskView(object):
     """The interface presented to configurators."""
 
+    verbose = 0  # set by ConfigTask
+    dryRun = False
+
     def __init__(self, manifest, configSpec, target, reason=None, dependencies=None):
         # public:
         self.configSpec = configSpec
@@ -350,6 +467,32 @@ class TaskView(object):
             self._inputs = ResultsMap(inputs, RefContext(self.target, vars))
         return self._inputs
 
+    def getDigest(self):
+        """
+        Returns a digest of the task's configuration (including its unevaluated inputs)
+        and the property values declared by its target's template.
+        Used to detect if a task needs to run again
+        (see :meth:`unfurl.plan.DeployPlan.includeTask`).
+
+        Inputs aren't evaluated so the digest is cheap, has no side effects
+        and doesn't change when expressions return a new value each time (e.g. temporary files).
+        This means it only detects changes to the specification: changes that reach
+        the task through expressions like ``get_attribute`` on other instances,
+        or through external values, don't change the digest.
+        """
+        m = hashlib.sha1()
+        m.update(
+            json.dumps(
+                [
+                    self.configSpec.getDigest(),
+                    serializeValue(self.target.template.properties),
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        )
+        return m.hexdigest()
+
     @property
     def vars(self):
         """
@@ -507,6 +650,51 @@ class TaskView(object):
     def addMessage(self, message):
         self.messages.append(message)
 
+    def blocking(self):
+        """
+        Returns a context manager for wrapping code that waits on an external process or service.
+
+        >>> with task.blocking():
+        ...     result = self.runProcess(cmd)
+
+        When the job is running tasks in parallel (see the ``--jobs`` option) other tasks can run
+        while the code in the ``with`` block is waiting, so that code shouldn't access the instance model
+        (e.g. evaluate expressions or read or update attributes).
+        """
+        return self.job.blocking(self)
+
+    def wait(self, func, *args, **kw):
+        """
+        Create a request to call the given function with the given arguments
+        that will be executed when yielded by `run()`:
+
+        >>> result = yield task.wait(self.runProcess, cmd)
+
+        Use this to call functions that wait on an external process or service
+        so that other tasks can run while they are waiting (see :meth:`blocking`).
+
+        Returns:
+           :class:`WaitRequest`
+        """
+        return WaitRequest(func, args, kw)
+
+    def waitBatch(self, key, func, item, window=1.0):
+        """
+        Like `wait` but tasks that yield a request with the same ``key`` can be run together,
+        with one call to ``func``:
+
+        >>> result = yield task.waitBatch(key, self.runBatch, item)
+
+        ``func`` is called with a list of the ``item`` of each task in the batch
+        and must return a list of results in the same order.
+        When the job is running tasks in parallel,
+        the first task in a batch waits up to ``window`` seconds for other tasks to join it.
+
+        Returns:
+           :class:`BatchRequest`
+        """
+        return BatchRequest(key, func, item, window)
+
     def findInstance(self, name):
         return self._manifest.getRootResource().findInstanceOrExternal(name)
 
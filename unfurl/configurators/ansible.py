@@ -2,9 +2,15 @@
 # SPDX-License-Identifier: MIT
 from __future__ import absolute_import
 import sys
+import atexit
 import collections
+import copy
 import functools
+import hashlib
 import logging
+import multiprocessing
+import re
+import threading
 from ..util import assertForm, saveToTempfile
 from ..configurator import Status
 from ..result import serializeValue
@@ -72,6 +78,20 @@ def getAnsibleResults(result, extraKeys=(), facts=()):
     return resultDict, outputs
 
 
+# matches Ansible templates that use unfurl's filters or lookup
+_unfurlFiltersRE = re.compile(r"""\|\s*(eval|ref|mapValue)\b|lookup\(\s*['"]unfurl""")
+
+
+def _usesUnfurl(value):
+    if isinstance(value, six.string_types):
+        return bool(_unfurlFiltersRE.search(value))
+    elif isinstance(value, collections.Mapping):
+        return any(_usesUnfurl(v) for v in value.values())
+    elif isinstance(value, (collections.MutableSequence, tuple)):
+        return any(_usesUnfurl(v) for v in value)
+    return False
+
+
 class AnsibleConfigurator(TemplateConfigurator):
     """The current resource is the inventory."""
 
@@ -207,6 +227,23 @@ class AnsibleConfigurator(TemplateConfigurator):
         vars["__unfurl"] = task.inputs.context
         return vars
 
+    def isIsolated(self, task):
+        """
+        Returns True if the ``isolated`` input is set and the playbook can run
+        in a separate worker process (an inline playbook that uses Unfurl's filters
+        or lookup can't, they need the instance model).
+        """
+        if not task.inputs.get("isolated"):
+            return False
+        playbook = self.findPlaybook(task)
+        if not isinstance(playbook, six.string_types) and _usesUnfurl(playbook):
+            logger.warning(
+                "not isolating the playbook for %s, it uses Unfurl's filters",
+                task.target.name,
+            )
+            return False
+        return True
+
     def _makePlayBook(self, playbook, task):
         assertForm(playbook, collections.MutableSequence)
         # XXX use host group instead of localhost depending on operation_host
@@ -254,25 +291,120 @@ class AnsibleConfigurator(TemplateConfigurator):
         )
         return result
 
+    def _getVaultSecrets(self, task):
+        if task.operationHost and task.operationHost.templar:
+            return task.operationHost.templar._loader._vault.secrets
+        return None
+
+    def getBatchItem(self, task):
+        """
+        Returns the play and inventory needed to run this task in the same playbook
+        as other tasks (see `runBatch`) or None if the task can't be batched.
+
+        Only isolated tasks that set the ``batch`` input and have an inline playbook
+        and no ``inventory`` input can be batched and each task runs as a separate play.
+        """
+        if (
+            not task.inputs.get("batch")
+            or not self.isIsolated(task)
+            or task.inputs.get("inventory")
+        ):
+            return None
+        playbook = self.findPlaybook(task)
+        if isinstance(playbook, six.string_types) or (
+            playbook and "hosts" in playbook[0]
+        ):
+            return None
+        play = self._makePlayBook(playbook, task)[0]
+        name = "%s on %s" % (task.name, task.target.key)
+        play["name"] = name
+        play["environment"] = task.getEnvironment(True)
+        playVars = self.getVars(task)
+        playVars.pop("__unfurl", None)
+        play["vars"] = playVars
+        return dict(
+            name=name,
+            play=serializeValue(play),
+            inventory=serializeValue(self._makeInventory(task.operationHost, {}, task)),
+            args=self.getPlaybookArgs(task),
+            vault_secrets=self._getVaultSecrets(task),
+            poolSize=task.job.jobOptions.jobs,
+        )
+
+    @classmethod
+    def getBatchKey(cls, item):
+        """
+        Only tasks with the same playbook arguments, vault secrets and pool size
+        can be batched together.
+        """
+        if item["vault_secrets"]:
+            # don't put the secrets themselves in the key, it is logged
+            m = hashlib.sha1()
+            for vaultId, secret in item["vault_secrets"]:
+                m.update(("%s:" % vaultId).encode("utf-8") + secret.bytes + b"\n")
+            secrets = m.hexdigest()
+        else:
+            secrets = None
+        return (cls.__name__, secrets, item["poolSize"]) + tuple(item["args"])
+
+    def runBatch(self, items):
+        """
+        Runs the plays of a batch of tasks (see `getBatchItem`) in one playbook
+        and returns the results of each task's play.
+        Called without access to the instance model.
+        The items all have the same settings (see `getBatchKey`).
+        """
+        hosts = {}
+        children = {}
+        for item in items:
+            hosts.update(item["inventory"]["all"]["hosts"])
+            children.update(item["inventory"]["all"]["children"])
+        inventory = dict(all=dict(hosts=hosts, vars={}, children=children))
+        playbook = [item["play"] for item in items]
+        first = items[0]
+        logger.debug("running %s plays in one playbook", len(playbook))
+        results = getPlaybookPool(first["poolSize"]).runPlaybooks(
+            [saveToTempfile(playbook, "-playbook.yml").name],
+            saveToTempfile(inventory, "-inventory.yaml").name,
+            None,
+            first["args"],
+            first["vault_secrets"],
+        )
+        return [results.getPlayResults(item["name"]) for item in items]
+
     def run(self, task):
         try:
-            # build host inventory from resource
-            inventory = self.getInventory(task)
-            playbook = self.getPlaybook(task)
-
-            # build vars from inputs
-            extraVars = self.getVars(task)
-            if task.operationHost and task.operationHost.templar:
-                vault_secrets = task.operationHost.templar._loader._vault.secrets
+            batchItem = self.getBatchItem(task)
+            if batchItem:
+                key = self.getBatchKey(batchItem)
+                resultCallback = yield task.waitBatch(key, self.runBatch, batchItem)
             else:
-                vault_secrets = None
-            resultCallback = runPlaybooks(
-                [playbook],
-                inventory,
-                extraVars,
-                self.getPlaybookArgs(task),
-                vault_secrets,
-            )
+                # build host inventory from resource
+                inventory = self.getInventory(task)
+                playbook = self.getPlaybook(task)
+
+                # build vars from inputs
+                extraVars = self.getVars(task)
+                vault_secrets = self._getVaultSecrets(task)
+                if self.isIsolated(task):
+                    # the worker process can't access the instance model
+                    extraVars.pop("__unfurl", None)
+                    resultCallback = yield task.wait(
+                        getPlaybookPool(task.job.jobOptions.jobs).runPlaybooks,
+                        [playbook],
+                        inventory,
+                        serializeValue(extraVars),
+                        self.getPlaybookArgs(task),
+                        vault_secrets,
+                    )
+                else:
+                    resultCallback = runPlaybooks(
+                        [playbook],
+                        inventory,
+                        extraVars,
+                        self.getPlaybookArgs(task),
+                        vault_secrets,
+                    )
 
             if resultCallback.exit_code or len(resultCallback.resultsByStatus.failed):
                 status = Status.error
@@ -356,6 +488,9 @@ class ResultCallback(CallbackModule):
         )
         self._load_name = "result"
         self.changed = 0
+        # OrderedDict<play name:list<result>>
+        self.resultsByPlay = collections.OrderedDict()
+        self._playName = None
 
     def get_option(self, k):
         return False
@@ -375,6 +510,11 @@ class ResultCallback(CallbackModule):
         getattr(self.resultsByStatus, status).setdefault(result.task_name, []).append(
             result
         )
+        self.resultsByPlay.setdefault(self._playName, []).append(result)
+
+    def v2_playbook_on_play_start(self, play):
+        self._playName = play.get_name()
+        super(ResultCallback, self).v2_playbook_on_play_start(play)
 
     def v2_runner_on_ok(self, result):
         self._addResult("ok", result)
@@ -443,3 +583,140 @@ def runPlaybooks(playbooks, _inventory, params=None, args=None, vault_secrets=No
     finally:
         display.verbosity = oldVerbosity
     return resultsCB
+
+
+class TaskResultRecord(object):
+    """
+    A picklable copy of an ``ansible.executor.task_result.TaskResult``
+    with the subset of its interface used by `getAnsibleResults`.
+    """
+
+    def __init__(self, result):
+        cleaned = result.clean_copy()
+        self.task_name = result.task_name
+        self._host = str(result._host)
+        self._result = cleaned._result
+        self._failed = result.is_failed()
+        self._changed = result.is_changed()
+
+    def clean_copy(self):
+        return self
+
+    def is_failed(self):
+        return self._failed
+
+    def is_changed(self):
+        return self._changed
+
+
+class PlaybookResults(object):
+    """
+    The results of a playbook run in a worker process,
+    has the same attributes as the `ResultCallback` returned by `runPlaybooks`.
+    """
+
+    def __init__(self, resultsCB):
+        records = {}
+        for result in resultsCB.results:
+            records[id(result)] = TaskResultRecord(result)
+        self.results = [records[id(r)] for r in resultsCB.results]
+        self.resultsByStatus = _ResultsByStatus(
+            *[
+                collections.OrderedDict(
+                    (name, [records[id(r)] for r in results])
+                    for name, results in byStatus.items()
+                )
+                for byStatus in resultsCB.resultsByStatus
+            ]
+        )
+        self.resultsByPlay = collections.OrderedDict(
+            (name, [records[id(r)] for r in results])
+            for name, results in resultsCB.resultsByPlay.items()
+        )
+        self.changed = resultsCB.changed
+        self.exit_code = resultsCB.exit_code
+
+    def getPlayResults(self, name):
+        """
+        Returns a copy of these results with only the results of the given play.
+        """
+        playResults = copy.copy(self)
+        results = self.resultsByPlay.get(name, [])
+        ids = set(id(r) for r in results)
+        playResults.results = results
+        playResults.resultsByStatus = _ResultsByStatus(
+            *[
+                collections.OrderedDict(
+                    (taskName, [r for r in taskResults if id(r) in ids])
+                    for taskName, taskResults in byStatus.items()
+                    if any(id(r) in ids for r in taskResults)
+                )
+                for byStatus in self.resultsByStatus
+            ]
+        )
+        playResults.resultsByPlay = collections.OrderedDict([(name, results)])
+        playResults.changed = len([r for r in results if r.is_changed()])
+        if results:
+            # the playbook's exit code reflects every play, not just this one,
+            # so use the exit code ansible-playbook would return if it only ran this play
+            if playResults.resultsByStatus.unreachable:
+                playResults.exit_code = 4
+            elif playResults.resultsByStatus.failed:
+                playResults.exit_code = 2
+            else:
+                playResults.exit_code = 0
+        return playResults
+
+
+def _initWorker():
+    # pool workers are daemonic but Ansible needs to start its own worker processes
+    # and daemonic processes aren't allowed to have children
+    multiprocessing.current_process().daemon = False
+
+
+def _runPlaybooksInWorker(playbooks, _inventory, params, args, vault_secrets):
+    return PlaybookResults(
+        runPlaybooks(playbooks, _inventory, params, args, vault_secrets)
+    )
+
+
+class PlaybookPool(object):
+    """
+    A pool of long-lived worker processes that run playbooks.
+
+    Running each playbook in its own process lets several playbooks run at the same time
+    (`runPlaybooks` modifies Ansible's process-wide state)
+    and workers are reused so Ansible's modules and plugins are only loaded once per worker.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._pool = multiprocessing.Pool(size, _initWorker)
+
+    def runPlaybooks(
+        self, playbooks, _inventory, params=None, args=None, vault_secrets=None
+    ):
+        return self._pool.apply(
+            _runPlaybooksInWorker, (playbooks, _inventory, params, args, vault_secrets)
+        )
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+# size => PlaybookPool
+_playbookPools = {}
+_playbookPoolLock = threading.Lock()
+
+
+def getPlaybookPool(size):
+    """
+    Returns the shared `PlaybookPool` with the given number of workers, creating it if needed.
+    """
+    with _playbookPoolLock:
+        pool = _playbookPools.get(size)
+        if pool is None:
+            pool = _playbookPools[size] = PlaybookPool(size)
+            atexit.register(pool.close)
+        return pool
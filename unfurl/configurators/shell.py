@@ -251,7 +251,8 @@ class ShellConfigurator(TemplateConfigurator):
                 cmd.remove("%dryrun%")
 
         echo = params.get("echo")  # task.verbose > -1)
-        result = self.runProcess(
+        result = yield task.wait(
+            self.runProcess,
             cmd,
             shell=shell,
             timeout=task.configSpec.timeout,
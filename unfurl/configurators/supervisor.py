@@ -61,15 +61,15 @@ class SupervisorConfigurator(Configurator):
         modified = False
         try:
             if op == "start":
-                server.supervisor.startProcess(name)
+                yield task.wait(server.supervisor.startProcess, name)
                 modified = True
             elif op == "stop":
-                server.supervisor.stopProcess(name)
+                yield task.wait(server.supervisor.stopProcess, name)
                 modified = True
             elif op == "delete":
                 if os.path.exists(confPath):
                     os.remove(confPath)
-                modified = _reloadConfig(server, name)
+                modified = yield task.wait(_reloadConfig, server, name)
             elif op == "configure":
                 program = task.vars["SELF"]["program"]
                 programDir = os.path.dirname(confPath)
@@ -86,8 +86,8 @@ class SupervisorConfigurator(Configurator):
                             for (k, v) in task.getEnvironment(True).items()
                         )
                     conff.write(conf)
-                modified = _reloadConfig(server, name)
-                server.supervisor.addProcessGroup(name)
+                modified = yield task.wait(_reloadConfig, server, name)
+                yield task.wait(server.supervisor.addProcessGroup, name)
         except Fault as err:
             if (
                 not (op == "start" and err.faultCode == 60)  # ok, 60 == ALREADY_STARTED
@@ -85,6 +85,7 @@ class TerraformConfigurator(ShellConfigurator):
         return True
 
     def _initTerraform(self, task, terraform, cwd, env):
+        # note: called with task.wait() so this shouldn't access the instance model
         echo = task.verbose > -1
         timeout = task.configSpec.timeout
         cmd = terraform + ["init"]
@@ -184,7 +185,9 @@ class TerraformConfigurator(ShellConfigurator):
             with open(providerSchemaPath) as psf:
                 providerSchema = json.load(psf)
         else:  # first time
-            providerSchema = self._initTerraform(task, terraform, cwd, env)
+            providerSchema = yield task.wait(
+                self._initTerraform, task, terraform, cwd, env
+            )
             if providerSchema:
                 saveToFile(providerSchemaPath, providerSchema)
             else:
@@ -218,17 +221,20 @@ class TerraformConfigurator(ShellConfigurator):
         if varfilePath:
             cmd.append("-var-file=" + varfilePath)
 
-        result = self.runProcess(
-            cmd, timeout=task.configSpec.timeout, env=env, cwd=cwd, echo=echo
+        timeout = task.configSpec.timeout
+        result = yield task.wait(
+            self.runProcess, cmd, timeout=timeout, env=env, cwd=cwd, echo=echo
         )
         if result.returncode and re.search(r"terraform\s+init", result.stderr):
             # modules or plugins out of date, re-run terraform init
-            providerSchema = self._initTerraform(task, terraform, cwd, env)
+            providerSchema = yield task.wait(
+                self._initTerraform, task, terraform, cwd, env
+            )
             if providerSchema:
                 saveToFile(providerSchemaPath, providerSchema)
                 # try again
-                result = self.runProcess(
-                    cmd, timeout=task.configSpec.timeout, env=env, cwd=cwd, echo=echo
+                result = yield task.wait(
+                    self.runProcess, cmd, timeout=timeout, env=env, cwd=cwd, echo=echo
                 )
             else:
                 raise UnfurlTaskError(task, "terrform init failed")
@@ -4,25 +4,45 @@
 Public Api:
 
 mapValue - returns a copy of the given value resolving any embedded queries or template strings
+mapValueMany - mapValue for each of a list of instances
 
 Ref.resolve given an expression, returns a ResultList
 Ref.resolveOne given an expression, return value, none or a (regular) list
+Ref.resolveMany given an expression and a list of instances, return the results for each
 Ref.isRef return true if the given diction looks like a Ref
 
 Internal:
 
 evalRef() given expression (string or dictionary) return list of Result
 Expr.resolve() given expression string, return list of Result
+exprCache the parsed expressions shared by Expr objects (see ExprCache.stats())
+ResourceRef.queryCache the memoized results of queries on a topology (see ReadSet)
+ExprProfile collects statistics about the expressions and templates evaluated
 Results._mapValue same as mapValue but with lazily evaluation
 """
 import six
 import re
 import operator
 import collections
-from collections import Mapping, MutableSequence
+import threading
+from collections import Mapping, MutableMapping, MutableSequence
 from ruamel.yaml.comments import CommentedMap
 from .util import validateSchema, UnfurlError, assertForm
-from .result import ResultsList, Result, Results, ExternalValue, ResourceRef
+from .result import (
+    ResultsList,
+    Result,
+    Results,
+    ExternalValue,
+    ResourceRef,
+    ReadSet,
+    currentReadSet,
+    markUncacheable,
+)
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import clock as perf_counter
 
 
 def mapValue(value, resourceOrCxt, applyTemplates=True):
@@ -31,6 +51,14 @@ def mapValue(value, resourceOrCxt, applyTemplates=True):
     return _mapValue(value, resourceOrCxt, False, applyTemplates)
 
 
+def mapValueMany(value, instances, applyTemplates=True):
+    "Returns a list with the result of `mapValue` for each of the given instances."
+    if Ref.isRef(value):
+        # only parse the expression once
+        return Ref(value).resolveMany(instances, wantList=False)
+    return [mapValue(value, instance, applyTemplates) for instance in instances]
+
+
 def _mapValue(value, ctx, wantList=False, applyTemplates=True):
     from .support import isTemplate, applyTemplate
 
@@ -91,7 +119,97 @@ class _Tracker(object):
 _defaultStrictness = True
 
 
+class _Vars(MutableMapping):
+    """
+    The vars of a `RefContext`.
+    Adding vars when copying a context adds a layer on top of the vars it was copied from
+    instead of copying or updating them and setting a var only changes the top layer
+    (copying it first if it was shared).
+    """
+
+    __slots__ = ("_local", "_parent", "_shared")
+
+    def __init__(self, local=None, parent=None, shared=False):
+        self._local = {} if local is None else local
+        self._parent = parent
+        self._shared = shared
+
+    def push(self, vars):
+        "Returns new vars with the given dictionary on top of these."
+        return _Vars(vars, self, True)
+
+    def findLayer(self, key):
+        "Returns the layer that sets the given var or None."
+        layer = self
+        while layer is not None:
+            if key in layer._local:
+                return layer
+            layer = layer._parent
+        return None
+
+    def __getitem__(self, key):
+        layer = self.findLayer(key)
+        if layer is None:
+            raise KeyError(key)
+        return layer._local[key]
+
+    def get(self, key, default=None):
+        layer = self.findLayer(key)
+        return default if layer is None else layer._local[key]
+
+    def __contains__(self, key):
+        return self.findLayer(key) is not None
+
+    def _ownLocal(self):
+        if self._shared:
+            self._local = dict(self._local)
+            self._shared = False
+        return self._local
+
+    def __setitem__(self, key, value):
+        self._ownLocal()[key] = value
+
+    def __delitem__(self, key):
+        # only vars in the top layer can be deleted
+        del self._ownLocal()[key]
+
+    def __iter__(self):
+        seen = set()
+        layer = self
+        while layer is not None:
+            for key in layer._local:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+            layer = layer._parent
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "_Vars(%r)" % self.copy()
+
+
 class RefContext(object):
+    __slots__ = (
+        "vars",
+        "currentResource",
+        "_lastResource",
+        "_rest",
+        "wantList",
+        "resolveExternal",
+        "_trace",
+        "strict",
+        "baseDir",
+        "templar",
+        "referenced",
+        "kw",
+        "currentFunc",
+    )
+
     def __init__(
         self,
         currentResource,
@@ -101,7 +219,8 @@ class RefContext(object):
         trace=0,
         strict=_defaultStrictness,
     ):
-        self.vars = vars or {}
+        # note: the vars dictionary isn't copied so changes to it are visible to the caller
+        self.vars = vars if isinstance(vars, _Vars) else _Vars(vars)
         # the original context:
         self.currentResource = currentResource
         # the last resource encountered while evaluating:
@@ -115,27 +234,31 @@ class RefContext(object):
         self.baseDir = currentResource.baseDir
         self.templar = currentResource.templar
         self.referenced = _Tracker()
+        # set when evaluating a function:
+        self.kw = None
+        self.currentFunc = None
 
     def copy(self, resource=None, vars=None, wantList=None, trace=0, strict=None):
-        copy = RefContext(
-            resource or self.currentResource,
-            self.vars,
-            self.wantList,
-            self.resolveExternal,
-            max(self._trace, trace),
-            self.strict if strict is None else strict,
-        )
+        # copies share their vars unless new vars are given (see `_Vars`)
+        copy = RefContext.__new__(RefContext)
+        copy.vars = self.vars if vars is None else self.vars.push(vars)
+        copy.currentResource = resource or self.currentResource
         if not isinstance(copy.currentResource, ResourceRef) and isinstance(
             self._lastResource, ResourceRef
         ):
             copy._lastResource = self._lastResource
-        if vars:
-            copy.vars.update(vars)
-        if wantList is not None:
-            copy.wantList = wantList
+        else:
+            copy._lastResource = copy.currentResource
+        copy._rest = None
+        copy.wantList = self.wantList if wantList is None else wantList
+        copy.resolveExternal = self.resolveExternal
+        copy._trace = max(self._trace, trace)
+        copy.strict = self.strict if strict is None else strict
         copy.baseDir = self.baseDir
         copy.templar = self.templar
         copy.referenced = self.referenced
+        copy.kw = None
+        copy.currentFunc = None
         return copy
 
     def trace(self, *msg):
@@ -149,7 +272,13 @@ class RefContext(object):
         return self._resolveVar(key[1:]).resolved
 
     def _resolveVar(self, key):
-        value = self.vars[key]
+        layer = self.vars.findLayer(key)
+        value = _Missing if layer is None else layer._local[key]
+        readSet = currentReadSet()
+        if readSet:
+            readSet.readVar(key, _varKey(value), value, layer)
+        if layer is None:
+            raise KeyError(key)
         if isinstance(value, Result):
             return value
         else:
@@ -171,26 +300,390 @@ class RefContext(object):
 
     def __getstate__(self):
         # Remove the unpicklable entries.
-        state = self.__dict__.copy()
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
         state["templar"] = None
         del state["referenced"]
         return state
 
     def __setstate__(self, d):
-        self.__dict__ = d
+        for name, value in d.items():
+            setattr(self, name, value)
         self.referenced = _Tracker()
 
 
+_Missing = object()
+
+
+def _varKey(value):
+    """
+    Returns a key that is equal to the key of another var value if that value is the same
+    or None if a memoized query can't depend on the value (see `ReadSet`).
+    """
+    if isinstance(value, Result):
+        if value.external:
+            return None
+        value = value.resolved
+    if value is _Missing:
+        return ("missing",)
+    if value is None or isinstance(
+        value, six.string_types + six.integer_types + (bool, float)
+    ):
+        return (type(value), value)
+    if isinstance(value, ResourceRef):
+        return ("instance", id(value))
+    if isinstance(value, Results):
+        # a var that is set to an instance's attributes (e.g. SELF)
+        resource = value.context.currentResource
+        if getattr(resource, "attributes", None) is value:
+            return ("attributes", id(resource))
+    return None
+
+
+class ExprCache(object):
+    """
+    A bounded LRU cache of parsed expressions and the functions compiled from them
+    (see `compilePath`).
+    Entries are keyed by the expression's source and whether it is evaluated
+    inside a ``foreach`` (which changes how relative paths are parsed).
+
+    The cached segment lists are shared so they must not be modified.
+    (``unfurl.support.templateCache`` also uses this class to cache compiled templates.)
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            # move to the end so it is the most recently used
+            self._cache[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = value
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self._cache),
+            maxsize=self.maxsize,
+        )
+
+
+exprCache = ExprCache()
+
+
+class _MemoizedQuery(object):
+    __slots__ = ("resource", "results", "reads", "referenced")
+
+    def __init__(self, resource, results, reads, referenced):
+        self.resource = resource
+        self.results = results
+        self.reads = reads
+        # the references the query added to the context's _Tracker or None if it wasn't tracking
+        self.referenced = referenced
+
+    def isCurrent(self, ctx):
+        if self.resource is not ctx.currentResource:
+            return False
+        if self.referenced is None and ctx.referenced.count:
+            return False
+        if not self.reads.isCurrent():
+            return False
+        for name, (key, value) in self.reads.vars.items():
+            if _varKey(ctx.vars.get(name, _Missing)) != key:
+                return False
+        return True
+
+
+def _isMemoizable(result):
+    # don't share mutable values or values that might change without us knowing
+    return not result.external and not isinstance(
+        result.resolved, (Results, Mapping, MutableSequence)
+    )
+
+
+def _copyResult(result):
+    copy = Result(result.resolved)
+    copy.original = result.original
+    copy.external = result.external
+    copy.select = result.select
+    return copy
+
+
+def _resolveMemoized(expr, ctx):
+    """
+    Returns the results of evaluating the expression, reusing the results of an earlier
+    evaluation in the same context if nothing it read has changed since.
+    """
+    # each topology has its own cache so memoized results don't outlive it
+    queryCache = ctx.currentResource.queryCache
+    if queryCache is None:
+        return expr.resolve(ctx)
+    key = (
+        expr.source,
+        id(ctx.currentResource),
+        ctx.strict,
+        ctx.resolveExternal,
+        ctx.baseDir,
+        # evalRef() resets wantList for top-level expressions but don't rely on it
+        ctx.wantList,
+    )
+    tracker = ctx.referenced
+    memo = queryCache.get(key)
+    if memo is not None and memo.isCurrent(ctx):
+        readSet = currentReadSet()
+        if readSet:
+            readSet.merge(memo.reads, ctx.vars)
+        if tracker.count:
+            tracker.referenced.extend(memo.referenced)
+        if _profile is not None:
+            _profile.memoized()
+        return [_copyResult(r) for r in memo.results]
+
+    start = len(tracker.referenced)
+    reads = ReadSet(ctx.vars).start()
+    try:
+        results = expr.resolve(ctx)
+    finally:
+        reads.stop()
+    if reads.cacheable and all(_isMemoizable(r) for r in results):
+        referenced = tracker.referenced[start:] if tracker.count else None
+        memo = _MemoizedQuery(
+            ctx.currentResource,
+            [_copyResult(r) for r in results],
+            reads,
+            referenced,
+        )
+        queryCache.put(key, memo)
+    return results
+
+
+class _ProfileStats(object):
+    __slots__ = (
+        "calls",
+        "time",
+        "ownTime",
+        "visited",
+        "matched",
+        "memoized",
+        "segments",
+    )
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0  # including the time spent in nested expressions and templates
+        self.ownTime = 0.0
+        self.visited = 0  # candidate items its segments were evaluated against
+        self.matched = 0  # results returned
+        self.memoized = 0  # calls that reused a memoized result (see `ResourceRef.queryCache`)
+        self.segments = collections.OrderedDict()  # segment => [time, visited, matched]
+
+    def asDict(self, source):
+        stats = dict(
+            calls=self.calls,
+            time=round(self.time, 6),
+            ownTime=round(self.ownTime, 6),
+        )
+        if self.segments or self.matched:
+            stats.update(
+                visited=self.visited, matched=self.matched, memoized=self.memoized
+            )
+            stats["segments"] = [
+                dict(segment=label, time=round(t, 6), visited=visited, matched=matched)
+                for label, (t, visited, matched) in self.segments.items()
+            ]
+        return dict(source=source, **stats)
+
+
+class ExprProfile(object):
+    """
+    Collects statistics about the expressions and templates evaluated while it is active
+    (see `start` and `stop`): for each expression, the number of times it was evaluated,
+    the time spent evaluating it, the number of candidate items its segments visited
+    and how many results it matched, along with the time spent in each of its segments;
+    and for each template, the number of times it was rendered and the time spent rendering it.
+
+    Evaluating the expressions isn't thread-safe so one profile is shared by all threads.
+    """
+
+    def __init__(self):
+        self.expressions = {}
+        self.templates = {}
+        self._local = threading.local()
+        self._previous = None
+
+    def start(self):
+        global _profile
+        self._previous = _profile
+        _profile = self
+        return self
+
+    def stop(self):
+        global _profile
+        _profile = self._previous
+        self._previous = None
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def enter(self, table, source):
+        stats = table.get(source)
+        if stats is None:
+            stats = table[source] = _ProfileStats()
+        stats.calls += 1
+        # [stats, start time, time spent in nested expressions and templates]
+        frame = [stats, perf_counter(), 0.0]
+        self._stack().append(frame)
+        return frame
+
+    def exit(self, frame, matched=0):
+        elapsed = perf_counter() - frame[1]
+        stack = self._stack()
+        stack.pop()
+        stats = frame[0]
+        stats.time += elapsed
+        stats.ownTime += elapsed - frame[2]
+        stats.matched += matched
+        if stack:
+            stack[-1][2] += elapsed
+
+    def resolve(self, expr, ctx, top):
+        frame = self.enter(self.expressions, expr.source)
+        results = []
+        try:
+            results = _resolveExpr(expr, ctx, top)
+        finally:
+            self.exit(frame, len(results))
+        return results
+
+    def memoized(self):
+        stack = self._stack()
+        if stack:
+            stack[-1][0].memoized += 1
+
+    def evalSegment(self, evalSegment, label, result, context):
+        stack = self._stack()
+        if not stack:
+            return evalSegment(result, context)
+        stats = stack[-1][0]
+        start = perf_counter()
+        found = list(evalSegment(result, context))
+        segment = stats.segments.get(label)
+        if segment is None:
+            segment = stats.segments[label] = [0.0, 0, 0]
+        segment[0] += perf_counter() - start
+        segment[1] += 1
+        segment[2] += len(found)
+        stats.visited += 1
+        return found
+
+    def getStats(self, top=None):
+        """
+        Returns a dictionary with the statistics of the expressions and of the templates,
+        each sorted by the time spent in them (excluding nested expressions and templates)
+        and limited to the ``top`` slowest if set.
+        """
+        key = lambda item: item[1].ownTime
+        return dict(
+            expressions=[
+                stats.asDict(source)
+                for source, stats in sorted(
+                    self.expressions.items(), key=key, reverse=True
+                )[:top]
+            ],
+            templates=[
+                stats.asDict(source)
+                for source, stats in sorted(
+                    self.templates.items(), key=key, reverse=True
+                )[:top]
+            ],
+        )
+
+    def summary(self, top=10):
+        stats = self.getStats(top)
+        lines = [
+            "Expression profile (%s expressions, %s templates):"
+            % (len(self.expressions), len(self.templates)),
+            "  calls  own(s)  total(s)  visited  matched  expression",
+        ]
+        for item in stats["expressions"]:
+            lines.append(
+                "  %5d %7.3f %9.3f %8d %8d  %s"
+                % (
+                    item["calls"],
+                    item["ownTime"],
+                    item["time"],
+                    item.get("visited", 0),
+                    item.get("matched", 0),
+                    item["source"],
+                )
+            )
+        for item in stats["templates"]:
+            lines.append(
+                "  %5d %7.3f %9.3f %8s %8s  %s"
+                % (
+                    item["calls"],
+                    item["ownTime"],
+                    item["time"],
+                    "",
+                    "",
+                    # templates can span many lines
+                    " ".join(item["source"].split())[:80],
+                )
+            )
+        return "\n".join(lines)
+
+
+# the active ExprProfile, if any
+_profile = None
+
+
+def getExprProfile():
+    return _profile
+
+
 class Expr(object):
     def __init__(self, exp, vars=None):
-        self.vars = {"true": True, "false": False, "null": None}
-
-        if vars:
-            self.vars.update(vars)
+        # only used to check if it's evaluated inside a foreach
+        self.vars = {} if vars is None else vars
 
         self.source = exp
+        key = (exp, "break" in self.vars)
+        parsed = exprCache.get(key)
+        if parsed is None:
+            parsed = _ParsedExpr(self._parse(exp, key[1]))
+            exprCache.put(key, parsed)
+        self._parsed = parsed
+        self.paths = parsed.paths
+
+    @staticmethod
+    def _parse(exp, inForeach):
         paths = list(parseExp(exp))
-        if "break" not in self.vars:
+        if not inForeach:
             # hack to check that we aren't a foreach expression
             if (not paths[0].key or paths[0].key[0] not in ".$") and (
                 paths[0].key or paths[0].filters
@@ -204,7 +697,7 @@ class Expr(object):
                     Segment(".ancestors", [], "", []),
                     paths[0]._replace(modifier="?"),
                 ]
-        self.paths = paths
+        return paths
 
     def __repr__(self):
         # XXX vars
@@ -215,17 +708,45 @@ class Expr(object):
         currentResource = context.currentResource
         if not self.paths[0].key and not self.paths[0].filters:  # starts with "::"
             currentResource = currentResource.all
-            paths = self.paths[1:]
         elif self.paths[0].key and self.paths[0].key[0] == "$":
             # if starts with a var, use that as the start
             currentResource = context.resolveVar(self.paths[0].key)
             if len(self.paths) == 1:
                 # bare reference to a var, just return it's value
                 return [Result(currentResource)]
-            paths = [self.paths[0]._replace(key="")] + self.paths[1:]
-        else:
+        if context._trace:
+            # the interpreter traces each step
+            return evalExp([currentResource], self._parsed.getEvalPaths(), context)
+        return list(self._parsed.evaluate(iter([Result(currentResource)]), context))
+
+
+class _ParsedExpr(object):
+    """
+    The parsed segments of an expression and the function compiled from them,
+    shared by the Expr objects for the same expression (see `exprCache`).
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+        self._evalPaths = None
+        self._compiled = None
+
+    def getEvalPaths(self):
+        # the segments evaluated by Expr.resolve() after it chooses the start
+        if self._evalPaths is None:
             paths = self.paths
-        return evalExp([currentResource], paths, context)
+            if not paths[0].key and not paths[0].filters:  # starts with "::"
+                self._evalPaths = paths[1:]
+            elif paths[0].key and paths[0].key[0] == "$":
+                self._evalPaths = [paths[0]._replace(key="")] + paths[1:]
+            else:
+                self._evalPaths = paths
+        return self._evalPaths
+
+    def evaluate(self, results, context):
+        if self._compiled is None:
+            self._compiled = compilePath(self.getEvalPaths())
+        return self._compiled(results, context)
 
 
 class Ref(object):
@@ -270,6 +791,10 @@ class Ref(object):
         results = ResultsList(results, ctx)
         ctx.addReference(self, results)
         ctx.trace("Ref.resolve(wantList=%s) results" % wantList, self.source, results)
+        return self._select(results, wantList)
+
+    @staticmethod
+    def _select(results, wantList):
         if wantList and not wantList == "result":
             return results
         else:
@@ -286,6 +811,51 @@ class Ref(object):
                 else:
                     return list(results)
 
+    def resolveMany(
+        self, instances, vars=None, wantList=True, strict=_defaultStrictness
+    ):
+        """
+        Evaluate the expression with each of the given instances as the current resource
+        and return a list with the result for each (see `resolve` for ``wantList``).
+
+        An expression that starts at the root (e.g. "::foo") doesn't depend on
+        the instance so it is only evaluated once for each topology.
+        """
+        startsAtRoot = self._startsAtRoot()
+        shared = {}
+        many = []
+        for instance in instances:
+            # contexts convert the values of vars when they're used so don't share them
+            ctx = RefContext(instance, dict(vars) if vars else None)
+            results = None
+            if startsAtRoot:
+                key = (id(instance.root), ctx.baseDir)
+                results = shared.get(key)
+            if results is None:
+                results = self.resolve(ctx, True, strict)
+                if startsAtRoot:
+                    shared[key] = results
+            else:
+                results = ResultsList(
+                    [_copyResult(r) for r in results._attributes], ctx
+                )
+            many.append(self._select(results, wantList))
+        return many
+
+    def _startsAtRoot(self):
+        from .support import isTemplate
+
+        source = self.source
+        if (
+            self.foreach
+            or not isinstance(source, six.string_types)
+            or isTemplate(source, None)
+            or "$start" in source
+        ):
+            return False
+        first = Expr(source, self.vars).paths[0]
+        return not first.key and not first.filters
+
     def resolveOne(self, ctx, strict=_defaultStrictness):
         """
         If no match return None
@@ -387,7 +957,8 @@ def _forEach(foreach, results, ctx):
             # it's a dict that needs to be evaluated
             valExp = foreach
 
-    ictx = ctx.copy(wantList=False)
+    # the loop's vars are set on a new layer so they aren't visible outside of it
+    ictx = ctx.copy(vars={}, wantList=False)
     # ictx._trace = 1
     Break = object()
     Continue = object()
@@ -432,6 +1003,8 @@ def _forEach(foreach, results, ctx):
 
 def forEach(foreach, results, ctx):
     # results will be list of Result
+    # (the loop's vars are added to the context's so don't memoize it)
+    markUncacheable()
     return _forEach(foreach, enumerate(r.external or r.resolved for r in results), ctx)
 
 
@@ -459,16 +1032,23 @@ _Funcs = {
     "foreach": forEachFunc,
 }
 _FuncsTop = ["q"]
+# functions whose result only depends on their arguments and what they read using queries,
+# so they don't prevent the query that uses them from being memoized
+_PureFuncs = set(["if", "and", "or", "not", "q", "eq", "validate"])
 
 
 def getEvalFunc(name):
     return _Funcs.get(name)
 
 
-def setEvalFunc(name, val, topLevel=False):
+def setEvalFunc(name, val, topLevel=False, pure=False):
     _Funcs[name] = val
     if topLevel:
         _FuncsTop.append(name)
+    if pure:
+        _PureFuncs.add(name)
+    else:
+        _PureFuncs.discard(name)
 
 
 def evalRef(val, ctx, top=False):
@@ -477,9 +1057,9 @@ def evalRef(val, ctx, top=False):
 
     # functions and ResultsMap assume resolveOne semantics
     if top:
-        vars = ctx.vars.copy()
-        vars["start"] = ctx.currentResource
-        ctx = ctx.copy(ctx.currentResource, vars, wantList=False)
+        ctx = ctx.copy(
+            ctx.currentResource, dict(start=ctx.currentResource), wantList=False
+        )
 
     if isinstance(val, Mapping):
         for key in val:
@@ -499,6 +1079,8 @@ def evalRef(val, ctx, top=False):
                         "unexpected '%s' found, did you intend it for the parent?"
                         % unexpected
                     )
+                if key not in _PureFuncs:
+                    markUncacheable()
                 val = func(args, ctx)
                 if key == "q":
                     if isinstance(val, Result):
@@ -511,7 +1093,11 @@ def evalRef(val, ctx, top=False):
             return [Result(applyTemplate(val, ctx))]
         else:
             expr = Expr(val, ctx.vars)
-            results = expr.resolve(ctx)  # returns a list of Result
+            profile = _profile
+            if profile is not None:
+                results = profile.resolve(expr, ctx, top)
+            else:
+                results = _resolveExpr(expr, ctx, top)
             ctx.trace("expr.resolve", results)
             return results
 
@@ -522,6 +1108,13 @@ def evalRef(val, ctx, top=False):
         return [Result(mappedVal)]
 
 
+def _resolveExpr(expr, ctx, top):
+    if top and not ctx._trace and isinstance(ctx.currentResource, ResourceRef):
+        return _resolveMemoized(expr, ctx)
+    else:
+        return expr.resolve(ctx)  # returns a list of Result
+
+
 def evalForFunc(val, ctx):
     "like `evalRef` except it returns the resolved value"
     results = evalRef(val, ctx)
@@ -687,6 +1280,182 @@ def evalExp(start, paths, context):
     return list(recursiveEval((Result(i) for i in start), paths, context))
 
 
+def _evalTestFast(value, test, context):
+    # same as evalTest() without tracing
+    comparor, key = test
+    try:
+        if isinstance(key, six.string_types) and key.startswith("$"):
+            compare = context.resolveVar(key)
+        else:
+            # try to coerce string to value type
+            compare = type(value)(key)
+        return bool(comparor(value, compare))
+    except:
+        return comparor is operator.ne
+
+
+def _lookupFast(result, key, context, last):
+    # same as lookup() without tracing, "last" replaces checking context._rest
+    try:
+        if isinstance(key, six.string_types) and key.startswith("$"):
+            key = context.resolveVar(key)
+
+        if isinstance(result.resolved, ResourceRef):
+            context._lastResource = result.resolved
+
+        ctx = context.copy(context._lastResource)
+        result = result.project(key, ctx)
+        if last:
+            result.resolved = Results._mapValue(result.resolved, ctx)
+        return result
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def _compileSegment(seg, last):
+    """
+    Returns a function equivalent to `evalItem` for the given segment.
+    """
+    key = seg.key
+    test = seg.test
+    filters = [
+        (compilePath(filter), filter[0], filter[0].modifier == "!")
+        for filter in seg.filters
+    ]
+
+    def evalSegment(result, context):
+        if key != "":
+            result = _lookupFast(result, key, context, last)
+            if not result:
+                return
+
+        value = result.resolved
+        for evalFilter, first, negate in filters:
+            if _treatAsSingular(result, first):
+                resultList = [value]
+            else:
+                resultList = value
+            # evaluate every match like evalExp() does
+            found = list(evalFilter((Result(i) for i in resultList), context))
+            if negate and found:
+                return
+            elif not negate and not found:
+                return
+
+        if test and not _evalTestFast(value, test, context):
+            return
+        yield result
+
+    return evalSegment
+
+
+def _getTypeFilter(seg):
+    """
+    Returns the type name if the segment has a filter like ``[.type=name]``
+    or ``[.template::type=name]``, otherwise None.
+    """
+    if seg.key != "":
+        return None
+    for filter in seg.filters:
+        if any(s.modifier or s.filters for s in filter):
+            continue
+        if len(filter) == 1 and filter[0].key == ".type":
+            test = filter[0].test
+        elif (
+            len(filter) == 2
+            and filter[0].key == ".template"
+            and not filter[0].test
+            and filter[1].key == "type"
+        ):
+            test = filter[1].test
+        else:
+            continue
+        if (
+            test
+            and test[0] is operator.eq
+            and isinstance(test[1], six.string_types)
+            and not test[1].startswith("$")
+        ):
+            return test[1]
+    return None
+
+
+def compilePath(exp):
+    """
+    Compiles a list of segments into a function equivalent to `recursiveEval`
+    that takes an iterator of Result and a RefContext and yields Result.
+    The segments' keys, modifiers and filters are examined once
+    instead of every time the expression is evaluated.
+    """
+    seg = exp[0]
+    matchFirst = seg.modifier == "?"
+    useValue = seg.key == "*"
+    intKey = isinstance(seg.key, six.integer_types)
+    rest = exp[1:]
+    # e.g. "::*::[.type=name]" can use the topology's type index
+    typeName = _getTypeFilter(rest[0]) if useValue and rest else None
+    evalRest = compilePath(rest) if rest else None
+    evalSegment = _compileSegment(seg, not rest)
+    label = formatSegment(seg)  # identifies the segment in an ExprProfile
+
+    def evalPath(v, context):
+        for result in v:
+            if not useValue and (
+                result.external
+                or not isinstance(result.resolved, MutableSequence)
+                or intKey
+            ):
+                if _profile is not None:
+                    iv = _profile.evalSegment(evalSegment, label, result, context)
+                else:
+                    iv = evalSegment(result, context)
+                evalNext = evalRest
+            else:
+                if useValue:
+                    if not isinstance(result.resolved, Mapping):
+                        continue
+                    evalNext = evalRest  # advance past "*" segment
+                else:
+                    evalNext = evalPath  # flattens
+                if typeName and hasattr(result.resolved, "findInstancesOfType"):
+                    # only visit the instances that could match the type filter
+                    iv = (
+                        Result(i)
+                        for i in result.resolved.findInstancesOfType(typeName)
+                    )
+                else:
+                    iv = result._values()
+
+            if evalNext:
+                found = False
+                for r in evalNext(iv, context):
+                    found = True
+                    yield r
+                if found and matchFirst:
+                    return
+            else:
+                for r in iv:
+                    yield r
+                    if matchFirst:
+                        return
+
+    return evalPath
+
+
+def formatSegment(seg):
+    "Returns the source of the given segment."
+    filters = "".join(
+        "[%s]" % "::".join(formatSegment(s) for s in filter) for filter in seg.filters
+    )
+    if seg.test:
+        test = "%s%s" % ("=" if seg.test[0] is operator.eq else "!=", seg.test[1])
+    else:
+        test = ""
+    if seg.modifier == "!":
+        return "!%s%s%s" % (seg.key, filters, test)
+    return "%s%s%s%s" % (seg.key, filters, test, seg.modifier)
+
+
 def _makeKey(key):
     try:
         return int(key)
@@ -7,16 +7,30 @@ Each task tracks and records its modifications to the system's state
 """
 
 import collections
+import contextlib
+import heapq
+import sys
+import threading
+import time
 import types
 import itertools
 import os
 import json
-from .support import Status, Priority, Defaults, AttributeManager
+import six
+from .support import Status, Priority, Defaults, AttributeManager, NodeState
 from .result import serializeValue, ChangeRecord
-from .util import UnfurlError, UnfurlTaskError, toEnum
-from .merge import mergeDicts
+from .eval import ExprProfile
+from .util import UnfurlError, UnfurlTaskError, toEnum, TokenBucket
+from .merge import mergeDicts, applyDiff
 from .runtime import OperationalInstance
-from .configurator import TaskView, ConfiguratorResult, TaskRequest, JobRequest
+from .configurator import (
+    TaskView,
+    ConfiguratorResult,
+    TaskRequest,
+    JobRequest,
+    WaitRequest,
+    BatchRequest,
+)
 from .plan import Plan
 from .localenv import LocalEnv
 from . import display, initLogging, configurators
@@ -25,6 +39,11 @@ try:
     from time import perf_counter
 except ImportError:
     from time import clock as perf_counter
+try:
+    from time import thread_time
+except ImportError:
+    # on unix, clock() is the process's cpu time
+    from time import clock as thread_time
 import logging
 
 logger = logging.getLogger("unfurl")
@@ -87,6 +106,9 @@ class JobOptions(object):
         dirty="auto",  # run the job even if the repository has uncommitted changrs
         message=None,
         workflow=Defaults.workflow,
+        jobs=1,  # maximum number of tasks to run in parallel
+        resume=False,  # skip the tasks completed by the last job if it was interrupted
+        profileExpressions=0,  # profile the expressions evaluated and report the N slowest
     )
 
     def __init__(self, **kw):
@@ -94,6 +116,8 @@ class JobOptions(object):
         options["instance"] = kw.get("resource")  # old option name
         if kw.get("starttime"):
             options["startTime"] = kw["starttime"]
+        if kw.get("profile_expressions"):
+            options["profileExpressions"] = kw["profile_expressions"]
         options.update(kw)
         self.__dict__.update(options)
         self.userConfig = kw
@@ -125,6 +149,9 @@ class ConfigTask(ConfigChange, TaskView):
         self.changeList = []
         self.result = None
         self.outputs = None
+        # phase name => [wall time, cpu time]
+        self.timings = collections.OrderedDict()
+        self.digest = None  # set by Job.recordDigests()
         # self._completedSubTasks = []
 
         # set the attribute manager on the root resource
@@ -165,7 +192,10 @@ class ConfigTask(ConfigChange, TaskView):
         # if isinstance(change, ConfigTask):
         #     self._completedSubTasks.append(change)
         try:
-            result = self.generator.send(change)
+            if isinstance(change, WaitRequest):
+                result = change.resume(self.generator)
+            else:
+                result = self.generator.send(change)
         finally:
             # serialize configuration changes
             self.commitChanges()
@@ -174,6 +204,37 @@ class ConfigTask(ConfigChange, TaskView):
     def start(self):
         self.startRun()
 
+    def _addTiming(self, phase, wall, cpu):
+        timing = self.timings.setdefault(phase, [0.0, 0.0])
+        timing[0] += wall
+        timing[1] += cpu
+
+    @contextlib.contextmanager
+    def timePhase(self, phase):
+        """
+        Adds the wall and cpu time spent in the ``with`` block to the given phase:
+        "check", "run", "wait" or "commit".
+        Inputs are resolved lazily so the time spent evaluating them is part of "run".
+        """
+        wall, cpu = perf_counter(), thread_time()
+        try:
+            yield
+        finally:
+            self._addTiming(phase, perf_counter() - wall, thread_time() - cpu)
+
+    def getTimings(self):
+        return collections.OrderedDict(
+            (phase, dict(wall=round(wall, 6), cpu=round(cpu, 6)))
+            for phase, (wall, cpu) in self.timings.items()
+        )
+
+    def formatTimings(self):
+        "e.g. check:0.0012/0.0011;run:1.5/0.02 (wall time/cpu time in seconds)"
+        return ";".join(
+            "%s:%.4g/%.4g" % (phase, wall, cpu)
+            for phase, (wall, cpu) in self.timings.items()
+        )
+
     def _updateStatus(self, result):
         """
         Update the instances status with the result of the operation.
@@ -215,6 +276,7 @@ class ConfigTask(ConfigChange, TaskView):
 
     def finished(self, result):
         assert result
+        wall, cpu = perf_counter(), thread_time()
         if self.generator:
             self.generator.close()
             self.generator = None
@@ -247,8 +309,50 @@ class ConfigTask(ConfigChange, TaskView):
         self._updateLastChange(result)
         self.result = result
         self.localStatus = Status.ok if result.success else Status.error
+        self._addTiming("commit", perf_counter() - wall, thread_time() - cpu)
+        if result.success:
+            self.job.runner.recordHandledConfig(self)
         return self
 
+    def resume(self, record):
+        """
+        Restore the changes a previous run of this task made before its job was interrupted
+        (see :class:`unfurl.yamlmanifest.JobCheckpoint`).
+        """
+        root = self.target.root
+        for key, changes in (record.get("changes") or {}).items():
+            resource = root.query(key)
+            if not resource:
+                logger.warning("can't restore changes to %s: instance not found", key)
+                continue
+            # XXX restore instances added by the task (".added")
+            attributes = resource.attributes
+            for name, diff in changes.items():
+                if name.startswith("."):
+                    continue
+                # the changes are diffs (see diffDicts) so apply them to the current value
+                old = {}
+                if name in attributes._attributes:
+                    old[name] = serializeValue(attributes._attributes[name])
+                new = applyDiff(old, {name: diff})
+                if name in new:
+                    attributes[name] = new[name]
+                elif name in attributes:
+                    del attributes[name]
+        self.commitChanges()
+        if record.get("targetState"):
+            self.target.state = toEnum(NodeState, record["targetState"])
+        logger.info("resuming task %s: already completed", self)
+        return self.finished(
+            ConfiguratorResult(
+                True,
+                record.get("modified"),
+                toEnum(Status, record.get("resultStatus")),
+                result=record.get("result"),
+                outputs=record.get("outputs"),
+            )
+        )
+
     def modifiedTarget(self):
         return (
             (self.result and self.result.modified)
@@ -371,6 +475,9 @@ class Job(ConfigChange):
         self.unexpectedAbort = None
         self.workDone = collections.OrderedDict()
         self.timeElapsed = 0
+        self.exprProfile = None  # set if the profileExpressions option was set
+        # child jobs run inside their parent's scheduler
+        self.scheduler = self.parentJob.scheduler if self.parentJob else None
 
     def createTask(self, configSpec, target, reason=None):
         # XXX2 if operation_host set, create remote task instead
@@ -381,14 +488,8 @@ class Job(ConfigChange):
         except Exception:
             UnfurlTaskError(task, "unable to create task")
 
-        # if configSpec.hasBatchConfigurator():
-        # search targets parents for a batchConfigurator
-        # XXX how to associate a batchConfigurator with a resource and when is its task created?
-        # batchConfigurator tasks more like a job because they have multiple changeids
-        #  batchConfiguratorJob = findBatchConfigurator(configSpec, target)
-        #  batchConfiguratorJob.add(task)
-        #  return None
-
+        # note: tasks are batched together when their configurator yields a BatchRequest
+        # (see ParallelScheduler.joinBatch)
         return task
 
     def filterConfig(self, config, target):
@@ -403,9 +504,10 @@ class Job(ConfigChange):
             return None, "instances"
         return config, None
 
-    def getCandidateTasks(self):
+    def getCandidateTasks(self, planGen=None):
         # XXX plan might call job.runJobRequest(configuratorJob) before yielding
-        planGen = self.plan.executePlan()
+        if planGen is None:
+            planGen = self.plan.executePlan()
         result = None
         try:
             while True:
@@ -435,6 +537,12 @@ class Job(ConfigChange):
                     continue
 
                 oldResult = self.runner.isConfigAlreadyHandled(configSpec, req.target)
+                if isinstance(oldResult, collections.Mapping):
+                    # completed by the interrupted job we're resuming
+                    task = self.createTask(configSpec, req.target, reason=req.reason)
+                    self.runner.addWork(task)
+                    result = task.resume(oldResult)
+                    continue
                 if oldResult:
                     # configuration may have premptively run while executing another task
                     logger.debug(
@@ -461,18 +569,64 @@ class Job(ConfigChange):
 
     def run(self):
         self.validateJobOptions()
-        taskGen = self.getCandidateTasks()
+        workflows = None
+        visited = set()
+        if self.jobOptions.jobs > 1 and not self.jobOptions.planOnly:
+            workflows = self.plan.getInstanceWorkflows(visited)
+        if workflows is not None:
+            if self._runParallel(workflows, visited):
+                return self.rootResource
+        elif self._runTasks(self.getCandidateTasks()):
+            return self.rootResource
+
+        # the only jobs left will be those that were added to resources already iterated over
+        # and were not yielding inside runTask
+        while self.jobRequestQueue:
+            jobRequest = self.jobRequestQueue[0]
+            job = self.runJobRequest(jobRequest)
+            if self.shouldAbort(job):
+                return self.rootResource
+
+        # XXX
+        # if not self.parentJob:
+        #   # create a job that will re-run configurations whose parameters or runtime dependencies have changed
+        #   # ("config changed" tasks)
+        #   # XXX3 check for orphaned resources and mark them as orphaned
+        #   #  (a resource is orphaned if it was added as a dependency and no longer has dependencies)
+        #   #  (orphaned resources can be deleted by the configuration that created them or manages that type)
+        #   maxloops = 10 # XXX3 better loop detection
+        #   for count in range(maxloops):
+        #     jobOptions = JobOptions(parentJob=self, repair='none')
+        #     plan = Plan(self.rootResource, self.runner.manifest.tosca, jobOptions)
+        #     job = Job(self.runner, self.rootResource, plan, jobOptions)
+        #     job.run()
+        #     # break when there are no more tasks to run
+        #     if not len(job.workDone) or self.shouldAbort(job):
+        #       break
+        #   else:
+        #     raise UnfurlError("too many final dependency runs")
+
+        return self.rootResource
+
+    def _runTasks(self, taskGen):
+        """
+        Runs the tasks yielded by the given generator (see :meth:`getCandidateTasks`).
+        Returns True if the job should be aborted.
+        """
         result = None
         try:
             while True:
                 task = taskGen.send(result)
                 self.runner.addWork(task)
-                if not self.shouldRunTask(task):
+                with task.timePhase("check"):
+                    shouldRun = self.shouldRunTask(task)
+                if not shouldRun:
                     result = None  # treat as filtered step
                     continue
 
                 if self.jobOptions.planOnly:
-                    errors = self.cantRunTask(task)
+                    with task.timePhase("check"):
+                        errors = self.cantRunTask(task)
                     if errors:
                         result = task.finished(
                             ConfiguratorResult(False, False, result=errors)
@@ -490,38 +644,46 @@ class Job(ConfigChange):
                     result = self.runTask(task)
 
                 if self.shouldAbort(task):
-                    return self.rootResource
+                    return True
         except StopIteration:
             pass
+        return False
 
-        # the only jobs left will be those that were added to resources already iterated over
-        # and were not yielding inside runTask
-        while self.jobRequestQueue:
-            jobRequest = self.jobRequestQueue[0]
-            job = self.runJobRequest(jobRequest)
-            if self.shouldAbort(job):
-                return self.rootResource
+    def _runParallel(self, workflows, visited):
+        """
+        Runs the given instance workflows (see :meth:`unfurl.plan.Plan.getInstanceWorkflows`)
+        on a pool of worker threads then prunes the instances that weren't visited.
+        Returns True if the job should be aborted.
+        """
+        if self._hasIsolatedOperations():
+            # start the worker processes for isolated playbooks before the scheduler
+            # starts its threads, forking a process that is running threads isn't safe
+            from .configurators.ansible import getPlaybookPool
 
-        # XXX
-        # if not self.parentJob:
-        #   # create a job that will re-run configurations whose parameters or runtime dependencies have changed
-        #   # ("config changed" tasks)
-        #   # XXX3 check for orphaned resources and mark them as orphaned
-        #   #  (a resource is orphaned if it was added as a dependency and no longer has dependencies)
-        #   #  (orphaned resources can be deleted by the configuration that created them or manages that type)
-        #   maxloops = 10 # XXX3 better loop detection
-        #   for count in range(maxloops):
-        #     jobOptions = JobOptions(parentJob=self, repair='none')
-        #     plan = Plan(self.rootResource, self.runner.manifest.tosca, jobOptions)
-        #     job = Job(self.runner, self.rootResource, plan, jobOptions)
-        #     job.run()
-        #     # break when there are no more tasks to run
-        #     if not len(job.workDone) or self.shouldAbort(job):
-        #       break
-        #   else:
-        #     raise UnfurlError("too many final dependency runs")
+            getPlaybookPool(self.jobOptions.jobs)
+        self.scheduler = ParallelScheduler(self, workflows)
+        try:
+            if self.scheduler.run():
+                return True
+        finally:
+            self.scheduler = None
+        return self._runTasks(self.getCandidateTasks(self.plan.executePrune(visited)))
 
-        return self.rootResource
+    def _hasIsolatedOperations(self):
+        for template in self.plan.tosca.nodeTemplates.values():
+            for iDef in template.getInterfaces():
+                if iDef.inputs and iDef.inputs.get("isolated"):
+                    return True
+        return False
+
+    def blocking(self, task):
+        """
+        Returns a context manager that lets other tasks run while the given task
+        waits on an external process. See :meth:`unfurl.configurator.TaskView.blocking`.
+        """
+        if self.scheduler:
+            return self.scheduler.blocking(task)
+        return _nonBlocking()
 
     def runJobRequest(self, jobRequest):
         logger.debug("running jobrequest: %s", jobRequest)
@@ -632,6 +794,15 @@ class Job(ConfigChange):
             outputs=serializeValue(self.getOutputs()),
             tasks=[task.summary(True) for task in self.workDone.values()],
         )
+        if not self.jobOptions.startTime:  # skip if startTime was explicitly set
+            # wall and cpu time spent in each phase of each task, in the same order as tasks
+            summary["timings"] = [task.getTimings() for task in self.workDone.values()]
+        if self.planOnly:
+            summary["plan"] = self.planSummary(True)
+        if self.exprProfile:
+            summary["expressionProfile"] = self.exprProfile.getStats(
+                self.profileExpressions
+            )
         if pprint:
             return json.dumps(summary, indent=2)
         return summary
@@ -661,6 +832,8 @@ class Job(ConfigChange):
                 "%s: %s" % (name, value)
                 for name, value in serializeValue(outputs).items()
             )
+        if self.exprProfile:
+            outputString += "\n" + self.exprProfile.summary(self.profileExpressions)
 
         if not self.workDone:
             return "Job %s completed: %s. Found nothing to do. %s" % (
@@ -681,8 +854,89 @@ class Job(ConfigChange):
         tasks = "\n    ".join(
             format(i + 1, task) for i, task in enumerate(self.workDone.values())
         )
+        if self.planOnly:
+            tasks += "\n" + self.planSummary()
         return line1 + tasks + outputString
 
+    def getTaskGraph(self):
+        """
+        Returns a :class:`unfurl.plan.TaskGraph` of the tasks in this job
+        and the estimated duration of each task (from the durations recorded in the changelog).
+        """
+        tasks = [task for task in self.workDone.values() if task.result]
+        history = self.runner.manifest.getTaskDurations()
+        durations = [
+            history.get((task.target.key, task.configSpec.operation)) for task in tasks
+        ]
+        known = [d for d in durations if d is not None]
+        # estimate missing durations with the average
+        default = sum(known) / len(known) if known else 1.0
+        durations = [default if d is None else d for d in durations]
+        return self.plan.buildTaskGraph(tasks), durations, bool(known)
+
+    def planSummary(self, asJson=False):
+        """
+        Summarize the structure of the tasks in this job:
+        its depth (the longest chain of dependent tasks), width
+        (the most tasks that could run in parallel) and its critical path.
+        """
+        graph, durations, hasHistory = self.getTaskGraph()
+        total, path = graph.findCriticalPath(durations)
+        summary = dict(
+            depth=graph.depth,
+            width=graph.width,
+            criticalPath=[
+                dict(target=task.target.name, operation=task.configSpec.operation)
+                for task in path
+            ],
+        )
+        if hasHistory:
+            summary["estimatedDuration"] = round(total, 3)
+        if asJson:
+            return summary
+
+        criticalPath = " -> ".join(
+            "%s:%s" % (step["target"], step["operation"])
+            for step in summary["criticalPath"]
+        )
+        if hasHistory:
+            criticalPath += " (estimated %.3fs)" % total
+        return "Plan depth: %s, width: %s, critical path: %s" % (
+            graph.depth,
+            graph.width,
+            criticalPath,
+        )
+
+    def recordDigests(self):
+        """
+        Record a digest of each successful task's configuration
+        (see :meth:`unfurl.configurator.TaskView.getDigest`) with the task and its
+        target so later jobs can skip the task if they haven't changed
+        (see :meth:`unfurl.plan.DeployPlan.includeTask`).
+
+        Only tasks configured the same way the plan would configure the operation are recorded,
+        not subtasks or workflow steps that were given additional inputs,
+        since the planner couldn't compute the same digest to compare.
+        """
+        for task in self.workDone.values():
+            if not task.result or not task.result.success:
+                continue
+            if not task.configSpec.interface:
+                continue
+            key = "%s.%s" % (task.configSpec.interface, task.configSpec.operation)
+            with task.timePhase("commit"):
+                try:
+                    digest = task.getDigest()
+                    if digest != self.plan.getConfigDigest(key, task.target):
+                        continue
+                except Exception:
+                    logger.debug(
+                        "could not compute the digest for task %s", task, exc_info=True
+                    )
+                    continue
+            task.digest = digest
+            task.target._configDigests[key] = digest
+
     def getOperationalDependencies(self):
         # XXX3 this isn't right, root job might have too many and child job might not have enough
         # plus dynamic configurations probably shouldn't be included if yielded by a configurator
@@ -701,20 +955,31 @@ class Job(ConfigChange):
         """
         During each task run:
         * Notification of metadata changes that reflect changes made to resources
+        * Waiting on external processes or services while other tasks run
         * Notification of add or removing dependency on a resource or properties of a resource
         * Notification of creation or deletion of a resource
         * Requests a resource with requested metadata, if it doesn't exist, a task is run to make it so
         (e.g. add a dns entry, install a package).
         """
-        errors = self.cantRunTask(task)
+        with task.timePhase("check"):
+            errors = self.cantRunTask(task)
         if errors:
             return task.finished(ConfiguratorResult(False, False, result=errors))
 
+        bucket = self.runner.limits.getRateLimiter(task)
+        if bucket:
+            delay = bucket.reserve()
+            if delay:
+                logger.debug("rate limiting task %s for %.3f seconds", task, delay)
+                with task.timePhase("wait"), task.blocking():
+                    time.sleep(delay)
+
         task.start()
         change = None
         while True:
             try:
-                result = task.send(change)
+                with task.timePhase("run"):
+                    result = task.send(change)
             except Exception:
                 UnfurlTaskError(task, "configurator.run failed")
                 return task.finished(ConfiguratorResult(False, None, Status.error))
@@ -730,6 +995,12 @@ class Job(ConfigChange):
             elif isinstance(result, JobRequest):
                 job = self.runJobRequest(result)
                 change = job
+            elif isinstance(result, BatchRequest) and self.scheduler:
+                with task.timePhase("wait"):
+                    change = self.scheduler.joinBatch(task, result)
+            elif isinstance(result, WaitRequest):
+                with task.timePhase("wait"), task.blocking():
+                    change = result.run()
             elif isinstance(result, ConfiguratorResult):
                 retVal = task.finished(result)
                 logger.info(
@@ -741,21 +1012,385 @@ class Job(ConfigChange):
                 return task.finished(ConfiguratorResult(False, None, Status.error))
 
 
+@contextlib.contextmanager
+def _nonBlocking():
+    yield
+
+
+class TaskLimits(object):
+    """
+    The concurrency and rate limits set in the ``limits`` section of the ensemble's
+    context, for example:
+
+    .. code-block:: YAML
+
+      limits:
+        operationHosts: # keyed by the name of the task's operation host
+          localhost: 4
+        connections: # keyed by the name of the relationship the task connects with
+          aws: 8
+        configurators: # keyed by the implementation's className
+          Terraform: 2
+        rates: # the tasks for these configurators start at most `rate` times per second
+          unfurl.configurators.k8s.ClusterConfigurator:
+            rate: 5
+            burst: 10
+
+    Concurrency limits cap how many tasks can wait on external processes at the same
+    time (see :meth:`ParallelScheduler.blocking`).
+    """
+
+    def __init__(self, limits=None):
+        limits = limits or {}
+        self.operationHosts = limits.get("operationHosts") or {}
+        self.connections = limits.get("connections") or {}
+        self.configurators = limits.get("configurators") or {}
+        self.buckets = {
+            name: TokenBucket(rate["rate"], rate.get("burst", 1))
+            for name, rate in (limits.get("rates") or {}).items()
+        }
+
+    @staticmethod
+    def _getConfiguratorNames(task):
+        names = [task.configSpec.className]
+        cls = task.configurator.__class__
+        names.append("%s.%s" % (cls.__module__, cls.__name__))
+        return names
+
+    def getConcurrencyLimits(self, task):
+        """
+        Returns a list of ``(key, limit)`` pairs for the limits that apply to the task.
+        """
+        limits = []
+        if task.operationHost and task.operationHost.name in self.operationHosts:
+            name = task.operationHost.name
+            limits.append((("operationHost", name), self.operationHosts[name]))
+        if self.connections:
+            for rel in task._getConnections():
+                limit = self.connections.get(rel.name)
+                if limit:
+                    limits.append((("connection", rel.name), limit))
+        for name in self._getConfiguratorNames(task):
+            if name in self.configurators:
+                limits.append((("configurator", name), self.configurators[name]))
+                break
+        return limits
+
+    def getRateLimiter(self, task):
+        """
+        Returns the :class:`unfurl.util.TokenBucket` for the task's configurator, if any.
+        """
+        if self.buckets:
+            for name in self._getConfiguratorNames(task):
+                if name in self.buckets:
+                    return self.buckets[name]
+        return None
+
+
+class ParallelScheduler(object):
+    """
+    Runs the tasks for each instance visited by a job's plan on a pool of worker threads
+    (the size of the pool is set by the "jobs" job option).
+    An instance's tasks are started only after the tasks of the instances it depends on
+    (see :meth:`unfurl.plan.Plan.findInstanceDependencies`) have finished.
+
+    Only one worker runs at a time: a worker holds ``lock`` while it accesses the instance model
+    and only releases it while a configurator waits on an external process (see :meth:`blocking`),
+    so tasks overlap without having to make the instance model thread-safe.
+
+    Tasks that yield a :class:`unfurl.configurator.BatchRequest` are combined into batches
+    (see :meth:`joinBatch`).
+
+    The number of tasks that wait at the same time can be limited per operation host,
+    connection or configurator (see :class:`TaskLimits`).
+    """
+
+    def __init__(self, job, workflows):
+        self.job = job
+        self.workflows = workflows
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.ready = []  # heap of workflow indexes so ready workflows start in plan order
+        self.waitingOn = {}
+        self.dependents = collections.defaultdict(list)
+        self.running = 0
+        self.idle = 0  # running workers that are waiting instead of accessing the instance model
+        self.workerCount = 0
+        self.batches = {}  # key => list of BatchRequests waiting to run
+        self.inUse = collections.Counter()  # TaskLimits key => count of waiting tasks
+        self.aborted = False
+        self.error = None
+        self._local = threading.local()
+        self._order = {}
+        self._buildGraph()
+
+    def _buildGraph(self):
+        plan = self.job.plan
+        positions = {}  # id(instance) => index
+        byTemplate = collections.defaultdict(list)  # template name => indexes
+        for i, (instance, template, gen) in enumerate(self.workflows):
+            if instance is not None:
+                positions[id(instance)] = i
+            byTemplate[template.name].append(i)
+
+        edges = set()
+        for i, (instance, template, gen) in enumerate(self.workflows):
+            if instance is not None:
+                for dep in plan.findInstanceDependencies(instance):
+                    edges.add((positions.get(id(dep)), i))
+                for dep in instance.getOperationalDependents():
+                    edges.add((i, positions.get(id(dep))))
+            # instances that haven't been created yet can only be ordered by their templates
+            for name in plan.findTemplateDependencies(template):
+                for j in byTemplate.get(name, ()):
+                    if instance is None or self.workflows[j][0] is None:
+                        edges.add((j, i))
+
+        for i in range(len(self.workflows)):
+            self.waitingOn[i] = set()
+        for before, after in edges:
+            if before is not None and after is not None and before != after:
+                self.waitingOn[after].add(before)
+        self._breakCycles()
+        for after, waitingOn in self.waitingOn.items():
+            for before in waitingOn:
+                self.dependents[before].append(after)
+        self.ready = [i for i, deps in self.waitingOn.items() if not deps]
+        heapq.heapify(self.ready)
+
+    def _getName(self, index):
+        instance, template, gen = self.workflows[index]
+        return instance.name if instance is not None else template.name
+
+    def _breakCycles(self):
+        # a dependency cycle would deadlock the workers so drop the dependencies
+        # in the cycle that point against plan order
+        remaining = dict((i, set(deps)) for i, deps in self.waitingOn.items())
+        dependents = collections.defaultdict(list)
+        for after, waitingOn in remaining.items():
+            for before in waitingOn:
+                dependents[before].append(after)
+        ready = [i for i, deps in remaining.items() if not deps]
+        while ready:
+            index = ready.pop()
+            del remaining[index]
+            for dependent in dependents[index]:
+                remaining[dependent].discard(index)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        # what's left is in a cycle or waiting on one,
+        # every cycle has a dependency that points against plan order
+        def reaches(start, end):
+            seen = set()
+            stack = [start]
+            while stack:
+                index = stack.pop()
+                if index == end:
+                    return True
+                if index not in seen:
+                    seen.add(index)
+                    stack.extend(dependents[index])
+            return False
+
+        backwards = [
+            (before, after)
+            for after in sorted(remaining)
+            for before in sorted(self.waitingOn[after])
+            if before > after and before in remaining
+        ]
+        for before, after in backwards:
+            if reaches(after, before):
+                logger.warning(
+                    "dependency cycle: %s will not wait for %s to complete",
+                    self._getName(after),
+                    self._getName(before),
+                )
+                self.waitingOn[after].discard(before)
+
+    def run(self):
+        """
+        Runs the workflows and returns True if the job should be aborted.
+        """
+        count = min(self.job.jobOptions.jobs, len(self.workflows))
+        self.workerCount = count
+        workers = [
+            threading.Thread(target=self._work, name="unfurl-worker-%d" % i)
+            for i in range(count)
+        ]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        if self.error:
+            six.reraise(*self.error)
+        self._reorderWork()
+        return self.aborted
+
+    def _nextReady(self):
+        while not self.aborted:
+            if self.ready:
+                return heapq.heappop(self.ready)
+            if not self.running:
+                return None  # nothing left to do
+            self.changed.wait()
+        return None
+
+    def _work(self):
+        with self.lock:
+            while True:
+                index = self._nextReady()
+                if index is None:
+                    break
+                self.running += 1
+                self._local.index = index
+                try:
+                    if self._runWorkflow(index):
+                        self.aborted = True
+                except Exception:
+                    self.error = sys.exc_info()
+                    self.aborted = True
+                finally:
+                    self._local.index = None
+                    self.running -= 1
+                    self._finished(index)
+
+    def _runWorkflow(self, index):
+        instance, template, planGen = self.workflows[index]
+        logger.debug("running workflow for %s", self._getName(index))
+        return self.job._runTasks(self.job.getCandidateTasks(planGen))
+
+    def _finished(self, index):
+        for dependent in self.dependents[index]:
+            waitingOn = self.waitingOn[dependent]
+            waitingOn.discard(index)
+            if not waitingOn:
+                heapq.heappush(self.ready, dependent)
+        self.changed.notify_all()
+
+    @contextlib.contextmanager
+    def blocking(self, task):
+        # save the changes made so far like when the configurator yields,
+        # other tasks might update the instances the task has accessed
+        task.commitChanges()
+        limits = self.job.runner.limits.getConcurrencyLimits(task)
+        self.idle += 1
+        self.changed.notify_all()
+        while any(self.inUse[key] >= limit for key, limit in limits):
+            self.changed.wait()
+        for key, limit in limits:
+            self.inUse[key] += 1
+        self.lock.release()
+        try:
+            yield
+        finally:
+            self.lock.acquire()
+            for key, limit in limits:
+                self.inUse[key] -= 1
+            if limits:
+                self.changed.notify_all()
+            self.idle -= 1
+            # other tasks have set their own attribute manager
+            task.target.root.attributeManager = task._attributeManager
+
+    def _canJoinBatch(self):
+        # another task can join a batch if a worker is accessing the instance model
+        # or a worker is free to start a workflow that is ready
+        return self.idle < self.running or (
+            self.ready and self.running < self.workerCount
+        )
+
+    def joinBatch(self, task, request):
+        """
+        Adds the given request to the batch waiting to run with the same key
+        or, if there isn't one, starts a new batch and waits for other tasks to join it.
+        The batch runs when its ``window`` has elapsed or no other task could join it.
+        Returns the request with its result set.
+        """
+        batch = self.batches.get(request.key)
+        if batch is not None:
+            batch.append(request)
+            task.commitChanges()
+            self.idle += 1
+            self.changed.notify_all()
+            while not request.done:
+                self.changed.wait()
+            self.idle -= 1
+            task.target.root.attributeManager = task._attributeManager
+            return request
+
+        batch = self.batches[request.key] = [request]
+        task.commitChanges()
+        self.idle += 1
+        self.changed.notify_all()
+        deadline = perf_counter() + request.window
+        while self._canJoinBatch():
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            self.changed.wait(remaining)
+        self.idle -= 1
+        del self.batches[request.key]
+        logger.debug("running batch %s with %s tasks", request.key, len(batch))
+        with self.blocking(task):
+            BatchRequest.runBatch(batch)
+        self.changed.notify_all()
+        return request
+
+    def addWork(self, task):
+        index = getattr(self._local, "index", None)
+        if index is None:
+            index = len(self.workflows)
+        self._order[id(task)] = (index, len(self._order))
+
+    def _reorderWork(self):
+        # commit the job's tasks in plan order instead of the order they happened to complete
+        last = (len(self.workflows), len(self._order))
+        workDone = sorted(
+            self.job.workDone.items(), key=lambda item: self._order.get(item[0], last)
+        )
+        self.job.workDone = collections.OrderedDict(workDone)
+
+
 class Runner(object):
     def __init__(self, manifest):
         self.manifest = manifest
         assert self.manifest.tosca
         self.taskCount = 0
         self.currentJob = None
+        self.handled = {}
+        self.checkpoint = None
+        context = getattr(manifest, "context", None) or {}
+        self.limits = TaskLimits(context.get("limits"))
 
     def addWork(self, task):
         key = id(task)
         self.currentJob.workDone[key] = task
         task.job.workDone[key] = task
+        if self.currentJob.scheduler:
+            self.currentJob.scheduler.addWork(task)
+
+    @staticmethod
+    def _getHandledKey(configSpec, target):
+        return (configSpec.operation, configSpec.getDigest(), target.key)
+
+    def recordHandledConfig(self, task):
+        """
+        Record that the task's configuration was successfully applied to its target
+        so it isn't run again during this job (e.g. by a parent job after a child job ran it).
+        """
+        self.handled[self._getHandledKey(task.configSpec, task.target)] = task
+        if self.checkpoint:
+            self.checkpoint.append(task)
 
     def isConfigAlreadyHandled(self, configSpec, target):
-        return None  # XXX
-        # return configSpec.name in self.currentJob.workDone
+        """
+        Returns the task that already applied the configuration to the target
+        during this job, if any, or the task's record if the job is resuming an interrupted job.
+        """
+        return self.handled.get(self._getHandledKey(configSpec, target))
 
     def createJob(self, joboptions, previousId=None):
         """
@@ -792,6 +1427,7 @@ class Runner(object):
 
     def run(self, jobOptions=None):
         job = None
+        profile = None
         try:
             cwd = os.getcwd()
             if self.manifest.getBaseDir():
@@ -812,27 +1448,69 @@ class Runner(object):
                         )
                         return None
 
+            if jobOptions.profileExpressions:
+                profile = ExprProfile().start()
             job = self.createJob(
                 jobOptions, self.manifest.lastJob and self.manifest.lastJob["changeId"]
             )
+            job.exprProfile = profile
             startTime = perf_counter()
             self.currentJob = job
+            self.handled = {}
+            if not jobOptions.planOnly:
+                if jobOptions.resume:
+                    for record in self.manifest.loadCheckpoint(job):
+                        key = (
+                            record["implementation"]["operation"],
+                            record["configDigest"],
+                            record["target"],
+                        )
+                        self.handled[key] = record
+                self.checkpoint = self.manifest.startCheckpoint(job)
             try:
                 display.verbosity = jobOptions.verbose
                 job.run()
+                if not jobOptions.planOnly and not job.dryRun:
+                    job.recordDigests()
             except Exception:
                 job.localStatus = Status.error
                 job.unexpectedAbort = UnfurlError(
                     "unexpected exception while running job", True, True
                 )
             self.currentJob = None
+            if self.checkpoint:
+                self.checkpoint.close()
+                self.checkpoint = None
             self.manifest.commitJob(job)
         finally:
             if job:
                 job.timeElapsed = perf_counter() - startTime
+                # release the memoized queries, they are only reused within a job
+                queryCache = job.rootResource.queryCache
+                if queryCache is not None:
+                    queryCache.clear()
+            if profile:
+                profile.stop()
+                if job:
+                    self.saveExprProfile(job)
             os.chdir(cwd)
         return job
 
+    def saveExprProfile(self, job):
+        """
+        Saves the statistics collected by the job's `ExprProfile` as JSON
+        next to the job's log file.
+        """
+        if not self.manifest.localEnv or job.parentJob or job.jobOptions.startTime:
+            return None
+        path = self.manifest.getJobLogPath(job.getStartTime(), "-expressions.json")
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        logger.info("saving expression profile to %s", path)
+        with open(path, "w") as f:
+            json.dump(job.exprProfile.getStats(), f, indent=2)
+        return path
+
 
 def runJob(manifestPath=None, _opts=None):
     """
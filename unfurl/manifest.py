@@ -100,7 +100,7 @@ class Manifest(AttributeManager):
         m = hashlib.sha1()  # use same digest function as git
         t = self.tosca.template
         for tpl in [spec, t.topology_template.custom_defs, t.nested_tosca_tpls]:
-            m.update(json.dumps(tpl, sort_keys=True).encode("utf-8"))
+            m.update(json.dumps(tpl, sort_keys=True, default=str).encode("utf-8"))
         return m.hexdigest()
 
     def _ready(self, rootResource):
@@ -128,6 +128,15 @@ class Manifest(AttributeManager):
     def saveJob(self, job):
         pass
 
+    def startCheckpoint(self, job):
+        return None
+
+    def loadCheckpoint(self, job):
+        return []
+
+    def getTaskDurations(self):
+        return {}
+
     def loadTemplate(self, name, lastChange=None):
         if lastChange:
             try:
@@ -151,6 +160,7 @@ class Manifest(AttributeManager):
         instance._priority = toEnum(Priority, status.get("priority"))
         instance._lastStateChange = status.get("lastStateChange")
         instance._lastConfigChange = status.get("lastConfigChange")
+        instance._configDigests = dict(status.get("configDigests") or {})
 
         readyState = status.get("readyState")
         if not isinstance(readyState, collections.Mapping):
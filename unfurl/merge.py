@@ -434,11 +434,16 @@ def diffDicts(old, new, cls=dict):
     for key, val in old.items():
         if key in new:
             newval = new[key]
-            if val != newval:
-                if isinstance(val, Mapping) and isinstance(newval, Mapping):
-                    diff[key] = diffDicts(val, newval, cls)
-                else:
-                    diff[key] = newval
+            if val is newval:
+                continue
+            if isinstance(val, Mapping) and isinstance(newval, Mapping):
+                # diff the maps directly instead of comparing them first
+                # so each nested map is only compared once
+                childDiff = diffDicts(val, newval, cls)
+                if childDiff:
+                    diff[key] = childDiff
+            elif val != newval:
+                diff[key] = newval
         else:
             diff[key] = {"+%": "delete"}
 
@@ -448,6 +453,36 @@ def diffDicts(old, new, cls=dict):
     return diff
 
 
+def applyDiff(old, diff, cls=dict):
+    """
+    Return a new dict where old + diff, as returned by `diffDicts`, = new.
+    Unlike `mergeDicts`, lists in diff replace the old list.
+    """
+    new = cls()
+    # start with old to preserve original order
+    for key, val in old.items():
+        if key in diff:
+            change = diff[key]
+            if isinstance(change, Mapping):
+                if change.get(mergeStrategyKey) == "delete":
+                    continue
+                if isinstance(val, Mapping):
+                    new[key] = applyDiff(val, change, cls)
+                    continue
+            new[key] = change
+        else:
+            new[key] = val
+
+    for key, change in diff.items():
+        if key not in old:
+            if not (
+                isinstance(change, Mapping)
+                and change.get(mergeStrategyKey) == "delete"
+            ):
+                new[key] = change
+    return new
+
+
 # XXX rename function, confusing name
 def patchDict(old, new, cls=dict):
     """
@@ -483,17 +518,23 @@ def patchDict(old, new, cls=dict):
 def intersectDict(old, new, cls=dict):
     """
     remove keys from old that don't match new
+    (delete markers in old match keys that are missing from new)
     """
     # start with old to preserve original order
     for key, val in list(old.items()):
+        deleted = isinstance(val, Mapping) and val.get(mergeStrategyKey) == "delete"
         if key in new:
             newval = new[key]
             if val != newval:
-                if isinstance(val, Mapping) and isinstance(newval, Mapping):
+                if (
+                    not deleted
+                    and isinstance(val, Mapping)
+                    and isinstance(newval, Mapping)
+                ):
                     old[key] = intersectDict(val, newval, cls)
                 else:
                     del old[key]
-        else:
+        elif not deleted:
             del old[key]
 
     return old
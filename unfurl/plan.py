@@ -1,13 +1,14 @@
 # Copyright (c) 2020 Adam Souzis
 # SPDX-License-Identifier: MIT
 import six
-from .runtime import NodeInstance
+from .runtime import NodeInstance, RelationshipInstance
 from .util import UnfurlError, Generate, toEnum
 from .support import Status, NodeState
 from .configurator import (
     ConfigurationSpec,
     getConfigSpecArgsFromImplementation,
     TaskRequest,
+    TaskView,
 )
 from .tosca import findStandardInterface
 
@@ -359,7 +360,7 @@ class Plan(object):
         if iDef and iDef.name != "default":
             # merge inputs
             if inputs:
-                inputs = dict(iDef.inputs, **inputs)
+                inputs = dict(iDef.inputs or {}, **inputs)
             else:
                 inputs = iDef.inputs or {}
             kw = getConfigSpecArgsFromImplementation(iDef, inputs, resource.template)
@@ -374,7 +375,7 @@ class Plan(object):
                     kw["workflow"] = reason
             else:
                 name = "%s.%s" % (interface, action)
-            configSpec = ConfigurationSpec(name, action, **kw)
+            configSpec = ConfigurationSpec(name, action, interface=interface, **kw)
             logger.debug(
                 "creating configuration %s with %s to run for %s: %s",
                 configSpec.name,
@@ -393,6 +394,17 @@ class Plan(object):
 
         return TaskRequest(configSpec, resource, reason or action)
 
+    def getConfigDigest(self, operation, resource):
+        """
+        Returns the digest (see :meth:`unfurl.configurator.TaskView.getDigest`)
+        of the given operation as the plan would create it for the given instance
+        or None if the operation isn't implemented.
+        """
+        req = self.createTaskRequest(operation, resource)
+        if req.error:
+            return None
+        return TaskView(None, req.configSpec, resource).getDigest()
+
     def generateDeleteConfigurations(self, include):
         for resource in getOperationalDependents(self.root):
             # reverse to teardown leaf nodes first
@@ -603,25 +615,19 @@ class Plan(object):
         while gen():
             gen.result = yield gen.next
 
-    def executePlan(self):
+    def _findInstancesToVisit(self):
         """
-        Generate candidate tasks
-
-        yields TaskRequests
+        Yields ``(instance, template)`` pairs in the order the plan visits them.
+        ``template`` is None if the instance was just created for the template.
         """
-        opts = self.jobOptions
         templates = self._getTemplates()
 
         logger.debug("checking for tasks for templates %s", [t.name for t in templates])
-        visited = set()
         for template in templates:
             found = False
             for resource in self.findResourcesFromTemplate(template):
                 found = True
-                visited.add(id(resource))
-                gen = Generate(self._generateWorkflowConfigurations(resource, template))
-                while gen():
-                    gen.result = yield gen.next
+                yield resource, template
 
             if (
                 not found
@@ -630,18 +636,155 @@ class Plan(object):
             ):
                 include = self.includeNotFound(template)
                 if include:
-                    resource = self.createResource(template)
-                    visited.add(id(resource))
-                    gen = Generate(self._generateWorkflowConfigurations(resource, None))
-                    while gen():
-                        gen.result = yield gen.next
+                    yield self.createResource(template), None
 
-        if opts.prune:
+    def executePrune(self, visited):
+        """
+        yields TaskRequests to remove the instances that the plan didn't visit
+        if the "prune" job option was set.
+        """
+        if self.jobOptions.prune:
             test = lambda resource: "prune" if id(resource) not in visited else False
             gen = Generate(self.generateDeleteConfigurations(test))
             while gen():
                 gen.result = yield gen.next
 
+    def executePlan(self):
+        """
+        Generate candidate tasks
+
+        yields TaskRequests
+        """
+        visited = set()
+        for resource, template in self._findInstancesToVisit():
+            visited.add(id(resource))
+            gen = Generate(self._generateWorkflowConfigurations(resource, template))
+            while gen():
+                gen.result = yield gen.next
+
+        gen = Generate(self.executePrune(visited))
+        while gen():
+            gen.result = yield gen.next
+
+    def getInstanceWorkflows(self, visited):
+        """
+        Returns a list of ``(instance, template, generator)`` tuples, one for each instance
+        that :meth:`executePlan` would visit and in the same order,
+        where each generator yields the TaskRequests for that instance.
+
+        Instances that already exist are found upfront so their tasks can be run in parallel.
+        As with :meth:`executePlan`, the instance for a template that doesn't have one isn't
+        created until its workflow starts, in case an earlier task creates or discovers it.
+        For those workflows ``instance`` is None.
+
+        The ids of the instances visited are added to ``visited`` as they are found or created,
+        pass it to :meth:`executePrune` after the workflows have completed.
+
+        Returns None if the plan can't be divided by instance.
+        """
+        workflows = []
+        for template in self._getTemplates():
+            found = False
+            for resource in self.findResourcesFromTemplate(template):
+                found = True
+                visited.add(id(resource))
+                workflows.append(
+                    (
+                        resource,
+                        template,
+                        self._generateWorkflowConfigurations(resource, template),
+                    )
+                )
+
+            if (
+                not found
+                and not template.abstract
+                and "dependent" not in template.directives
+            ):
+                workflows.append(
+                    (None, template, self._generateDeferredWorkflow(template, visited))
+                )
+        return workflows
+
+    def _generateDeferredWorkflow(self, template, visited):
+        # look for the template's instances again, a previous task might have created them
+        resources = list(self.findResourcesFromTemplate(template))
+        if resources:
+            oldTemplate = template
+        else:
+            if not self.includeNotFound(template):
+                return
+            resources = [self.createResource(template)]
+            oldTemplate = None
+        for resource in resources:
+            visited.add(id(resource))
+            gen = Generate(self._generateWorkflowConfigurations(resource, oldTemplate))
+            while gen():
+                gen.result = yield gen.next
+
+    def findInstanceDependencies(self, instance):
+        """
+        Yields the node instances whose tasks should be completed
+        before the given instance's tasks can start:
+        its parent, the targets of its requirements and its explicit operation hosts.
+        """
+        try:
+            for dep in instance.getOperationalDependencies():
+                if isinstance(dep, RelationshipInstance):
+                    dep = dep.target
+                if dep:
+                    yield dep
+        except Exception:
+            # the instance's tasks will report this when they are run
+            logger.debug(
+                "could not find dependencies for %s", instance.name, exc_info=True
+            )
+
+        for operation_host in findExplicitOperationHosts(
+            instance.template, self.interface
+        ):
+            dep = self.root.findResource(operation_host)
+            if dep:
+                yield dep
+
+    def findTemplateDependencies(self, template):
+        """
+        Yields the names of the templates whose instances' tasks should be completed
+        before the tasks of an instance of the given template can start
+        (used for instances that haven't been created yet, see :meth:`findInstanceDependencies`).
+        """
+        for ancestor in getAncestorTemplates(template.toscaEntityTemplate):
+            if ancestor.name != template.name:
+                yield ancestor.name
+        for operation_host in findExplicitOperationHosts(template, self.interface):
+            yield operation_host
+
+    def buildTaskGraph(self, tasks):
+        """
+        Returns a :class:`TaskGraph` of the given tasks (in the order the plan generated them).
+
+        A task depends on the previous task with the same target
+        and on the last task of each instance its target depends on
+        (see :meth:`findInstanceDependencies`).
+        """
+        graph = TaskGraph(tasks)
+        lastTasks = {}  # id(instance) => index of its last task
+        for index, task in enumerate(graph.tasks):
+            target = task.target
+            if isinstance(target, RelationshipInstance):
+                # relationship tasks run after both ends are ready
+                dependencies = [target.source, target.target]
+            else:
+                dependencies = list(self.findInstanceDependencies(target))
+            for instance in [target] + dependencies:
+                if instance is None:
+                    continue
+                before = lastTasks.get(id(instance))
+                if before is not None:
+                    graph.addEdge(before, index)
+            lastTasks[id(target)] = index
+        return graph
+
 
 class DeployPlan(Plan):
     interface = "Standard"
@@ -692,11 +835,41 @@ class DeployPlan(Plan):
                     return "update"
 
         # there isn't a new config to run, see if the last applied config needs to be re-run
-        # XXX: if (jobOptions.upgrade or jobOptions.update or jobOptions.force):
-        #  if (configTask.hasInputsChanged() or configTask.hasDependenciesChanged()) and
-        #    return 'config changed', configTask.configSpec
+        if jobOptions.upgrade or jobOptions.update:
+            if self.hasConfigChanged(resource):
+                return "config changed"
         return self.checkForRepair(resource)
 
+    def hasConfigChanged(self, instance):
+        """
+        Returns True if the configuration of any operation that was
+        applied to the instance (or to its requirements) have changed since the last
+        job that ran it (see :meth:`unfurl.job.Job.recordDigests`).
+        """
+        # only check requirements that have already been instantiated
+        for current in [instance] + (instance._requirements or []):
+            for operation, digest in current._configDigests.items():
+                try:
+                    newDigest = self.getConfigDigest(operation, current)
+                    if newDigest is None:
+                        # XXX the operation's implementation was removed
+                        continue
+                    changed = newDigest != digest
+                except Exception:
+                    logger.debug(
+                        "could not compute the digest for %s on %s",
+                        operation,
+                        current.name,
+                        exc_info=True,
+                    )
+                    changed = True
+                if changed:
+                    logger.debug(
+                        "configuration changed for %s on %s", operation, current.name
+                    )
+                    return True
+        return False
+
     def checkForRepair(self, instance):
         jobOptions = self.jobOptions
         assert instance
@@ -773,6 +946,9 @@ class DeployPlan(Plan):
 
 
 class UndeployPlan(Plan):
+    def getInstanceWorkflows(self, visited):
+        return None
+
     def executePlan(self):
         """
         yields configSpec, target, reason
@@ -793,6 +969,9 @@ class ReadOnlyPlan(Plan):
 
 
 class WorkflowPlan(Plan):
+    def getInstanceWorkflows(self, visited):
+        return None
+
     def executePlan(self):
         """
         yields configSpec, target, reason
@@ -848,6 +1027,9 @@ class RunNowPlan(Plan):
             timeout=timeout,
         )
 
+    def getInstanceWorkflows(self, visited):
+        return None
+
     def executePlan(self):
         instanceFilter = self.jobOptions.instance
         if instanceFilter:
@@ -885,6 +1067,67 @@ class RunNowPlan(Plan):
                     yield req
 
 
+class TaskGraph(object):
+    """
+    A directed acyclic graph of tasks. Edges always point from a task to a task
+    that comes later in the list, so the list is in topological order.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+        self.predecessors = [set() for task in self.tasks]
+
+    def addEdge(self, before, after):
+        assert before < after, "edges must follow the order of the tasks"
+        self.predecessors[after].add(before)
+
+    def getLevels(self):
+        """
+        Returns each task's level:
+        1 + the level of the task's deepest predecessor (tasks without any are level 1).
+        """
+        levels = []
+        for preds in self.predecessors:
+            levels.append(1 + max([levels[p] for p in preds] or [0]))
+        return levels
+
+    @property
+    def depth(self):
+        "The number of tasks in the longest chain of dependent tasks."
+        return max(self.getLevels() or [0])
+
+    @property
+    def width(self):
+        "The largest number of tasks at the same level, i.e. that could run in parallel."
+        counts = {}
+        for level in self.getLevels():
+            counts[level] = counts.get(level, 0) + 1
+        return max(counts.values() or [0])
+
+    def findCriticalPath(self, durations):
+        """
+        Returns ``(total duration, tasks)`` for the longest path through the graph,
+        where ``durations`` is a list with the (estimated) duration of each task.
+        """
+        if not self.tasks:
+            return 0, []
+        finish = []
+        previous = []
+        for index, preds in enumerate(self.predecessors):
+            before = max(preds, key=lambda p: finish[p]) if preds else None
+            start = finish[before] if before is not None else 0
+            finish.append(start + durations[index])
+            previous.append(before)
+
+        index = max(range(len(finish)), key=lambda i: finish[i])
+        total = finish[index]
+        path = []
+        while index is not None:
+            path.append(self.tasks[index])
+            index = previous[index]
+        return total, list(reversed(path))
+
+
 def findExplicitOperationHosts(template, interface):
     for iDef in template.getInterfaces():
         if isinstance(iDef.implementation, dict):
@@ -1,16 +1,29 @@
 # Copyright (c) 2020 Adam Souzis
 # SPDX-License-Identifier: MIT
+import itertools
+import threading
 from collections import Mapping, MutableSequence, MutableMapping
 from datetime import datetime, timedelta
 
 from .merge import diffDicts
-from .util import UnfurlError, isSensitive, sensitive, sensitive_dict, sensitive_list
+from .util import (
+    UnfurlError,
+    isSensitive,
+    sensitive,
+    sensitive_dict,
+    sensitive_list,
+    ChainMap,
+    CopyOnWriteMap,
+)
 
 
 def serializeValue(value, **kw):
     getter = getattr(value, "asRef", None)
     if getter:
         return getter(kw)
+    if kw.get("lazy") and isinstance(value, Results):
+        # don't resolve the items that haven't been read, save them as is
+        return value.serializeLazy(**kw)
     if isinstance(value, Mapping):
         ctor = sensitive_dict if isinstance(value, sensitive) else dict
         return ctor((key, serializeValue(v, **kw)) for key, v in value.items())
@@ -21,8 +34,59 @@ def serializeValue(value, **kw):
         return value
 
 
+# properties that don't change after an instance is created
+_immutableProps = frozenset(
+    [
+        "name",
+        "type",
+        "template",
+        "parent",
+        "root",
+        "ancestors",
+        "parents",
+        "key",
+        "tosca_id",
+        "tosca_name",
+        "baseDir",
+        "artifacts",
+        "attributes",
+    ]
+)
+# properties that change when instances are added
+_instancesProps = frozenset(
+    [
+        "all",
+        "instances",
+        "requirements",
+        "capabilities",
+        "relationships",
+        "descendents",
+        "source",
+        "target",
+        "names",
+    ]
+)
+# properties that change when the status of an instance changes
+_statusProps = frozenset(
+    [
+        "status",
+        "localStatus",
+        "state",
+        "manualOverideStatus",
+        "priority",
+        "operational",
+        "active",
+        "present",
+        "missing",
+        "required",
+    ]
+)
+
+
 class ResourceRef(object):
     # ABC requires 'parent', and '_resolve'
+    # and '_attributesVersion', incremented when its attributes change (see `ReadSet`)
+    __slots__ = ()
 
     def _getProp(self, name):
         if name == ".":
@@ -30,6 +94,14 @@ class ResourceRef(object):
         elif name == "..":
             return self.parent
         name = name[1:]
+        readSet = currentReadSet()
+        if readSet and name not in _immutableProps:
+            if name in _instancesProps:
+                readSet.readInstances()
+            elif name in _statusProps:
+                readSet.readStatus()
+            else:
+                readSet.cacheable = False
         # XXX3 use propmap
         return getattr(self, name)
 
@@ -69,6 +141,179 @@ class ResourceRef(object):
     def templar(self):
         return self.root._templar
 
+    @property
+    def queryCache(self):
+        "The memoized results of queries evaluated on the topology (see `ReadSet`)."
+        return getattr(self.root, "_queryCache", None)
+
+
+# Memoized query results (see `ResourceRef.queryCache`) are invalidated using version numbers:
+# each instance has one for its attributes and the topology has one for the instances in it
+# and one for their statuses.
+_versions = itertools.count(1)
+_instancesVersion = 0
+_statusVersion = 0
+_reading = threading.local()
+
+
+def touchAttributes(resource):
+    "Call when the given instance's attributes change."
+    if isinstance(resource, ResourceRef):
+        resource._attributesVersion = next(_versions)
+
+
+def touchInstances():
+    "Call when an instance is added to a topology."
+    global _instancesVersion
+    _instancesVersion = next(_versions)
+
+
+def touchStatus():
+    "Call when the status or state of an instance changes."
+    global _statusVersion
+    _statusVersion = next(_versions)
+
+
+def currentReadSet():
+    "Returns the `ReadSet` recording the evaluation in progress on this thread or None."
+    stack = getattr(_reading, "stack", None)
+    return stack[-1] if stack else None
+
+
+def readInstances():
+    readSet = currentReadSet()
+    if readSet:
+        readSet.readInstances()
+
+
+def markUncacheable():
+    "Call when the evaluation in progress read something a `ReadSet` can't track."
+    readSet = currentReadSet()
+    if readSet:
+        readSet.cacheable = False
+
+
+class ReadSet(object):
+    """
+    Records what an evaluation read so its result can be reused until one of those changes:
+    the instances whose attributes it read, whether it depended on which instances exist
+    or on their statuses and the values of the vars it used.
+
+    While started, reads on the current thread are recorded in it
+    and when it is stopped they are added to the `ReadSet` it was nested in.
+    """
+
+    __slots__ = (
+        "attributes",
+        "instances",
+        "status",
+        "vars",
+        "scope",
+        "cacheable",
+    )
+
+    def __init__(self, scope):
+        # id(instance) => (instance, version)
+        self.attributes = {}
+        self.instances = None
+        self.status = None
+        # name => (key, value)
+        self.vars = {}
+        # the vars of the context being evaluated
+        self.scope = scope
+        self.cacheable = True
+
+    def start(self):
+        stack = getattr(_reading, "stack", None)
+        if stack is None:
+            stack = _reading.stack = []
+        stack.append(self)
+        return self
+
+    def stop(self):
+        stack = _reading.stack
+        assert stack[-1] is self
+        stack.pop()
+        if stack:
+            stack[-1].merge(self)
+
+    def isEmpty(self):
+        return (
+            self.cacheable
+            and not self.attributes
+            and self.instances is None
+            and self.status is None
+            and not self.vars
+        )
+
+    def readAttributes(self, resource):
+        if not isinstance(resource, ResourceRef):
+            self.cacheable = False
+        elif id(resource) not in self.attributes:
+            # record the version before they are read in case they change while being read
+            self.attributes[id(resource)] = (resource, resource._attributesVersion)
+
+    def readInstances(self):
+        if self.instances is None:
+            self.instances = _instancesVersion
+
+    def readStatus(self):
+        if self.status is None:
+            self.status = _statusVersion
+
+    def readVar(self, name, key, value, layer):
+        """
+        ``layer`` is the layer of the vars the value was found in
+        and ``key`` is None if the value can't be compared (see `unfurl.eval.RefContext`).
+        """
+        if key is None or self.scope.findLayer(name) is not layer:
+            # we can't tell if it changed using our scope's vars
+            self.cacheable = False
+        elif name not in self.vars:
+            # keep a reference to the value so its id isn't reused
+            self.vars[name] = (key, value)
+
+    def merge(self, other, scope=None):
+        """
+        Add the reads recorded in another `ReadSet`.
+        ``scope`` is the vars its vars were read from if not its own.
+        """
+        if not other.cacheable:
+            self.cacheable = False
+            return
+        for key, (resource, version) in other.attributes.items():
+            current = self.attributes.get(key)
+            if current is None or version < current[1]:
+                self.attributes[key] = (resource, version)
+        if other.instances is not None and (
+            self.instances is None or other.instances < self.instances
+        ):
+            self.instances = other.instances
+        if other.status is not None and (
+            self.status is None or other.status < self.status
+        ):
+            self.status = other.status
+        if other.vars:
+            if scope is None:
+                scope = other.scope
+            for name, value in other.vars.items():
+                if scope.findLayer(name) is not self.scope.findLayer(name):
+                    # the var wasn't inherited from our scope
+                    self.cacheable = False
+                    return
+                self.vars.setdefault(name, value)
+
+    def isCurrent(self):
+        "Returns False if anything read has changed (except vars)."
+        if self.instances is not None and self.instances != _instancesVersion:
+            return False
+        if self.status is not None and self.status != _statusVersion:
+            return False
+        for resource, version in self.attributes.values():
+            if resource._attributesVersion != version:
+                return False
+        return True
+
 
 class ChangeRecord(object):
     """
@@ -209,6 +454,8 @@ class ChangeRecord(object):
 
 
 class ChangeAware(object):
+    __slots__ = ()
+
     def hasChanged(self, changeRecord):
         """
         Whether or not this object changed since the give ChangeRecord.
@@ -286,12 +533,27 @@ class Result(ChangeAware):
         else:
             if isinstance(self.resolved, Results):
                 return self.resolved.hasDiff()
+            elif self.resolved is self.original:
+                # unchanged, no need to compare
+                return False
             else:
                 newval = self.asRef()
                 if self.original != newval:
                     return True
         return False
 
+    def _getDiffIfChanged(self):
+        # same as getDiff() but returns _Deleted if the value hasn't changed
+        # so nested maps are only walked once
+        if isinstance(self.resolved, ResultsMap):
+            diff = self.resolved.getDiff()
+            if diff or self.original is _Deleted:
+                return diff
+            return _Deleted
+        elif self.hasDiff():
+            return self.getDiff()
+        return _Deleted
+
     def getDiff(self):
         if isinstance(self.resolved, Results):
             return self.resolved.getDiff()
@@ -379,18 +641,37 @@ class Results(object):
     and resolving the whole tree up front can lead to evaluations of circular references unless the
     order is carefully chosen. So evaluate lazily and memoize the results.
     This also allows us to track changes to the returned structure.
+
+    If ``copyOnWrite`` is set, the lists and dicts nested in ``serializedOriginal``
+    are copied (see `CopyOnWriteMap`) instead of modified when their items are resolved
+    or changed.
+    If ``dirty`` is set, the key of the context's instance is added to it when a value
+    is changed (see `AttributeManager.commitChanges`).
     """
 
-    __slots__ = ("_attributes", "context", "_deleted")
+    __slots__ = (
+        "_attributes",
+        "context",
+        "_deleted",
+        "_reads",
+        "_copyOnWrite",
+        "_dirty",
+    )
 
     doFullResolve = False
 
-    def __init__(self, serializedOriginal, resourceOrCxt):
+    def __init__(
+        self, serializedOriginal, resourceOrCxt, copyOnWrite=False, dirty=None
+    ):
         from .eval import RefContext
 
         assert not isinstance(serializedOriginal, Results), serializedOriginal
         self._attributes = serializedOriginal
         self._deleted = {}
+        # key => the ReadSet of the evaluation that resolved its value
+        self._reads = None
+        self._copyOnWrite = copyOnWrite
+        self._dirty = dirty
         if not isinstance(resourceOrCxt, RefContext):
             ctx = RefContext(resourceOrCxt)
         else:
@@ -404,9 +685,27 @@ class Results(object):
             ctx.trace("found baseDir", newBaseDir, "old", oldBaseDir)
         self.context = ctx
 
+    def _read(self):
+        readSet = currentReadSet()
+        if readSet:
+            readSet.readAttributes(self.context.currentResource)
+        return readSet
+
+    def _changed(self, key):
+        if self._reads:
+            self._reads.pop(key, None)
+        self._touch()
+
+    def _touch(self):
+        resource = self.context.currentResource
+        touchAttributes(resource)
+        if self._dirty is not None:
+            self._dirty.add(resource.key)
+
     def getCopy(self, key, default=None):
         from .eval import mapValue
 
+        self._read()
         try:
             val = self._attributes[key]
         except:
@@ -421,7 +720,7 @@ class Results(object):
         return mapValue(val, self.context)
 
     @staticmethod
-    def _mapValue(val, context):
+    def _mapValue(val, context, copyOnWrite=False, dirty=None):
         "Recursively and lazily resolves any references in a value"
         from .eval import mapValue, Ref
 
@@ -432,9 +731,14 @@ class Results(object):
         elif isinstance(val, sensitive):
             return val
         elif isinstance(val, Mapping):
-            return ResultsMap(val, context)
+            if copyOnWrite:
+                return ResultsMap(CopyOnWriteMap(val), context, True, dirty)
+            return ResultsMap(val, context, dirty=dirty)
         elif isinstance(val, list):
-            return ResultsList(val, context)
+            if copyOnWrite:
+                # only the list is copied, its items are copied when they are resolved
+                return ResultsList(list(val), context, True, dirty)
+            return ResultsList(val, context, dirty=dirty)
         else:
             # at this point, just evaluates templates in strings or returns val
             return mapValue(val, context)
@@ -444,26 +748,42 @@ class Results(object):
         return any(isinstance(x, Result) and isSensitive(x) for x in self._values())
 
     def hasDiff(self):
+        if self._deleted:
+            return True
         # only check resolved values
         return any(isinstance(x, Result) and x.hasDiff() for x in self._values())
 
     def __getitem__(self, key):
         from .eval import mapValue
 
+        readSet = self._read()
         val = self._attributes[key]
         if isinstance(val, Result):
             assert not isinstance(val.resolved, Result), val
+            if readSet and self._reads and key in self._reads:
+                # the value depends on what was read when it was resolved
+                readSet.merge(self._reads[key])
             return val.resolved
         else:
-            if self.doFullResolve:
-                if isinstance(val, Results):
-                    resolved = val
-                else:  # evaluate records that aren't Results
-                    resolved = mapValue(val, self.context)
-            else:
-                # lazily evaluate lists and dicts
-                self.context.trace("Results._mapValue", val)
-                resolved = self._mapValue(val, self.context)
+            reads = ReadSet(self.context.vars).start()
+            try:
+                if self.doFullResolve:
+                    if isinstance(val, Results):
+                        resolved = val
+                    else:  # evaluate records that aren't Results
+                        resolved = mapValue(val, self.context)
+                else:
+                    # lazily evaluate lists and dicts
+                    self.context.trace("Results._mapValue", val)
+                    resolved = self._mapValue(
+                        val, self.context, self._copyOnWrite, self._dirty
+                    )
+            finally:
+                reads.stop()
+            if not reads.isEmpty():
+                if self._reads is None:
+                    self._reads = {}
+                self._reads[key] = reads
             # will return a Result if val was an expression that was evaluated
             if isinstance(resolved, Result):
                 result = resolved
@@ -474,19 +794,29 @@ class Results(object):
                 result.original = val
             self._attributes[key] = result
             assert not isinstance(resolved, Result), val
+            if (
+                self._dirty is not None
+                and resolved is not val
+                and not isinstance(resolved, Results)
+            ):
+                # an expression or template was evaluated, its value needs to be saved
+                self._dirty.add(self.context.currentResource.key)
             return resolved
 
     def __setitem__(self, key, value):
         assert not isinstance(value, Result), (key, value)
         self._attributes[key] = Result(value)
         self._deleted.pop(key, None)
+        self._changed(key)
 
     def __delitem__(self, index):
         val = self._attributes[index]
         self._deleted[index] = val
         del self._attributes[index]
+        self._changed(index)
 
     def __len__(self):
+        self._read()
         return len(self._attributes)
 
     def __eq__(self, other):
@@ -505,6 +835,7 @@ class Results(object):
 
 class ResultsMap(Results, MutableMapping):
     def __iter__(self):
+        self._read()
         return iter(self._attributes)
 
     def resolveAll(self):
@@ -518,17 +849,36 @@ class ResultsMap(Results, MutableMapping):
         )
 
     def __contains__(self, key):
+        self._read()
         return key in self._attributes
 
     def _values(self):
         return self._attributes.values()
 
+    def _changedItems(self):
+        # the items that were resolved or set
+        attributes = self._attributes
+        if isinstance(attributes, ChainMap):
+            # they are only set on the first map
+            attributes = attributes.split()[0]
+        if isinstance(attributes, CopyOnWriteMap):
+            return attributes.changes.items()
+        return attributes.items()
+
+    def serializeLazy(self, **kw):
+        return dict(
+            (key, serializeValue(v, **kw) if isinstance(v, Result) else v)
+            for key, v in self._attributes.items()
+        )
+
     def getDiff(self, cls=dict):
         # returns a dict with the same semantics as diffDicts
         diffDict = cls()
-        for key, val in self._attributes.items():
-            if isinstance(val, Result) and val.hasDiff():
-                diffDict[key] = val.getDiff()
+        for key, val in self._changedItems():
+            if isinstance(val, Result):
+                diff = val._getDiffIfChanged()
+                if diff is not _Deleted:
+                    diffDict[key] = diff
 
         for key in self._deleted:
             diffDict[key] = {"+%": "delete"}
@@ -540,10 +890,22 @@ class ResultsList(Results, MutableSequence):
     def insert(self, index, value):
         assert not isinstance(value, Result), value
         self._attributes.insert(index, Result(value))
+        self._changed(index)
+
+    def _changed(self, index):
+        # indexes might have shifted
+        self._reads = None
+        self._touch()
 
     def _values(self):
         return self._attributes
 
+    def serializeLazy(self, **kw):
+        return [
+            serializeValue(v, **kw) if isinstance(v, Result) else v
+            for v in self._attributes
+        ]
+
     def getDiff(self, cls=list):
         # we don't have patchList yet so just returns the whole list
         return cls(
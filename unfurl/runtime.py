@@ -8,13 +8,22 @@ Each instance have a status; attributes that describe its state; and a TOSCA tem
 which describes its capabilities, relationships and available interfaces for configuring and interacting with it.
 """
 import six
+from six.moves import intern
 import collections
 
 from ansible.parsing.dataloader import DataLoader
 
 from .util import UnfurlError, loadClass, toEnum, makeTempDir, ChainMap
-from .result import ResourceRef, ChangeAware
-
+from .result import (
+    ResourceRef,
+    ChangeAware,
+    touchInstances,
+    touchStatus,
+    readInstances,
+    markUncacheable,
+)
+
+from .eval import ExprCache
 from .support import AttributeManager, Defaults, Status, Priority, NodeState, Templar
 from .tosca import CapabilitySpec, RelationshipSpec, NodeSpec, TopologySpec
 
@@ -31,6 +40,8 @@ class Operational(ChangeAware):
     and all use the same algorithm to compute their status from their dependent resouces, tasks, and configurations
     """
 
+    __slots__ = ()
+
     # XXX3 add repairable, messages?
 
     # core properties to override
@@ -186,6 +197,17 @@ class OperationalInstance(Operational):
     A concrete implementation of Operational
     """
 
+    __slots__ = (
+        "_localStatus",
+        "_manualOverideStatus",
+        "_priority",
+        "_lastStateChange",
+        "_lastConfigChange",
+        "_state",
+        "_configDigests",
+        "dependencies",
+    )
+
     def __init__(
         self,
         status=None,
@@ -202,6 +224,7 @@ class OperationalInstance(Operational):
             self._lastStateChange = status._lastStateChange
             self._lastConfigChange = status._lastConfigChange
             self._state = status._state
+            self._configDigests = dict(status._configDigests)
             self.dependencies = status.dependencies
         else:
             self._localStatus = toEnum(Status, status)
@@ -210,6 +233,9 @@ class OperationalInstance(Operational):
             self._lastStateChange = lastStateChange
             self._lastConfigChange = lastConfigChange
             self._state = state
+            # "Interface.operation" => digest of the task that last applied it
+            # (see TaskView.getDigest)
+            self._configDigests = {}
             self.dependencies = []
         # self.repairable = False # XXX3
         # self.messages = [] # XXX3
@@ -225,6 +251,7 @@ class OperationalInstance(Operational):
 
         def fset(self, value):
             self._localStatus = value
+            touchStatus()
 
         def fdel(self):
             del self._localStatus
@@ -241,6 +268,7 @@ class OperationalInstance(Operational):
 
         def fset(self, value):
             self._manualOverideStatus = value
+            touchStatus()
 
         def fdel(self):
             del self._manualOverideStatus
@@ -257,6 +285,7 @@ class OperationalInstance(Operational):
 
         def fset(self, value):
             self._priority = value
+            touchStatus()
 
         def fdel(self):
             del self._priority
@@ -281,6 +310,7 @@ class OperationalInstance(Operational):
 
         def fset(self, value):
             self._state = toEnum(NodeState, value)
+            touchStatus()
 
         return locals()
 
@@ -288,26 +318,63 @@ class OperationalInstance(Operational):
 
 
 class _ChildResources(collections.Mapping):
+    """
+    The node instances in the root's topology, keyed by name.
+    Also indexes them by type (see `findInstancesOfType`).
+    """
+
     def __init__(self, resource):
         self.resource = resource
+        # name => instance in the order they were created
+        # (node instance names are unique within a topology)
+        self._byName = collections.OrderedDict()
+        # type name => instances of that type or a type derived from it
+        self._byType = {}
+
+    def _addInstance(self, instance):
+        self._byName[instance.name] = instance
+        for typeName in instance.template.getTypeNames():
+            self._byType.setdefault(typeName, []).append(instance)
+
+    def findInstancesOfType(self, typeName):
+        """
+        Returns the instances whose template is compatible with the given type
+        (see ``EntitySpec.isCompatibleType``) in the order they were created.
+        """
+        readInstances()
+        return list(self._byType.get(typeName, ()))
 
     def __getitem__(self, key):
-        return self.resource.findResource(key)
+        readInstances()
+        return self._byName.get(key)
 
     def __iter__(self):
-        return iter(r.name for r in self.resource.getSelfAndDescendents())
+        readInstances()
+        return iter(self._byName)
 
     def __len__(self):
-        return len(tuple(self.resource.getSelfAndDescendents()))
+        readInstances()
+        return len(self._byName)
 
 
 class EntityInstance(OperationalInstance, ResourceRef):
-    attributeManager = None
-    created = None
-    shadow = None
-    imports = None
-    envRules = None
-    _baseDir = ""
+    # instances use __slots__ to reduce their memory footprint in large topologies
+    __slots__ = (
+        "name",
+        "_attributes",
+        "parent",
+        "template",
+        "attributeManager",
+        "created",
+        "shadow",
+        "imports",
+        "envRules",
+        "_baseDir",
+        # see `ResourceRef`
+        "_attributesVersion",
+        # the version its saved attributes are at (see `AttributeManager.getAttributes`)
+        "_savedAttributesVersion",
+    )
 
     def __init__(
         self, name="", attributes=None, parent=None, template=None, status=Status.ok
@@ -315,13 +382,23 @@ class EntityInstance(OperationalInstance, ResourceRef):
         # default to Status.ok because that has the semantics of only relying on dependents
         # note: NodeInstances always a explicit status and so instead default to unknown
         OperationalInstance.__init__(self, status)
-        self.name = name
+        # names are used as keys so intern them (only exact strs can be interned)
+        self.name = intern(name) if type(name) is str else name
         self._attributes = attributes or {}
+        self.attributeManager = None
+        self.created = None
+        self.shadow = None
+        self.imports = None
+        self.envRules = None
+        self._baseDir = ""
+        self._attributesVersion = 0
+        self._savedAttributesVersion = 0
         self.parent = parent
         if parent:
             getattr(parent, self.parentRelation).append(self)
 
         self.template = template or self.templateType()
+        touchInstances()
 
     def _resolve(self, key):
         # might return a Result
@@ -343,6 +420,7 @@ class EntityInstance(OperationalInstance, ResourceRef):
             if self.root.attributeManager:
                 self.root.attributeManager.setStatus(self, value)
             self._localStatus = value
+            touchStatus()
 
         def fdel(self):
             del self._localStatus
@@ -421,16 +499,26 @@ class EntityInstance(OperationalInstance, ResourceRef):
         return self.lastChange == other.lastChange and self.key == other.key
 
     def __getstate__(self):
-        state = self.__dict__.copy()
+        state = dict(getattr(self, "__dict__", {}))  # set if a subclass didn't use slots
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
         # Remove the unpicklable entries.
         if state.get("_templar"):
             del state["_templar"]
+        state.pop("_queryCache", None)
         if state.get("_interfaces"):
             state["_interfaces"] = {}
         if "attributeManager" in state:
             del state["attributeManager"]
         return state
 
+    def __setstate__(self, state):
+        self.attributeManager = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         return "%s('%s')" % (self.__class__, self.name)
 
@@ -442,7 +530,13 @@ class CapabilityInstance(EntityInstance):
     # 3.8.1 Capability assignment p. 114
     parentRelation = "_capabilities"
     templateType = CapabilitySpec
-    _relationships = None
+    __slots__ = ("_relationships",)
+
+    def __init__(
+        self, name="", attributes=None, parent=None, template=None, status=Status.ok
+    ):
+        self._relationships = None
+        EntityInstance.__init__(self, name, attributes, parent, template, status)
 
     @property
     def relationships(self):
@@ -474,7 +568,13 @@ class RelationshipInstance(EntityInstance):
     # 3.8.2 Requirements assignment p. 115
     parentRelation = "_relationships"
     templateType = RelationshipSpec
-    source = None
+    __slots__ = ("source",)
+
+    def __init__(
+        self, name="", attributes=None, parent=None, template=None, status=Status.ok
+    ):
+        self.source = None
+        EntityInstance.__init__(self, name, attributes, parent, template, status)
 
     @property
     def target(self):
@@ -506,6 +606,16 @@ class RelationshipInstance(EntityInstance):
 class NodeInstance(EntityInstance):
     templateType = NodeSpec
     parentRelation = "instances"
+    # _all, _templar and _queryCache are only set on the root
+    __slots__ = (
+        "_capabilities",
+        "_requirements",
+        "instances",
+        "_interfaces",
+        "_all",
+        "_templar",
+        "_queryCache",
+    )
 
     def __init__(
         self, name="", attributes=None, parent=None, template=None, status=None
@@ -527,6 +637,8 @@ class NodeInstance(EntityInstance):
         if self.root is self:
             self._all = _ChildResources(self)
             self._templar = Templar(DataLoader())
+            self._queryCache = ExprCache(maxsize=2048)
+        self.root._all._addInstance(self)
 
         self._interfaces = {}
         # preload
@@ -633,12 +745,14 @@ class NodeInstance(EntityInstance):
             try:
                 inherit = self._interfaces.get("inherit")  # pre-loaded
                 if inherit:
+                    markUncacheable()
                     return inherit(key)
                 else:
                     raise
             except KeyError:
                 default = self._interfaces.get("default")  # pre-loaded
                 if default:
+                    markUncacheable()
                     return default(key)
                 else:
                     raise
@@ -683,12 +797,13 @@ class NodeInstance(EntityInstance):
         return list(self.getSelfAndDescendents())
 
     def findResource(self, resourceid):
-        if self.name == resourceid:
-            return self
-        for r in self.instances:
-            child = r.findResource(resourceid)
-            if child:
-                return child
+        "Returns the instance with the given name if it is self or one of its descendents"
+        instance = self.root._all[resourceid]
+        if instance is None or instance is self:
+            return instance
+        for ancestor in instance.yieldParents():
+            if ancestor is self:
+                return instance
         return None
 
     def findInstanceOrExternal(self, resourceid):
@@ -730,6 +845,7 @@ class NodeInstance(EntityInstance):
 
 class TopologyInstance(NodeInstance):
     templateType = TopologySpec
+    __slots__ = ("inputs", "outputs", "_relationships", "_tmpDir")
 
     def __init__(self, template, status=None):
         NodeInstance.__init__(self, "root", template=template, status=status)
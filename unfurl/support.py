@@ -4,20 +4,36 @@
 Internal classes supporting the runtime.
 """
 import collections
-from collections import MutableSequence
-import copy
+from collections import MutableSequence, Sequence, Mapping
 import os
 import os.path
 import six
 import re
 import ast
 import codecs
+import threading
 from enum import IntEnum
 
-from .eval import RefContext, setEvalFunc, Ref, mapValue
-from .result import Results, ResultsMap, Result, ExternalValue, serializeValue
+from .eval import (
+    RefContext,
+    setEvalFunc,
+    Ref,
+    mapValue,
+    ExprCache,
+    getExprProfile,
+)
+from .result import (
+    Results,
+    ResultsMap,
+    Result,
+    ExternalValue,
+    serializeValue,
+    markUncacheable,
+    touchAttributes,
+)
 from .util import (
     ChainMap,
+    CopyOnWriteMap,
     findSchemaErrors,
     UnfurlError,
     UnfurlValidationError,
@@ -29,7 +45,12 @@ from .util import (
 )
 from .merge import intersectDict, mergeDicts
 import ansible.template
+from ansible.template.vars import AnsibleJ2Vars
+from ansible.errors import AnsibleError, AnsibleUndefinedVariable
 from ansible.parsing.dataloader import DataLoader
+from ansible.parsing.yaml.objects import AnsibleVaultEncryptedUnicode
+from jinja2 import Undefined
+from jinja2.exceptions import TemplateSyntaxError, UndefinedError
 from ansible.utils.unsafe_proxy import wrap_var, AnsibleUnsafeText, AnsibleUnsafeBytes
 
 import logging
@@ -285,6 +306,26 @@ setEvalFunc(
 )
 
 
+# compiled jinja2 templates, shared by every Templar in this process
+templateCache = ExprCache(maxsize=512)
+
+# the environment options that change how a template is compiled
+_envOptions = (
+    "block_start_string",
+    "block_end_string",
+    "variable_start_string",
+    "variable_end_string",
+    "comment_start_string",
+    "comment_end_string",
+    "line_statement_prefix",
+    "line_comment_prefix",
+    "trim_blocks",
+    "lstrip_blocks",
+    "newline_sequence",
+    "keep_trailing_newline",
+)
+
+
 class Templar(ansible.template.Templar):
     def template(self, variable, **kw):
         if isinstance(variable, Results):
@@ -343,6 +384,156 @@ class Templar(ansible.template.Templar):
         )
         return original
 
+    def _compileTemplate(self, data, escape_backslashes, overrides):
+        # the environment's loader depends on the basedir (used by "include")
+        key = (
+            data,
+            escape_backslashes,
+            repr(sorted((overrides or {}).items())),
+            self._basedir,
+            tuple(getattr(self.environment, name) for name in _envOptions),
+        )
+        t = templateCache.get(key)
+        if t is not None:
+            return t
+
+        # the rest of this method is adapted from ansible.template.Templar.do_template()
+        myenv = self.environment.overlay(**(overrides or {}))
+        # Get jinja env overrides from template
+        if data.startswith(ansible.template.JINJA2_OVERRIDE):
+            eol = data.find("\n")
+            line = data[len(ansible.template.JINJA2_OVERRIDE) : eol]
+            data = data[eol + 1 :]
+            for pair in line.split(","):
+                (key, val) = pair.split(":")
+                setattr(myenv, key.strip(), ast.literal_eval(val.strip()))
+
+        # Adds Ansible custom filters and tests
+        myenv.filters.update(self._get_filters())
+        myenv.tests.update(self._get_tests())
+        if escape_backslashes:
+            # Allow users to specify backslashes in playbooks as "\\" instead of as "\\\\".
+            data = ansible.template._escape_backslashes(data, myenv)
+        try:
+            t = myenv.from_string(data)
+        except TemplateSyntaxError as e:
+            raise AnsibleError(
+                "template error while templating string: %s. String: %s" % (e, data)
+            )
+        templateCache.put(key, t)
+        return t
+
+    def do_template(
+        self,
+        data,
+        preserve_trailing_newlines=True,
+        escape_backslashes=True,
+        fail_on_undefined=None,
+        overrides=None,
+        disable_lookups=False,
+    ):
+        """
+        Like ``ansible.template.Templar.do_template`` but compiled templates are
+        cached in `templateCache` instead of compiled every time they are rendered.
+        """
+        if ansible.template.USE_JINJA2_NATIVE and not isinstance(
+            data, six.string_types
+        ):
+            return data
+        if fail_on_undefined is None:
+            fail_on_undefined = self._fail_on_undefined_errors
+        try:
+            try:
+                t = self._compileTemplate(data, escape_backslashes, overrides)
+            except AnsibleError:
+                raise
+            except Exception as e:
+                if "recursion" in str(e):
+                    raise AnsibleError(
+                        "recursive loop detected in template string: %s" % data
+                    )
+                return data
+
+            # the compiled template is shared so set these per render
+            # instead of on t.globals like Ansible does
+            renderGlobals = dict(t.globals)
+            renderGlobals["dict"] = dict
+            if disable_lookups:
+                renderGlobals["query"] = renderGlobals["q"] = renderGlobals[
+                    "lookup"
+                ] = self._fail_lookup
+            else:
+                renderGlobals["lookup"] = self._lookup
+                renderGlobals["query"] = renderGlobals["q"] = self._query_lookup
+            renderGlobals["now"] = self._now_datetime
+            renderGlobals["finalize"] = self._finalize
+
+            jvars = AnsibleJ2Vars(self, renderGlobals)
+            self.cur_context = newContext = t.new_context(jvars, shared=True)
+            try:
+                res = ansible.template.j2_concat(t.root_render_func(newContext))
+            except TypeError as te:
+                if "AnsibleUndefined" in str(te):
+                    raise AnsibleUndefinedVariable(
+                        "Unable to look up a name or access an attribute in template string (%s): %s"
+                        % (data, te)
+                    )
+                raise AnsibleError(
+                    "Unexpected templating type error occurred on (%s): %s" % (data, te)
+                )
+            unsafe = getattr(newContext, "unsafe", False)
+            if unsafe:
+                res = wrap_var(res)
+            if ansible.template.USE_JINJA2_NATIVE and not isinstance(
+                res, six.string_types
+            ):
+                return res
+
+            if preserve_trailing_newlines:
+                dataNewlines = ansible.template._count_newlines_from_end(data)
+                resNewlines = ansible.template._count_newlines_from_end(res)
+                if dataNewlines > resNewlines:
+                    res += self.environment.newline_sequence * (
+                        dataNewlines - resNewlines
+                    )
+                    if unsafe:
+                        res = wrap_var(res)
+            return res
+        except (UndefinedError, AnsibleUndefinedVariable) as e:
+            if fail_on_undefined:
+                raise AnsibleUndefinedVariable(e)
+            logger.debug("Ignoring undefined failure: %s", e)
+            return data
+
+    _do_template = do_template
+
+
+_templarPool = {}
+_templarPoolLock = threading.Lock()
+
+
+def getTemplar(baseDir, vaultSecrets=None):
+    """
+    Returns the `Templar` shared by templates evaluated in the given directory
+    with the given vault secrets, creating it if needed.
+    """
+    # key by the secrets' contents so manifests never see each other's secrets
+    secretsKey = vaultSecrets and tuple(
+        (vaultId, secret.bytes) for vaultId, secret in vaultSecrets
+    )
+    key = (baseDir, secretsKey or None)
+    with _templarPoolLock:
+        templar = _templarPool.get(key)
+        if templar is None:
+            loader = DataLoader()
+            if baseDir:
+                loader.set_basedir(baseDir)
+            if vaultSecrets:
+                loader.set_vault_secrets(vaultSecrets)
+            templar = Templar(loader)
+            _templarPool[key] = templar
+    return templar
+
 
 def _getTemplateTestRegEx():
     return Templar(DataLoader())._clean_regex
@@ -372,6 +563,83 @@ class _VarTrackerDict(dict):
             return val
 
 
+# templates that only reference a variable or its attributes, e.g. "{{ SELF.url }}"
+_varPathTemplate = re.compile(r"^\{\{\s*([A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)\s*\}\}$")
+# templates that only evaluate an expression, e.g. "{{ '.::foo' | ref }}"
+_refTemplate = re.compile(
+    r"""^\{\{\s*(?:'([^'\\]*)'|"([^"\\]*)")\s*\|\s*(?:ref|eval)\s*\}\}$"""
+)
+# names that jinja2 treats as literals
+_jinjaConstants = frozenset(["true", "false", "none", "True", "False", "None"])
+_notTrivial = object()
+
+
+def _parseTrivialTemplate(value, templar):
+    """
+    Returns ("var", names) for templates like "{{ SELF.url }}",
+    ("ref", expr) for templates like "{{ '.::foo' | ref }}" or None for any other template.
+    """
+    env = templar.environment
+    if (
+        not ansible.template.USE_JINJA2_NATIVE
+        or env.variable_start_string != "{{"
+        or env.variable_end_string != "}}"
+    ):
+        return None
+    match = _varPathTemplate.match(value)
+    if match:
+        names = match.group(1).split(".")
+        if names[0] in _jinjaConstants:
+            return None
+        return ("var", names)
+    match = _refTemplate.match(value)
+    if match:
+        return ("ref", match.group(2) if match.group(1) is None else match.group(1))
+    return None
+
+
+def _applyTrivialTemplate(parsed, ctx, templar):
+    """
+    Evaluates a template parsed by `_parseTrivialTemplate` the way Jinja would
+    but without rendering it.
+    Returns ``_notTrivial`` if rendering might have a different result
+    (e.g. if a variable is undefined or its value is another template).
+    """
+    kind, arg = parsed
+    if kind == "ref":
+        value = Ref(arg).resolveOne(ctx)
+    else:
+        if arg[0] not in ctx.vars:
+            return _notTrivial
+        value = ctx.resolveReference(arg[0])
+        # AnsibleJ2Vars templates the variable's value, only continue if that wouldn't change it
+        if hasattr(value, "__UNSAFE__"):
+            return _notTrivial
+        if isinstance(value, six.string_types):
+            if templar.is_possibly_template(value):
+                return _notTrivial
+        elif not isinstance(value, Results) and isinstance(value, (Sequence, Mapping)):
+            return _notTrivial
+        for name in arg[1:]:
+            value = templar.environment.getattr(value, name)
+            if isinstance(value, Undefined):
+                return _notTrivial
+    if isinstance(value, AnsibleVaultEncryptedUnicode):
+        # same as ansible_native_concat()
+        return value.data
+    return value
+
+
+def _setTemplateVars(templar, ctx):
+    vars = _VarTrackerDict(__unfurl=ctx)
+    vars.update(ctx.vars)
+    vars.ctx = ctx
+
+    # replaces current vars
+    # don't use setter to avoid isinstance(dict) check
+    templar._available_variables = vars
+
+
 def applyTemplate(value, ctx, overrides=None):
     if not isinstance(value, six.string_types):
         msg = "Error rendering template: source must be a string, not %s" % type(value)
@@ -380,23 +648,24 @@ def applyTemplate(value, ctx, overrides=None):
         else:
             return "<<%s>>" % msg
     value = value.strip()
+    # templates can read anything (e.g. with lookups) so queries that use them aren't memoized
+    markUncacheable()
 
     # implementation notes:
     #   see https://github.com/ansible/ansible/test/units/template/test_templar.py
     #   dataLoader is only used by _lookup and to set _basedir (else ./)
     if not ctx.templar or (ctx.baseDir and ctx.templar._basedir != ctx.baseDir):
-        # we need to create a new templar
-        loader = DataLoader()
-        if ctx.baseDir:
-            loader.set_basedir(ctx.baseDir)
-        if ctx.templar and ctx.templar._loader._vault.secrets:
-            loader.set_vault_secrets(ctx.templar._loader._vault.secrets)
-        templar = Templar(loader)
+        # use the shared templar for this directory
+        templar = getTemplar(
+            ctx.baseDir, ctx.templar and ctx.templar._loader._vault.secrets
+        )
         ctx.templar = templar
     else:
         templar = ctx.templar
 
     overrides = Templar.findOverrides(value, overrides)
+    # simple templates are evaluated directly instead of rendered by jinja2
+    trivial = not overrides and _parseTrivialTemplate(value, templar)
     if overrides:
         # returns the original values
         overrides = templar._applyTemplarOverrides(overrides)
@@ -405,15 +674,9 @@ def applyTemplate(value, ctx, overrides=None):
     # templar.environment.lstrip_blocks = False
     fail_on_undefined = ctx.strict
 
-    vars = _VarTrackerDict(__unfurl=ctx)
-    vars.update(ctx.vars)
-    vars.ctx = ctx
-
-    # replaces current vars
-    # don't use setter to avoid isinstance(dict) check
-    templar._available_variables = vars
-
     oldvalue = value
+    profile = getExprProfile()
+    frame = profile and profile.enter(profile.templates, oldvalue)
     index = ctx.referenced.start()
     # set referenced to track references (set by Ref.resolve)
     # need a way to turn on and off
@@ -422,7 +685,14 @@ def applyTemplate(value, ctx, overrides=None):
         # disable caching so we don't need to worry about the value of a cached var changing
         # use do_template because we already know it's a template
         try:
-            value = templar.template(value, fail_on_undefined=fail_on_undefined)
+            value = _notTrivial
+            if trivial:
+                value = _applyTrivialTemplate(trivial, ctx, templar)
+            if value is _notTrivial:
+                _setTemplateVars(templar, ctx)
+                value = templar.template(
+                    oldvalue, fail_on_undefined=fail_on_undefined, cache=False
+                )
         except Exception as e:
             value = "<<Error rendering template: %s>>" % str(e)
             if ctx.strict:
@@ -451,6 +721,8 @@ def applyTemplate(value, ctx, overrides=None):
                 # wrap result as AnsibleUnsafe so it isn't evaluated again
                 return wrap_var(value)
     finally:
+        if frame:
+            profile.exit(frame)
         ctx.referenced.stop()
         if overrides:
             # restore original values
@@ -521,14 +793,14 @@ def getInput(arg, ctx):
         raise UnfurlError("undefined input '%s'" % arg)
 
 
-setEvalFunc("get_input", getInput, True)
+setEvalFunc("get_input", getInput, True, pure=True)
 
 
 def concat(args, ctx):
     return "".join([str(a) for a in mapValue(args, ctx)])
 
 
-setEvalFunc("concat", concat, True)
+setEvalFunc("concat", concat, True, pure=True)
 
 
 def token(args, ctx):
@@ -536,7 +808,7 @@ def token(args, ctx):
     return args[0].split(args[1])[args[2]]
 
 
-setEvalFunc("token", token, True)
+setEvalFunc("token", token, True, pure=True)
 
 # XXX this doesn't work with node_filters, need an instance to get a specific result
 def getToscaProperty(args, ctx):
@@ -547,7 +819,7 @@ def getToscaProperty(args, ctx):
     return get_function(tosca_tpl, node_template, {"get_property": args}).result()
 
 
-setEvalFunc("get_property", getToscaProperty, True)
+setEvalFunc("get_property", getToscaProperty, True, pure=True)
 
 
 def hasEnv(arg, ctx):
@@ -619,19 +891,18 @@ def get_attribute(args, ctx):
     return ctx.query(query)
 
 
-setEvalFunc("get_attribute", get_attribute, True)
+setEvalFunc("get_attribute", get_attribute, True, pure=True)
 
 
 def get_nodes_of_type(type_name, ctx):
     return [
         r
-        for r in ctx.currentResource.root.getSelfAndDescendents()
-        if r.template.isCompatibleType(type_name)
-        and r.name not in ["inputs", "outputs"]
+        for r in ctx.currentResource.all.findInstancesOfType(type_name)
+        if r.name not in ["inputs", "outputs"]
     ]
 
 
-setEvalFunc("get_nodes_of_type", get_nodes_of_type, True)
+setEvalFunc("get_nodes_of_type", get_nodes_of_type, True, pure=True)
 
 
 def get_artifact(ctx, entity_name, artifact_name, location=None, remove=None):
@@ -930,6 +1201,8 @@ class AttributeManager(object):
     def __init__(self, yaml=None):
         self.attributes = {}
         self.statuses = {}
+        # the keys of the instances whose attributes were changed
+        self._dirty = set()
         self._yaml = yaml  # hack to safely expose the yaml context
 
     @property
@@ -955,16 +1228,23 @@ class AttributeManager(object):
 
     def getAttributes(self, resource):
         if resource.key not in self.attributes:
+            if resource._attributesVersion != resource._savedAttributesVersion:
+                # changes made with another AttributeManager weren't saved
+                touchAttributes(resource)
+                resource._savedAttributesVersion = resource._attributesVersion
+            # values are read from the instance's attributes but changes
+            # (including resolving them) are only saved in commitChanges()
+            overrides = CopyOnWriteMap(resource._attributes)
             if resource.template:
                 specd = resource.template.properties
                 defaultAttributes = resource.template.defaultAttributes
-                _attributes = ChainMap(
-                    copy.deepcopy(resource._attributes), specd, defaultAttributes
-                )
+                _attributes = ChainMap(overrides, specd, defaultAttributes)
             else:
-                _attributes = ChainMap(copy.deepcopy(resource._attributes))
+                _attributes = ChainMap(overrides)
 
-            attributes = ResultsMap(_attributes, RefContext(resource))
+            attributes = ResultsMap(
+                _attributes, RefContext(resource), True, self._dirty
+            )
             self.attributes[resource.key] = (resource, attributes)
             return attributes
         else:
@@ -978,6 +1258,9 @@ class AttributeManager(object):
     def commitChanges(self):
         changes = {}
         for resource, attributes in self.attributes.values():
+            if resource.key not in self._dirty:
+                # only read so there's nothing to save
+                continue
             # save in _attributes in serialized form
             overrides, specd = attributes._attributes.split()
             resource._attributes = {}
@@ -1006,17 +1289,23 @@ class AttributeManager(object):
                             )
                             foundSensitive.append(key)
                             continue
-                    resource._attributes[key] = value.asRef()  # serialize Result
+                    # serialize Result, values that weren't read are saved as is
+                    resource._attributes[key] = value.asRef(dict(lazy=True))
 
             # save changes
             diff = attributes.getDiff()
             if not diff:
+                resource._savedAttributesVersion = resource._attributesVersion
                 continue
+            # the saved values can differ from the live ones (e.g. sensitive values)
+            touchAttributes(resource)
+            resource._savedAttributesVersion = resource._attributesVersion
             for key in foundSensitive:
                 if key in diff:
                     diff[key] = resource._attributes[key]
             changes[resource.key] = diff
 
         self.attributes = {}
+        self._dirty = set()
         # self.statuses = {}
         return changes
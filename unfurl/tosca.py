@@ -453,6 +453,26 @@ class NodeSpec(EntitySpec):
         self._requirements = None
         self._relationships = None
         self._artifacts = None
+        self._typeNames = None
+
+    def isCompatibleType(self, typeStr):
+        return typeStr in self.getTypeNames()
+
+    def getTypeNames(self):
+        """
+        Returns the name of this template's type followed by the names of the types it derives from.
+        """
+        if self._typeNames is None:
+            # same logic as toscaEntityTemplate.is_derived_from()
+            typeNames = []
+            if self.toscaEntityTemplate.type:
+                typeNames.append(self.toscaEntityTemplate.type)
+                parent = self.toscaEntityTemplate.parent_type
+                while parent and parent.type:
+                    typeNames.append(parent.type)
+                    parent = parent.parent_type
+            self._typeNames = typeNames
+        return self._typeNames
 
     @property
     def artifacts(self):
@@ -775,6 +795,9 @@ class TopologySpec(EntitySpec):
     def isCompatibleType(self, typeStr):
         return False
 
+    def getTypeNames(self):
+        return []
+
 
 class Workflow(object):
     def __init__(self, workflow):
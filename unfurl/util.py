@@ -12,13 +12,15 @@ import os
 import fnmatch
 import shutil
 import collections
+import threading
+import time
 
 if os.name == "posix" and sys.version_info[0] < 3:
     import subprocess32 as subprocess
 else:
     import subprocess
 
-from collections import Mapping
+from collections import Mapping, MutableMapping
 import os.path
 from jsonschema import Draft7Validator, validators, RefResolver
 import jsonschema.exceptions
@@ -463,6 +465,58 @@ class ChainMap(Mapping):
         return "ChainMap(%r)" % (self._maps,)
 
 
+class CopyOnWriteMap(MutableMapping):
+    """
+    A mapping that reads from the given mapping until a key is set or deleted.
+    Changes are recorded in ``changes`` and ``deleted`` so the original mapping
+    isn't modified.
+    """
+
+    def __init__(self, original):
+        self.original = original
+        self.changes = {}
+        self.deleted = set()  # keys deleted from the original
+
+    @property
+    def baseDir(self):
+        return getattr(self.original, "baseDir", None)
+
+    def __getitem__(self, key):
+        try:
+            return self.changes[key]
+        except KeyError:
+            if key in self.deleted:
+                raise
+            return self.original[key]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.changes.pop(key, None)
+        if key in self.original:
+            self.deleted.add(key)
+
+    def __iter__(self):
+        # keep the original's order, new keys are added at the end
+        for key in self.original:
+            if key not in self.deleted:
+                yield key
+        for key in self.changes:
+            if key not in self.original:
+                yield key
+
+    def __len__(self):
+        added = len([key for key in self.changes if key not in self.original])
+        return len(self.original) - len(self.deleted) + added
+
+    def __repr__(self):
+        return "CopyOnWriteMap(%r, %r)" % (self.original, self.changes)
+
+
 class Generate(object):
     """
     Roughly equivalent to "yield from" but works in Python < 3.3
@@ -487,6 +541,48 @@ class Generate(object):
             return False
 
 
+class TokenBucket(object):
+    """
+    Limits how often an operation happens to ``rate`` times per second on average,
+    allowing bursts of up to ``burst`` operations. Thread-safe.
+
+    Usage:
+
+    >>>  bucket = TokenBucket(5, burst=10)
+    >>>  bucket.acquire()  # sleeps until the operation is allowed
+    """
+
+    def __init__(self, rate, burst=1, clock=time.time):
+        assert rate > 0 and burst >= 1, (rate, burst)
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token from the bucket and returns the number of seconds
+        to wait before it can be used (0 if it can be used now).
+        """
+        with self._lock:
+            now = self.clock()
+            elapsed = max(now - self.last, 0)
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
 def filterEnv(rules, env=None, addOnly=False):
     """
     If 'env' is None it will be set to os.environ
@@ -9,12 +9,13 @@ import collections
 import numbers
 import os.path
 import itertools
+import time
 
 from . import DefaultNames
-from .util import UnfurlError, toYamlText, filterEnv
+from .util import UnfurlError, toYamlText, filterEnv, sensitive_str
 from .merge import patchDict, intersectDict
 from .yamlloader import YamlConfig
-from .result import serializeValue
+from .result import serializeValue, ChangeRecord
 from .support import ResourceChanges, Defaults, Imports, Status
 from .localenv import LocalEnv
 from .lock import Lock
@@ -25,6 +26,7 @@ from .eval import mapValue
 from .tosca import ToscaSpec, TOSCA_VERSION
 
 from ruamel.yaml.comments import CommentedMap
+from ruamel.yaml.error import YAMLError
 from codecs import open
 
 import logging
@@ -141,6 +143,8 @@ def saveTask(task):
       messages:
       outputs:
       result:  # an object or "skipped"
+      timings:  # wall and cpu time in seconds for each phase of the task
+      digest:  # digest of its configuration and inputs (see `TaskView.getDigest`)
     """
     output = CommentedMap()
     output["changeId"] = task.changeId
@@ -165,10 +169,58 @@ def saveTask(task):
             output["result"] = saveResult(task.result.result)
     else:
         output["result"] = "skipped"
+    if task.timings:
+        output["timings"] = CommentedMap(task.getTimings().items())
+    if task.digest:
+        output["digest"] = task.digest
 
     return output
 
 
+class JobCheckpoint(object):
+    """
+    An append-only journal of the tasks a job has completed,
+    written as the job runs so it can be resumed if it is interrupted.
+    Each task is saved as a separate YAML document
+    (see `saveTask`) with the state of its target.
+    """
+
+    syncInterval = 1.0  # seconds between fsyncs
+
+    def __init__(self, path, yaml, jobRecord):
+        self.path = path
+        self.yaml = yaml
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.file = open(path, "w")
+        self.lastSync = 0
+        self._write(jobRecord)
+
+    def _write(self, record):
+        self.file.write("---\n")
+        self.yaml.dump(record, self.file)
+        self.file.flush()
+        now = time.time()
+        if now - self.lastSync >= self.syncInterval:
+            os.fsync(self.file.fileno())
+            self.lastSync = now
+
+    def append(self, task):
+        record = saveTask(task)
+        record["configDigest"] = task.configSpec.getDigest()
+        record["modified"] = task.modifiedTarget()
+        if task.result.status is not None:
+            record["resultStatus"] = task.result.status.name
+        if task.target.state is not None:
+            record["targetState"] = task.target.state.name
+        self._write(record)
+
+    def close(self):
+        if not self.file.closed:
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+
 class ReadOnlyManifest(Manifest):
     """Loads an ensemble from a manifest but doesn't instantiate the instance model."""
 
@@ -431,6 +483,10 @@ class YamlManifest(ReadOnlyManifest):
         saveStatus(resource, status)
         if resource.created is not None:
             status["created"] = resource.created
+        if resource._configDigests:
+            status["configDigests"] = CommentedMap(
+                sorted(resource._configDigests.items())
+            )
 
         return (resource.name, status)
 
@@ -569,6 +625,86 @@ class YamlManifest(ReadOnlyManifest):
             job.out = self.manifest.save()
         return jobRecord, changes
 
+    def getCheckpointPath(self):
+        return os.path.join(self.jobsFolder, "checkpoint.yaml")
+
+    def startCheckpoint(self, job):
+        if not self.manifest.path or job.dryRun:
+            return None
+        jobRecord = CommentedMap(
+            [
+                ("changeId", job.changeId),
+                ("workflow", job.workflow),
+                ("specDigest", self.specDigest),
+            ]
+        )
+        return JobCheckpoint(self.getCheckpointPath(), self.yaml, jobRecord)
+
+    def loadCheckpoint(self, job):
+        """
+        Returns the tasks recorded by the job's checkpoint if the last job was interrupted.
+        """
+        path = self.getCheckpointPath()
+        if not self.manifest.path or not os.path.exists(path):
+            logger.info("no checkpoint found to resume from")
+            return []
+        records = []
+        with open(path) as f:
+            try:
+                for record in self.yaml.load_all(f):
+                    if record:
+                        records.append(record)
+            except YAMLError as e:
+                # the job was interrupted while the last record was being written
+                logger.warning("ignoring truncated record in checkpoint: %s", e)
+        if not records:
+            return []
+        jobRecord = records.pop(0)
+        if jobRecord.get("workflow") != job.workflow:
+            logger.warning(
+                'not resuming job %s: workflow was "%s" not "%s"',
+                jobRecord.get("changeId"),
+                jobRecord.get("workflow"),
+                job.workflow,
+            )
+            return []
+        if jobRecord.get("specDigest") != self.specDigest:
+            logger.warning(
+                "not resuming job %s: the spec has changed", jobRecord.get("changeId")
+            )
+            return []
+        records = [r for r in records if self._isResumable(r)]
+        logger.info(
+            "resuming job %s with %s completed tasks",
+            jobRecord.get("changeId"),
+            len(records),
+        )
+        return records
+
+    @staticmethod
+    def _isResumable(record):
+        if "configDigest" not in record:
+            # incomplete, see JobCheckpoint.append()
+            logger.warning(
+                "ignoring truncated record in checkpoint for task %s",
+                record.get("changeId"),
+            )
+            return False
+        for changes in (record.get("changes") or {}).values():
+            if sensitive_str.redacted_str in changes.values():
+                # the value can't be restored, run the task again
+                logger.info(
+                    "not resuming task %s: it saved a redacted value",
+                    record.get("changeId"),
+                )
+                return False
+        return True
+
+    def removeCheckpoint(self):
+        path = self.getCheckpointPath()
+        if os.path.exists(path):
+            os.remove(path)
+
     def commitJob(self, job):
         if job.planOnly:
             return
@@ -577,6 +713,9 @@ class YamlManifest(ReadOnlyManifest):
             if not job.out and self.manifest.path:
                 job.out = sys.stdout
         jobRecord, changes = self.saveJob(job)
+        if not job.dryRun:
+            # the job's changes are saved now
+            self.removeCheckpoint()
         if not changes:
             logger.info("job run didn't make any changes; nothing to commit")
             return
@@ -678,8 +817,41 @@ class YamlManifest(ReadOnlyManifest):
                     target=task.target.key,
                     summary=task.summary(),
                 )
+                attrs["operation"] = task.configSpec.operation
+                if task.timings:
+                    attrs["timings"] = task.formatTimings()
                 f.write(task.log(attrs))
 
+    def getTaskDurations(self):
+        """
+        Returns a dictionary mapping ``(target key, operation)`` to the wall time in seconds
+        the last task with that target and operation took, as recorded in the changelog.
+        """
+        durations = {}
+        if not self.changeLogPath:
+            return durations
+        logPath = self.getChangeLogPath()
+        if not os.path.exists(logPath):
+            return durations
+        with open(logPath) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = ChangeRecord(parse=line.rstrip("\n"))
+                timings = getattr(record, "timings", None)
+                operation = getattr(record, "operation", None)
+                if not timings or not operation:
+                    continue
+                try:
+                    total = sum(
+                        float(timing.partition(":")[2].partition("/")[0])
+                        for timing in timings.split(";")
+                    )
+                except ValueError:
+                    continue
+                durations[(record.target, operation)] = total
+        return durations
+
     def saveChangeLog(self, jobRecord, newChanges):
         try:
             changelog = CommentedMap()